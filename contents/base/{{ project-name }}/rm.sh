@@ -1,5 +1,6 @@
 rm -rf src/
 rm -rf tests/
 rm -rf manage/
+rm -rf benchmarks/
 rm Dockerfile
 rm -rf *.*
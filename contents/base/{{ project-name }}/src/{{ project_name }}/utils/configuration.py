@@ -1,13 +1,44 @@
+import atexit
 import logging.config
 import os
+import sys
 import yaml
 from pathlib import Path
+from .structured_logging import LazyQueueHandler, start_queue_logging
+
+_configured = False
+_listener = None
 
 
 def configure_logging():
+    """
+    Configure logging from logging.yaml, once. With queue.enabled the root handlers run in a background
+    thread fed by a non blocking queue of queue.capacity records, which is flushed at exit.
+    """
+    global _configured, _listener
+
+    if _configured:
+        return
+    _configured = True
+
     logging_config = os.path.join(Path(__file__).parent.parent.parent.parent, 'logging.yaml')
     with open(logging_config, 'rt') as f:
         config = yaml.safe_load(f.read())
 
+    # not a dictConfig key
+    queue_config = config.pop("queue", {})
+
     # Configure the logging module with the config file
     logging.config.dictConfig(config)
+
+    if queue_config.get("enabled", False):
+        root = logging.getLogger()
+        _listener = start_queue_logging(root, int(queue_config.get("capacity", 10000)))
+        atexit.register(_stop_listener, root)
+
+
+def _stop_listener(root: logging.Logger):
+    _listener.stop()
+    dropped = sum(handler.dropped for handler in root.handlers if isinstance(handler, LazyQueueHandler))
+    if dropped:
+        print(f"logging - {dropped} records dropped, the log queue was full", file=sys.stderr)
@@ -0,0 +1,107 @@
+import json
+import logging
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+# attributes of every LogRecord, the others were passed with extra= and are written as fields
+_RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """One json object per line: time, level, logger, thread, message, the extra= fields and the exception"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        rc = {
+            "time": self.formatTime(record, self.datefmt),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES:
+                rc[key] = value
+        if record.exc_info:
+            rc["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            rc["exception"] = record.exc_text
+        if record.stack_info:
+            rc["stack"] = self.formatStack(record.stack_info)
+        return json.dumps(rc, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Lets through at most burst messages of each type every interval seconds, the type of a message is its
+    logger and unformatted message, so messages logged with %-style arguments share a type. The first message
+    let through after some were dropped carries their number as sampled_out. Warnings and errors are never
+    dropped.
+    """
+
+    def __init__(self, burst: int = 20, interval: float = 10.0, level: str = "WARNING"):
+        super().__init__()
+        self.burst = int(burst)
+        self.interval = float(interval)
+        self.level = logging.getLevelName(level) if isinstance(level, str) else int(level)
+        self._windows = {}  # type -> [window start, messages let through, messages dropped]
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= self.level:
+            return True
+
+        key = (record.name, str(record.msg))
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                dropped = window[2] if window is not None else 0
+                window = self._windows[key] = [now, 0, 0]
+                if dropped:
+                    record.sampled_out = dropped
+            if window[1] >= self.burst:
+                window[2] += 1
+                return False
+            window[1] += 1
+        return True
+
+
+class LazyQueueHandler(QueueHandler):
+    """
+    QueueHandler that leaves the formatting to the listener thread and never blocks: the record is queued with
+    its message and arguments as logged, and dropped (and counted) when the queue is full. Arguments should not
+    be mutated after they are logged.
+    """
+
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def start_queue_logging(logger: logging.Logger, capacity: int = 10000) -> QueueListener:
+    """
+    Move the handlers of logger behind a LazyQueueHandler, they are run by a QueueListener thread so that
+    formatting and writes do not happen in the threads that log
+    :return: the started listener, stop() flushes the queue
+    """
+
+    handlers = list(logger.handlers)
+    q = queue.Queue(maxsize=capacity)
+    for handler in handlers:
+        logger.removeHandler(handler)
+    logger.addHandler(LazyQueueHandler(q))
+
+    listener = QueueListener(q, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
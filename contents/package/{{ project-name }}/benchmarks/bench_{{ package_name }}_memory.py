@@ -0,0 +1,128 @@
+"""
+Memory benchmark for the {{ package_name }} package: records buffered from decoded result pages.
+
+Pages shaped like talkwalker results, with the repetition of a real topic (a few languages and source types,
+a few hundred sources and their world_data, a handful of matched profiles), are decoded and formatted like
+in the pipeline and every record is kept, like pending windows and tweet batches are. tracemalloc reports
+the memory held by the records and the peak, with the interning of compact.py turned off and on. Run it from
+the project root:
+
+    poetry run python benchmarks/bench_{{ package_name }}_memory.py --items 20000
+"""
+import argparse
+import gc
+import json
+import random
+import tracemalloc
+from types import SimpleNamespace
+
+from {{ project_name }}.{{ package_name }} import compact
+from {{ project_name }}.{{ package_name }}.compact import CompactRecord
+from {{ project_name }}.{{ package_name }}.transform import transform_page
+
+LANGS = ["en", "en", "en", "fr", "de", "es", "it", "nl", "pt", "ja"]
+SOURCE_TYPES = [
+    ["ONLINENEWS", "ONLINENEWS_NEWSPAPER"],
+    ["ONLINENEWS", "ONLINENEWS_AGENCY"],
+    ["BLOG", "BLOG_OTHER"],
+    ["SOCIALMEDIA", "SOCIALMEDIA_TWITTER"],
+    ["FORUM", "FORUM_OTHER"],
+]
+PROFILES = [["profile-brand"], ["profile-brand", "profile-competitors"], ["profile-competitors"]]
+COUNTRIES = [("Europe", "France", "FR"), ("Europe", "Germany", "DE"), ("North America", "United States", "US")]
+
+
+def fixture(items: int, page_size: int = 100, sources: int = 300, seed: int = 1) -> list:
+    """Raw result pages (bytes), the sources repeat with their domain, attributes and world_data"""
+
+    rng = random.Random(seed)
+    source_list = []
+    for i in range(sources):
+        continent, country, code = rng.choice(COUNTRIES)
+        source_list.append({
+            "domain": f"site{i}.example.com",
+            "world_data": {
+                "continent": continent, "country": country, "region": f"Region {i % 20}", "city": f"City {i % 50}",
+                "longitude": round(rng.uniform(-120, 20), 4), "latitude": round(rng.uniform(30, 55), 4),
+                "country_code": code, "resolution": "city",
+            },
+        })
+
+    pages = []
+    for start in range(0, items, page_size):
+        page = []
+        for i in range(start, min(start + page_size, items)):
+            source = rng.choice(source_list)
+            page.append({"data": {
+                "url": f"https://{source['domain']}/articles/{i}",
+                "matched_profile": rng.choice(PROFILES),
+                "indexed": 1712700000123 + i,
+                "search_indexed": 1712700000456 + i,
+                "published": 1712700000000 + i * 1000,
+                "title": f"Title of article {i}",
+                "content": f"Content of article {i} " * 8,
+                "root_url": f"https://{source['domain']}/",
+                "domain_url": f"https://{source['domain']}/",
+                "host_url": f"https://{source['domain']}/articles/",
+                "lang": rng.choice(LANGS),
+                "sentiment": rng.randint(-5, 5),
+                "source_type": rng.choice(SOURCE_TYPES),
+                "post_type": ["TEXT"],
+                "tokens_title": ["title", "article"],
+                "source_extended_attributes": {
+                    "world_data": source["world_data"], "id": source["domain"], "name": source["domain"],
+                },
+                "extra_author_attributes": {
+                    "world_data": source["world_data"], "id": f"author{i % 1000}", "name": f"Author {i % 1000}",
+                    "gender": rng.choice(["MALE", "FEMALE", "UNKNOWN"]),
+                },
+                "engagement": rng.randint(0, 100),
+                "reach": rng.randint(0, 10000),
+                "word_count": 32,
+            }})
+        pages.append(json.dumps({"result_content": {"data": page}}).encode())
+    return pages
+
+
+def buffer_records(pages: list) -> list:
+    """Decode and format the pages like the pipeline does, keeping every record"""
+    records = []
+    for content in pages:
+        page = json.loads(content, object_hook=lambda d: SimpleNamespace(**d)).result_content.data
+        formatted, _ = transform_page(page)
+        records.extend(CompactRecord.from_dict(data) for data in formatted)
+    return records
+
+
+def measure(pages: list, interning: bool):
+    compact.INTERNING = interning
+    gc.collect()
+    tracemalloc.start()
+    records = buffer_records(pages)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return records, current, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--items", type=int, default=20000)
+    args = parser.parse_args()
+
+    pages = fixture(args.items)
+
+    print(f"{'interning':<10} {'held MB':>9} {'peak MB':>9} {'held B/record':>14}")
+    outputs = []
+    for interning in (False, True):
+        records, current, peak = measure(pages, interning)
+        print(f"{'on' if interning else 'off':<10} {current / 2**20:>9.1f} {peak / 2**20:>9.1f} "
+              f"{current / len(records):>14.0f}")
+        outputs.append([record.to_json() for record in records])
+        del records
+    compact.INTERNING = True
+
+    print(f"identical output: {outputs[0] == outputs[1]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+Tweet merge benchmark for the {{ package_name }} package: time and memory per merged tweet.
+
+Compares transform.merge_tweet, which merges the tweet into the item dict in place, with the previous
+implementation that copied both into a new dict. Merged items are kept alive until the end of the run, like
+they are until serialization. tracemalloc reports the memory they hold and the peak of each merge over the
+memory held before it. Run it from the project root:
+
+    poetry run python benchmarks/bench_{{ package_name }}_merge.py --tweets 10000
+"""
+import argparse
+import time
+import tracemalloc
+from datetime import datetime
+
+from {{ project_name }}.{{ package_name }}.transform import merge_tweet
+
+
+def merge_tweet_copying(tweet_data: dict, item: dict) -> dict:
+    """merge_tweet before it worked in place, for comparison"""
+    created_at = tweet_data["created_at"].replace(" ", "").replace("\n", "")
+    dt_obj = datetime.strptime(created_at, "%Y-%m-%dT%H:%M:%S.%fZ")
+    created_epoch_unix = int(dt_obj.timestamp())
+
+    data = {**item, **tweet_data}
+    if data["published"] == -1 or data["published"] == 0:
+        data["published"] = created_epoch_unix
+        data["x-p6m-publish-source"] = "twitter"
+    text = data.pop("text")
+    data["content"] = text
+    data["word_count"] = len(text.split())
+    data["external_provider_attributes"] = tweet_data
+    data["url"] = tweet_data["id"]
+    return data
+
+
+def sample(i: int):
+    """(tweet, item dict) pair shaped like a twitter lookup result and a CompactRecord.to_dict()"""
+    tweet_id = str(1700000000000000000 + i)
+    tweet = {
+        "id": tweet_id,
+        "author_id": str(1000 + i % 97),
+        "created_at": "2024-04-10T08:15:30.000Z",
+        "text": f"tweet {i} with a link https://t.co/abcdef and a few more words to count #hashtag",
+        "lang": "en",
+        "public_metrics": {"retweet_count": i % 7, "reply_count": 0, "like_count": i % 13, "quote_count": 0},
+    }
+    item = {
+        "url": f"https://twitter.com/user/status/{tweet_id}",
+        "indexed": 1712736930000,
+        "search_indexed": 1712736930000,
+        "published": 1712736930 if i % 4 else 0,
+        "title": "",
+        "content": "",
+        "title_snippet": "",
+        "root_url": "https://twitter.com/",
+        "domain_url": "https://twitter.com/",
+        "host_url": "https://twitter.com/user",
+        "lang": "en",
+        "porn_level": 0,
+        "fluency_level": 80,
+        "spam_level": 10,
+        "sentiment": 0,
+        "source_type": ["SOCIALMEDIA", "SOCIALMEDIA_TWITTER"],
+        "post_type": ["TEXT"],
+        "tokens_title": [],
+        "tokens_content": ["tweet", "link"],
+        "tokens_mention": [],
+        "tags_internal": [],
+        "article_extended_attributes": {"twitter_followers": 120},
+        "source_extended_attributes": {},
+        "extra_author_attributes": {"id": tweet_id, "name": "user"},
+        "engagement": i % 13,
+        "reach": 120,
+        "external_provider": "twitter",
+        "external_id": int(tweet_id),
+        "source": "twitter",
+    }
+    return tweet, item
+
+
+def measure(merge, pairs) -> dict:
+    # every merge gets an item dict of its own, like the one to_dict() returns in merge_tweet_data
+    start = time.perf_counter()
+    merged = [merge(tweet, dict(item)) for tweet, item in pairs]
+    elapsed = time.perf_counter() - start
+    del merged
+
+    # memory in a second pass, tracemalloc slows allocations down
+    tracemalloc.start()
+    merged = []
+    transient = 0
+    for tweet, item in pairs:
+        item = dict(item)
+        held = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        merged.append(merge(tweet, item))
+        # memory allocated during the merge above what was held before it
+        transient += tracemalloc.get_traced_memory()[1] - held
+    current = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    count = len(merged)
+    return {"us": elapsed / count * 1e6, "held": current / count, "merge_peak": transient / count}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--tweets", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    pairs = [sample(i) for i in range(args.tweets)]
+
+    print(f"{'per merged tweet':<20} {'us':>8} {'held B':>10} {'merge peak B':>14}")
+    for name, merge in (("copying (before)", merge_tweet_copying), ("in place (after)", merge_tweet)):
+        runs = [measure(merge, pairs) for _ in range(args.repeat)]
+        best = min(runs, key=lambda run: run["us"])
+        print(f"{name:<20} {best['us']:>8.2f} {best['held']:>10.0f} {best['merge_peak']:>14.0f}")
+
+
+if __name__ == "__main__":
+    main()
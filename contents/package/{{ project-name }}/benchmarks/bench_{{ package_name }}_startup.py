@@ -0,0 +1,74 @@
+"""
+Cold start benchmark for the {{ package_name }} package: import time of each entry point.
+
+Every measurement runs in a fresh interpreter with `-X importtime`, so modules imported by an earlier
+measurement do not hide the cost. Run it from the project root:
+
+    poetry run python benchmarks/bench_{{ package_name }}_startup.py --repeat 5
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+
+PACKAGE = "{{ project_name }}.{{ package_name }}"
+
+ENTRY_POINTS = [
+    f"{PACKAGE}.main",
+    f"{PACKAGE}.driver",
+    f"{PACKAGE}.source",
+    f"{PACKAGE}.credits",
+    f"{PACKAGE}.record",
+]
+
+
+def import_times(module: str) -> dict:
+    """Import module in a fresh interpreter and return the cumulative import time (us) of every module"""
+
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr.splitlines()[-1]}")
+
+    rc = {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        rc[name.strip()] = int(cumulative)
+    return rc
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=5, help="heaviest dependencies to list per entry point")
+    args = parser.parse_args()
+
+    print(f"{'entry point':<45} {'min ms':>8} {'median ms':>10}")
+    for module in ENTRY_POINTS:
+        try:
+            runs = [import_times(module) for _ in range(args.repeat)]
+        except RuntimeError as e:
+            print(f"{module:<45} {'n/a':>8} {'n/a':>10}  {e}")
+            continue
+
+        totals = [run[module] / 1000 for run in runs]
+        print(f"{module:<45} {min(totals):>8.1f} {statistics.median(totals):>10.1f}")
+
+        # top level third party packages are the usual suspects (newspaper, nltk, boto3, pydantic...)
+        fastest = runs[totals.index(min(totals))]
+        heavy = sorted(
+            ((us, name) for name, us in fastest.items() if "." not in name and name != module.split(".")[0]),
+            reverse=True,
+        )
+        for us, name in heavy[:args.top]:
+            print(f"    {name:<41} {us / 1000:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+import sys
+from .{{ package_name }}.main import main
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,201 @@
+import asyncio
+import json
+import logging
+import queue
+import threading
+import time
+from types import SimpleNamespace
+from .concurrency import classify
+from .source import TalkwalkerSource
+from .useragent import get_user_agent
+
+# NOTE: aiohttp is imported where it is used, the threaded engine is the default and does not need it.
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+class AsyncTalkwalkerSource(TalkwalkerSource):
+    """
+    TalkwalkerSource fetching its search windows with asyncio and aiohttp, selected with tw_fetch_engine=asyncio.
+
+    All windows are fetched concurrently on a single event loop, the pages of a window one after the other,
+    with up to max_in_flight requests open at once. Requests still go through the shared rate limiter, whose
+    reservations are awaited instead of slept, and through the adaptive limit and circuit breaker of their
+    upstream, whose slots are polled for. The pages are formatted and written by the same pipeline as the
+    pages of the threaded engine.
+    """
+
+    def __init__(self, *args, max_in_flight: int = 200, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_in_flight = max_in_flight
+        self._in_flight = None
+
+    def results_url(self) -> str:
+        return f"https://api.talkwalker.com/api/v1/search/p/{self.project_id}/results"
+
+    def _client_session(self):
+        import aiohttp
+
+        self._in_flight = asyncio.Semaphore(self.max_in_flight)
+        return aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.max_in_flight), timeout=aiohttp.ClientTimeout(total=10)
+        )
+
+    async def download_as_object_async(self, http, url, parameters):
+        headers = {"User-Agent": get_user_agent()}
+        params = {key: str(value) for key, value in parameters.items()}
+        limiter = self.upstreams.for_url(url)
+        for i in range(self.max_retries):
+            try:
+                # waits while talkwalker is paused by the circuit breaker instead of burning the retries
+                async with limiter.track_async() as call, self._in_flight:
+                    start = time.monotonic()
+                    async with http.get(url, params=params, headers=headers) as response:
+                        status = response.status
+                        content = await response.read()
+                    seconds = time.monotonic() - start
+                    call.outcome = classify(status)
+
+                x = json.loads(content, object_hook=lambda d: SimpleNamespace(**d))
+                if status >= 400:
+                    raise ValueError(f"{status} Error for url: {url}")
+                if self.page_archive is not None:
+                    self.page_archive.add_page(content)
+
+                pagination = getattr(x, "pagination", None)
+                return {
+                    "data": x, "pagination": vars(pagination) if pagination is not None else {}, "seconds": seconds,
+                    "bytes": len(content),
+                }
+            except asyncio.TimeoutError:
+                self.logger.error("Request timed out. Attempt: %s", i + 1)
+                self.log_error(f"Request timed out. Attempt: {i + 1}")
+                if i < self.max_retries - 1:  # wait before retrying, but not after the last attempt
+                    await asyncio.sleep(5 * (i + 1))
+                else:
+                    break
+            except Exception as e:
+                self.logger.error("%s", e)
+                self.log_error(f"{e}")
+
+    async def fetch_pages_async(self, http, url, parameters, emit) -> tuple:
+        """
+        Async fetch_pages(), awaits emit(page) for every page
+        :return: number of items of the window, and the offset of its next page when it was given up at the
+            deadline before its last page, None when all its pages were fetched
+        """
+
+        loop = asyncio.get_running_loop()
+        scrape_start_time = loop.time()
+        count = 0
+
+        while True:
+            delay = self.rate_limiter.reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            x = await self.download_as_object_async(http, url, parameters)
+            if x is None:
+                break
+
+            content = x.get("data").result_content
+            if content is None:
+                break
+
+            data = getattr(content, "data", None)
+            if data is None:
+                break
+
+            count += len(data)
+            self.page_sizer.observe(len(data), x["seconds"], x["bytes"])
+            await emit(data)
+
+            pagination = x.get("pagination", {})
+            next_offset = self.extract_offset_from_next(pagination.get("next", ""))
+            if next_offset is None:
+                break
+
+            parameters["offset"] = next_offset
+            parameters["hpp"] = self.page_sizer.next_size(pagination.get("total"), next_offset)
+
+            if self.scheduler is not None and self.scheduler.expired():
+                self.logger.warning("Deadline reached, giving up the window at offset %s", next_offset)
+                return count, next_offset
+
+            if loop.time() - scrape_start_time < self.page_interval:
+                await asyncio.sleep(self.page_interval)
+        return count, None
+
+    def iter_pages(self, windows, queue_size: int = 64):
+        """
+        Yields the raw pages of all windows as they arrive, up to max_in_flight windows are fetched
+        concurrently. Windows are taken from the windows iterable as fetchers become free. The event loop runs
+        in its own thread, so the requests progress while the caller processes a page. At most queue_size
+        pages are buffered, a fetcher whose page does not fit waits for the caller while the others go on.
+        """
+
+        url = self.results_url()
+        loop = asyncio.new_event_loop()
+        pages = queue.Queue(maxsize=queue_size)
+        windows = iter(windows)
+        errors = []
+
+        async def emit(page):
+            while True:
+                try:
+                    pages.put_nowait(page)
+                    return
+                except queue.Full:
+                    await asyncio.sleep(0.05)
+
+        async def fetcher(http):
+            for w in windows:
+                start, end, label = w
+                parameters = self.window_parameters(start, end)
+                if self.scheduler is not None:
+                    parameters["offset"] = self.scheduler.offset(w)
+                count, next_offset = await self.fetch_pages_async(http, url, parameters, emit)
+                self.logger.info("Item retrieved for %s: %s", label, count)
+                # a window given up at the deadline is resumed from its next page by the follow-up run
+                if self.scheduler is not None:
+                    if next_offset is None:
+                        self.scheduler.complete(w, count)
+                    else:
+                        self.scheduler.give_up(w, next_offset)
+
+        async def produce():
+            async with self._client_session() as http:
+                await asyncio.gather(*(fetcher(http) for _ in range(self.max_in_flight)))
+
+        producer = loop.create_task(produce())
+
+        def run():
+            try:
+                loop.run_until_complete(producer)
+            except BaseException as e:
+                errors.append(e)
+            finally:
+                pages.put(_DONE)
+
+        thread = threading.Thread(target=run, name="asyncio-fetch", daemon=True)
+        thread.start()
+        done = False
+        try:
+            while True:
+                page = pages.get()
+                if page is _DONE:
+                    done = True
+                    break
+                yield page
+        finally:
+            if not done:
+                # the caller stopped early, the pages still buffered are dropped until the fetchers are cancelled
+                loop.call_soon_threadsafe(producer.cancel)
+                while pages.get() is not _DONE:
+                    pass
+            thread.join()
+            loop.close()
+        if errors:
+            # the error of a failed window
+            raise errors[0]
@@ -0,0 +1,235 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class MetadataCache:
+    """
+    TTL cache for Talkwalker metadata lookups (project names, topic names, credits).
+
+    Entries are json files in a local directory. When a bucket is given they are mirrored to
+    s3://{bucket}/{prefix}/ as well, so short lived pods can reuse lookups made by earlier pods.
+    An entry is only reloaded from the API when it is missing or older than its TTL.
+    """
+
+    def __init__(self, ttl: int, directory: str, bucket: str = None, prefix: str = "cache/talkwalker"):
+        self.ttl = ttl
+        self.directory = directory
+        self.bucket = bucket
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+        self._s3 = None
+
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def token_key(access_token: str) -> str:
+        """Short digest of the access token, different tokens see different projects and credits"""
+        return hashlib.sha1(access_token.encode()).hexdigest()[:12]
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _s3_client(self):
+        if self._s3 is None:
+            import boto3
+            self._s3 = boto3.client("s3")
+        return self._s3
+
+    def _read_local(self, key: str):
+        try:
+            with open(self._path(key), "rt") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _read_bucket(self, key: str):
+        try:
+            response = self._s3_client().get_object(Bucket=self.bucket, Key=f"{self.prefix}/{key}.json")
+            return json.loads(response["Body"].read())
+        except Exception as e:
+            logger.info(f"metadata cache - {key} not available in bucket {self.bucket}: {e}")
+            return None
+
+    def _fresh(self, entry, ttl: int) -> bool:
+        return entry is not None and time.time() - entry["stored_at"] < ttl
+
+    def get(self, key: str, ttl: int = None):
+        """Return the cached value of key, or None when it is missing or stale"""
+
+        ttl = self.ttl if ttl is None else ttl
+
+        entry = self._read_local(key)
+        if not self._fresh(entry, ttl) and self.bucket:
+            entry = self._read_bucket(key)
+            if self._fresh(entry, ttl):
+                self._write_local(key, entry)
+
+        if self._fresh(entry, ttl):
+            self.hits += 1
+            return entry["value"]
+
+        self.misses += 1
+        return None
+
+    def _write_local(self, key: str, entry: dict) -> None:
+        # write to a temp file first, concurrent pods on a shared volume never see partial entries, and the
+        # threads of a backfill writing the same key never replace each other's temp file
+        tmp_path = f"{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wt") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, self._path(key))
+
+    def put(self, key: str, value) -> None:
+        entry = {"stored_at": time.time(), "value": value}
+        self._write_local(key, entry)
+
+        if self.bucket:
+            try:
+                self._s3_client().put_object(
+                    Bucket=self.bucket, Key=f"{self.prefix}/{key}.json", Body=json.dumps(entry).encode()
+                )
+            except Exception as e:
+                logger.warning(f"metadata cache - could not store {key} in bucket {self.bucket}: {e}")
+
+    def get_or_load(self, key: str, loader, ttl: int = None):
+        """Return the cached value of key, calling loader() and caching its result on a miss"""
+
+        value = self.get(key, ttl)
+        if value is None:
+            value = loader()
+            # failed lookups are not cached, the next run retries them
+            if value is not None:
+                self.put(key, value)
+        return value
+
+
+class TweetCache:
+    """
+    Hydrated tweets by tweet id, in a local sqlite database kept across runs.
+
+    Tweets are fresh for ttl seconds. Ids twitter reported missing are kept for missing_ttl seconds so they
+    are not looked up (and retried) again. close() drops stale entries and the oldest ones above max_entries.
+    When a bucket is given the database is restored from s3://{bucket}/{key} if there is no local one, and
+    uploaded there by close(); pods that run at the same time overwrite each other's snapshot. Safe to
+    share between threads.
+    """
+
+    def __init__(
+            self, path: str, ttl: int, missing_ttl: int, max_entries: int, bucket: str = None,
+            key: str = "cache/talkwalker/tweets.sqlite"
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.missing_ttl = missing_ttl
+        self.max_entries = max_entries
+        self.bucket = bucket
+        self.key = key
+        self.hits = 0
+        self.missing_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        if bucket and not os.path.exists(path):
+            self._restore()
+
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        # tweet is NULL for the ids twitter reported missing
+        self._db.execute("CREATE TABLE IF NOT EXISTS tweets (id TEXT PRIMARY KEY, stored_at REAL, tweet TEXT)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS tweets_stored_at ON tweets (stored_at)")
+        self._db.commit()
+
+    def _restore(self) -> None:
+        import boto3
+
+        try:
+            boto3.client("s3").download_file(self.bucket, self.key, self.path)
+            logger.info(f"tweet cache - restored {self.path} from s3://{self.bucket}/{self.key}")
+        except Exception as e:
+            logger.info(f"tweet cache - no snapshot in bucket {self.bucket}, starting empty: {e}")
+
+    def lookup(self, ids: list):
+        """
+        :return: ({id: tweet} of the fresh tweets, set of the ids known to be missing, list of the other ids)
+        """
+
+        now = time.time()
+        found, missing = {}, set()
+        with self._lock:
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                rows = self._db.execute(
+                    f"SELECT id, stored_at, tweet FROM tweets WHERE id IN ({','.join('?' * len(chunk))})", chunk
+                )
+                for tweet_id, stored_at, tweet in rows:
+                    if tweet is None:
+                        if now - stored_at < self.missing_ttl:
+                            missing.add(tweet_id)
+                    elif now - stored_at < self.ttl:
+                        found[tweet_id] = json.loads(tweet)
+
+            misses = [
+                tweet_id for tweet_id in dict.fromkeys(ids) if tweet_id not in found and tweet_id not in missing
+            ]
+            self.hits += len(found)
+            self.missing_hits += len(missing)
+            self.misses += len(misses)
+        return found, missing, misses
+
+    def store(self, tweets: list, missing_ids: list = ()) -> None:
+        """Cache the tweets of a lookup, and the ids it reported missing"""
+
+        now = time.time()
+        rows = [(str(tweet["id"]), now, json.dumps(tweet)) for tweet in tweets]
+        rows += [(str(tweet_id), now, None) for tweet_id in missing_ids]
+        if not rows:
+            return
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO tweets (id, stored_at, tweet) VALUES (?, ?, ?)", rows)
+            self._db.commit()
+
+    def prune(self) -> int:
+        """Drop the stale entries, then the oldest ones above max_entries, returns the number dropped"""
+
+        now = time.time()
+        with self._lock:
+            dropped = self._db.execute(
+                "DELETE FROM tweets WHERE (tweet IS NOT NULL AND stored_at < ?) OR (tweet IS NULL AND stored_at < ?)",
+                (now - self.ttl, now - self.missing_ttl),
+            ).rowcount
+            (count,) = self._db.execute("SELECT COUNT(*) FROM tweets").fetchone()
+            if count > self.max_entries:
+                dropped += self._db.execute(
+                    "DELETE FROM tweets WHERE id IN (SELECT id FROM tweets ORDER BY stored_at LIMIT ?)",
+                    (count - self.max_entries,),
+                ).rowcount
+            self._db.commit()
+        return dropped
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "missing_hits": self.missing_hits, "misses": self.misses}
+
+    def close(self) -> None:
+        dropped = self.prune()
+        with self._lock:
+            # closing the last connection checkpoints the write ahead log into the database file
+            self._db.close()
+        logger.info(f"tweet cache - {self.stats()}, {dropped} entries dropped")
+
+        if self.bucket:
+            import boto3
+
+            try:
+                boto3.client("s3").upload_file(self.path, self.bucket, self.key)
+            except Exception as e:
+                logger.warning(f"tweet cache - could not store the snapshot in bucket {self.bucket}: {e}")
@@ -0,0 +1,556 @@
+"""
+Compact, slotted representation of TalkwalkerRecord for the ingest hot path.
+
+Pending windows and tweet batches used to be held as large nested dicts and every item was turned into a
+tree of pydantic models just to be serialized. The classes below cover the same schema as record.py with
+__slots__ instead of per-object dicts, share their defaults, and encode themselves to the exact JSON that
+TalkwalkerRecord.model_dump_json() produces.
+
+Only the plain JSON values the API returns are validated natively. Anything else (e.g. numbers sent as
+strings with signs or underscores, booleans in number fields) is handed to the pydantic models, so
+validation rules and errors stay exactly those of record.py.
+"""
+import json
+import math
+import operator
+import sys
+from json.encoder import encode_basestring
+
+_MISSING = object()
+_REQUIRED = object()
+
+# share repeated strings and sub-records between buffered records, see _Interned and _Shared. Turned off only
+# to measure what it saves (benchmarks/bench_{{ package_name }}_memory.py)
+INTERNING = True
+
+
+class _Fallback(Exception):
+    """The fast path does not handle a value, pydantic decides"""
+
+
+# --- scalar kinds: coerce() normalizes a decoded json value, encode() appends its json to out
+
+
+class _Str:
+    @staticmethod
+    def coerce(value):
+        if type(value) is str:
+            return value
+        raise _Fallback
+
+    @staticmethod
+    def encode(value, out):
+        out.append(encode_basestring(value))
+
+
+class _Interned(_Str):
+    """Low cardinality strings (languages, source types, domains...), a single object per distinct value"""
+
+    @staticmethod
+    def coerce(value):
+        if type(value) is str:
+            return sys.intern(value) if INTERNING else value
+        raise _Fallback
+
+
+class _Int:
+    @staticmethod
+    def coerce(value):
+        kind = type(value)
+        if kind is int:
+            return value
+        # ids come as strings of digits, e.g. external_id
+        if kind is str and value.isascii() and value.isdigit():
+            return int(value)
+        raise _Fallback
+
+    @staticmethod
+    def encode(value, out):
+        out.append(str(value))
+
+
+class _Float:
+    @staticmethod
+    def coerce(value):
+        kind = type(value)
+        if kind is float:
+            return value
+        if kind is int:
+            try:
+                return float(value)
+            except OverflowError:
+                raise _Fallback
+        raise _Fallback
+
+    @staticmethod
+    def encode(value, out):
+        out.append(_float_json(value))
+
+
+def _float_json(value: float) -> str:
+    if not math.isfinite(value):
+        return "null"
+    text = repr(value)
+    # python and pydantic agree on positional notation, not on exponents (1e-07 vs 1e-7, 1e-05 vs 0.00001)
+    return text if "e" not in text else _core_json(value)
+
+
+def _core_json(value) -> str:
+    import pydantic_core
+
+    return pydantic_core.to_json(value).decode()
+
+
+class _Bool:
+    @staticmethod
+    def coerce(value):
+        if type(value) is bool:
+            return value
+        raise _Fallback
+
+    @staticmethod
+    def encode(value, out):
+        out.append("true" if value else "false")
+
+
+class _Dict:
+    @staticmethod
+    def coerce(value):
+        if type(value) is dict:
+            return value
+        raise _Fallback
+
+    @staticmethod
+    def encode(value, out):
+        if _plain(value):
+            out.append(json.dumps(value, ensure_ascii=False, separators=(",", ":")))
+        else:
+            out.append(_core_json(_finite(value)))
+
+
+def _plain(value) -> bool:
+    """True if json.dumps writes value exactly like pydantic does"""
+    kind = type(value)
+    if kind is dict:
+        return all(type(key) is str and _plain(item) for key, item in value.items())
+    if kind is list:
+        return all(_plain(item) for item in value)
+    if kind is float:
+        return math.isfinite(value) and "e" not in repr(value)
+    return value is None or kind is str or kind is int or kind is bool
+
+
+def _finite(value):
+    """pydantic writes NaN and infinities as null"""
+    kind = type(value)
+    if kind is dict:
+        return {key: _finite(item) for key, item in value.items()}
+    if kind is list:
+        return [_finite(item) for item in value]
+    if kind is float and not math.isfinite(value):
+        return None
+    return value
+
+
+class _List:
+    def __init__(self, item):
+        self.item = item
+
+    def coerce(self, value):
+        if type(value) is not list and type(value) is not tuple:
+            raise _Fallback
+        coerce = self.item.coerce
+        return tuple(coerce(item) for item in value)
+
+    def encode(self, value, out):
+        out.append("[")
+        for i, item in enumerate(value):
+            if i:
+                out.append(",")
+            self.item.encode(item, out)
+        out.append("]")
+
+
+class _Model:
+    def __init__(self, cls):
+        self.cls = cls
+
+    def coerce(self, value):
+        if type(value) is dict:
+            return self.cls._from_dict(value)
+        raise _Fallback
+
+    @staticmethod
+    def encode(value, out):
+        value._encode(out)
+
+
+class _Shared:
+    """
+    Values of kind that repeat across records (e.g. the source_type tuple or the world_data of a source) are
+    shared: an equal value coerced earlier is returned instead of the new one. Records are never mutated in
+    place, so sharing is safe. Sub-records are compared by their fields, which are shared (or scalars) first.
+    Decoded values seen before are looked up before they are coerced, so repeats are not even built.
+    At most maxsize distinct values are remembered, the tables start over when they are full.
+    """
+
+    def __init__(self, kind, maxsize: int = 4096):
+        self.kind = kind
+        self.maxsize = maxsize
+        self._values = {}  # share key -> shared value
+        self._decoded = {}  # decoded value as a tuple -> shared value
+
+    def coerce(self, value):
+        if not INTERNING:
+            return self.kind.coerce(value)
+
+        decoded = _decoded_key(value)
+        if decoded is not None:
+            try:
+                shared = self._decoded.get(decoded)
+            except TypeError:
+                # unhashable, e.g. a nested dict
+                decoded = None
+            else:
+                if shared is not None:
+                    return shared
+
+        value = self.kind.coerce(value)
+        try:
+            key = _share_key(value)
+            shared = self._values.get(key)
+        except TypeError:
+            return value
+        if shared is None:
+            if len(self._values) >= self.maxsize:
+                self._values.clear()
+            shared = self._values[key] = value
+        if decoded is not None:
+            if len(self._decoded) >= self.maxsize:
+                self._decoded.clear()
+            self._decoded[decoded] = shared
+        return shared
+
+    def encode(self, value, out):
+        self.kind.encode(value, out)
+
+
+def _decoded_key(value):
+    """
+    Hashable form of a decoded list or dict, None when it has a zero: 0.0 == -0.0 (== 0 == False) but they are
+    written differently. Only values that were coerced are stored, any other equal value coerces the same.
+    """
+    kind = type(value)
+    if kind is list:
+        return None if 0.0 in value else tuple(value)
+    if kind is dict:
+        return None if 0.0 in value.values() else tuple(value.items())
+    return None
+
+
+_field_getters = {}  # record class -> attrgetter of all its fields
+
+
+def _share_key(value):
+    if not isinstance(value, _Compact):
+        return value
+    cls = type(value)
+    getter = _field_getters.get(cls)
+    if getter is None:
+        getter = _field_getters[cls] = operator.attrgetter(*cls.__slots__)
+    fields = getter(value)
+    if 0.0 in fields:
+        # 0.0 == -0.0 (and == 0, == False) but they are written differently
+        fields = tuple((item, type(item), math.copysign(1.0, item)) if item == 0.0 else item for item in fields)
+    return cls, fields
+
+
+class _Compact:
+    """Base of the slotted records, _spec lists (name, kind, nullable, default) in record.py order"""
+
+    __slots__ = ()
+    _spec = ()
+
+    @classmethod
+    def _from_dict(cls, data: dict):
+        obj = cls.__new__(cls)
+        for name, kind, nullable, default in cls._spec:
+            value = data.get(name, _MISSING)
+            if value is _MISSING:
+                if default is _REQUIRED:
+                    raise _Fallback
+                value = default
+            elif value is None:
+                if not nullable:
+                    raise _Fallback
+            else:
+                value = kind.coerce(value)
+            setattr(obj, name, value)
+        return obj
+
+    def _encode(self, out) -> None:
+        out.append("{")
+        for i, (name, kind, _, _) in enumerate(self._spec):
+            out.append(',"' if i else '"')
+            out.append(name)
+            out.append('":')
+            value = getattr(self, name)
+            if value is None:
+                out.append("null")
+            else:
+                kind.encode(value, out)
+        out.append("}")
+
+    def to_json(self) -> str:
+        out = []
+        self._encode(out)
+        return "".join(out)
+
+    def to_dict(self) -> dict:
+        """Plain dict of the record, equivalent to TalkwalkerRecord.model_dump()"""
+        return {name: _to_python(getattr(self, name)) for name, _, _, _ in self._spec}
+
+
+def _to_python(value):
+    if isinstance(value, _Compact):
+        return value.to_dict()
+    if type(value) is tuple:
+        return [_to_python(item) for item in value]
+    return value
+
+
+def _define(name: str, spec: list, base=None) -> type:
+    """Build a slotted record class from (field, kind, nullable, default) tuples"""
+    return type(
+        name, (base or _Compact,), {"__slots__": tuple(field for field, _, _, _ in spec), "_spec": tuple(spec)}
+    )
+
+
+STR, INT, FLOAT, BOOL, DICT = _Str(), _Int(), _Float(), _Bool(), _Dict()
+INTERNED = _Interned()
+EMPTY = ()  # shared default of every list field, records are never mutated in place
+
+CompactImage = _define("CompactImage", [
+    ("url", STR, True, None),
+])
+
+CompactWorldData = _define("CompactWorldData", [
+    ("continent", INTERNED, True, None),
+    ("country", INTERNED, True, None),
+    ("region", INTERNED, True, None),
+    ("city", INTERNED, True, None),
+    ("longitude", FLOAT, True, None),
+    ("latitude", FLOAT, True, None),
+    ("country_code", INTERNED, True, None),
+    ("resolution", INTERNED, True, None),
+])
+_EMPTY_WORLD_DATA = CompactWorldData._from_dict({})
+
+CompactExtraAuthorAttributes = _define("CompactExtraAuthorAttributes", [
+    ("world_data", _Shared(_Model(CompactWorldData)), True, _EMPTY_WORLD_DATA),
+    ("id", STR, True, None),
+    ("name", STR, True, None),
+    ("gender", INTERNED, True, "UNKNOWN"),
+    ("image_url", STR, True, None),
+    ("short_name", STR, True, None),
+    ("url", STR, True, None),
+])
+
+CompactExtraSourceAttributes = _define("CompactExtraSourceAttributes", [
+    ("world_data", _Shared(_Model(CompactWorldData)), True, _EMPTY_WORLD_DATA),
+    ("id", STR, True, None),
+    ("name", STR, True, None),
+])
+
+CompactArticleExtendedAttributes = _define("CompactArticleExtendedAttributes", [
+    ("youtube_views", INT, True, None),
+    ("youtube_likes", INT, True, None),
+    ("num_comments", INT, True, None),
+    ("tiktok_views", INT, True, None),
+    ("tiktok_likes", INT, True, None),
+    ("tiktok_shares", INT, True, None),
+    ("twitter_shares", INT, True, None),
+])
+
+CompactNewsArticleAttributes = _define("CompactNewsArticleAttributes", [
+    ("url", STR, True, None),
+    ("source", STR, True, None),
+    ("snippet", BOOL, False, False),
+    ("published_date", STR, True, None),
+    ("media", STR, True, None),
+    ("title", STR, True, None),
+    ("authors", STR, True, None),
+    ("text", STR, True, None),
+    ("summary", STR, True, None),
+])
+
+CompactReferencedTweet = _define("CompactReferencedTweet", [
+    ("type", INTERNED, False, _REQUIRED),
+    ("id", STR, False, _REQUIRED),
+])
+
+CompactAttachments = _define("CompactAttachments", [
+    ("media_keys", _List(STR), False, _REQUIRED),
+])
+
+CompactPublicMetrics = _define("CompactPublicMetrics", [
+    ("retweet_count", INT, True, None),
+    ("reply_count", INT, True, None),
+    ("like_count", INT, True, None),
+    ("quote_count", INT, True, None),
+    ("bookmark_count", INT, True, None),
+    ("impression_count", INT, True, None),
+])
+
+CompactContextAnnotation = _define("CompactContextAnnotation", [
+    ("domain", DICT, True, {}),
+    ("entity", DICT, True, {}),
+])
+
+CompactAuthor = _define("CompactAuthor", [
+    ("username", STR, True, None),
+    ("location", STR, True, None),
+    ("id", STR, True, None),
+    ("description", STR, True, None),
+    ("verified", BOOL, True, False),
+    ("name", STR, True, None),
+])
+
+CompactTwitterData = _define("CompactTwitterData", [
+    ("id", STR, True, None),
+    ("conversation_id", INT, True, None),
+    ("referenced_tweets", _List(_Model(CompactReferencedTweet)), False, EMPTY),
+    ("lang", INTERNED, True, None),
+    ("author_id", STR, True, None),
+    ("created_at", STR, True, None),
+    ("attachments", _Model(CompactAttachments), True, None),
+    ("edit_history_tweet_ids", _List(STR), False, EMPTY),
+    ("public_metrics", _Model(CompactPublicMetrics), True, None),
+    ("text", STR, True, None),
+    ("context_annotations", _List(_Model(CompactContextAnnotation)), False, EMPTY),
+    ("in_reply_to_user_id", STR, True, None),
+    ("author", _Model(CompactAuthor), True, None),
+])
+
+_RECORD_SPEC = [
+    ("url", STR, True, None),
+    ("matched_profile", _Shared(_List(INTERNED)), False, EMPTY),
+    ("indexed", INT, True, None),
+    ("search_indexed", INT, True, None),
+    ("published", INT, True, None),
+    ("title", STR, True, None),
+    ("content", STR, True, None),
+    ("title_snippet", STR, True, None),
+    ("content_snippet", STR, True, None),
+    ("root_url", INTERNED, True, None),
+    ("domain_url", INTERNED, True, None),
+    ("host_url", STR, True, None),
+    ("parent_url", STR, True, None),
+    ("lang", INTERNED, True, None),
+    ("porn_level", INT, True, None),
+    ("fluency_level", INT, True, None),
+    ("DEPRECATED_spam_level", INT, True, None),
+    ("sentiment", INT, True, None),
+    ("source_type", _Shared(_List(INTERNED)), False, EMPTY),
+    ("post_type", _Shared(_List(INTERNED)), False, EMPTY),
+    ("noise_level", INT, True, None),
+    ("noise_category", INTERNED, True, None),
+    ("tokens_title", _List(STR), False, EMPTY),
+    ("tokens_content", _List(STR), False, EMPTY),
+    ("tokens_mention", _List(STR), False, EMPTY),
+    ("images", _List(_Model(CompactImage)), False, EMPTY),
+    ("tags_internal", _Shared(_List(INTERNED)), False, EMPTY),
+    ("tags_customer", _Shared(_List(INTERNED)), False, EMPTY),
+    ("article_extended_attributes", _Model(CompactArticleExtendedAttributes), True, None),
+    ("source_extended_attributes", _Shared(_Model(CompactExtraSourceAttributes)), True, None),
+    ("extra_author_attributes", _Model(CompactExtraAuthorAttributes), True, None),
+    ("user_response_time", INT, True, None),
+    ("engagement", INT, True, None),
+    ("reach", INT, True, None),
+    ("entity_url", _List(_Model(CompactImage)), False, EMPTY),
+    ("word_count", INT, False, 0),
+    ("external_provider", INTERNED, True, None),
+    ("external_id", INT, True, None),
+    ("external_author_id", INT, True, None),
+    ("source", INTERNED, True, None),
+    ("news_article_attributes", _Model(CompactNewsArticleAttributes), True, None),
+    ("external_provider_attributes", _Model(CompactTwitterData), True, None),
+]
+
+RECORD_FIELDS = frozenset(name for name, _, _, _ in _RECORD_SPEC)
+
+
+class _RecordBase(_Compact):
+    """Slotted TalkwalkerRecord, build it with from_dict() and serialize it with to_json()"""
+
+    __slots__ = ()
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        """
+        Validate a formatted talkwalker item (extra keys are ignored, like pydantic does).
+        :raises pydantic.ValidationError: when TalkwalkerRecord would reject the item
+        """
+        try:
+            return cls._from_dict(data)
+        except _Fallback:
+            from .record import TalkwalkerRecord
+
+            # model_dump() only holds values the fast path handles
+            return cls._from_dict(TalkwalkerRecord.model_validate(data).model_dump())
+
+
+CompactRecord = _define("CompactRecord", _RECORD_SPEC, _RecordBase)
+
+_projected_classes = {}
+
+
+def projected_record_class(projection) -> type:
+    """
+    CompactRecord without the fields dropped by a FieldProjection, the output records leave them out.
+    :raises ValueError: when the projection names fields that are not part of the record
+    """
+    if not projection:
+        return CompactRecord
+
+    key = str(projection)
+    if key not in _projected_classes:
+        _projected_classes[key] = _project(CompactRecord, projection, _RecordBase)
+    return _projected_classes[key]
+
+
+def _project(cls, projection, base=_Compact) -> type:
+    fields = {name for name, _, _, _ in cls._spec}
+    unknown = (projection.dropped | set(projection.nested)) - fields
+    if unknown:
+        raise ValueError(f"unknown fields in the field projection: {sorted(unknown)}")
+
+    spec = []
+    for name, kind, nullable, default in cls._spec:
+        if name in projection.dropped:
+            continue
+        child = projection.child(name)
+        if child:
+            kind, default = _project_kind(name, kind, default, child)
+        spec.append((name, kind, nullable, default))
+    return _define(cls.__name__, spec, base)
+
+
+def _project_kind(name, kind, default, projection):
+    if isinstance(kind, _Shared):
+        kind, default = _project_kind(name, kind.kind, default, projection)
+        return _Shared(kind), default
+    if isinstance(kind, _List) and isinstance(kind.item, _Model):
+        return _List(_Model(_project(kind.item.cls, projection))), default
+    if isinstance(kind, _Model):
+        cls = _project(kind.cls, projection)
+        # e.g. the default world_data, an empty record
+        return _Model(cls), cls._from_dict({}) if isinstance(default, _Compact) else default
+    raise ValueError(f"the field projection can only drop sub fields of records, {name} has none")
+
+
+def encode_record(item, record_class=CompactRecord) -> str:
+    """JSON line of a compact record or a formatted item dict, identical to TalkwalkerRecord's"""
+    if not isinstance(item, _RecordBase):
+        item = record_class.from_dict(item)
+    return item.to_json()
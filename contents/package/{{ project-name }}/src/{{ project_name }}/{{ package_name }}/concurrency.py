@@ -0,0 +1,209 @@
+import asyncio
+import logging
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Raised by a non blocking acquire while the circuit of the upstream is open"""
+
+
+class AdaptiveLimiter:
+    """
+    AIMD concurrency limit with a circuit breaker for one upstream host.
+
+    The limit grows by about one request per round of limit successful requests that answer within
+    latency_target, and is multiplied by decrease on 429s, timeouts and slow answers. After failure_threshold
+    consecutive failures the circuit opens: callers are paused for open_seconds instead of retrying into a
+    failing upstream, then a single probe request decides whether it closes again. Safe to share between
+    threads.
+    """
+
+    def __init__(
+            self, host: str, initial: int = 2, minimum: int = 1, maximum: int = 16, latency_target: float = 2.0,
+            decrease: float = 0.5, failure_threshold: int = 5, open_seconds: float = 30.0
+    ):
+        self.host = host
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_target = latency_target
+        self.decrease = decrease
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.in_flight = 0
+        self.failures = 0  # consecutive
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.requests = 0
+        self.throttled = 0
+        self._condition = threading.Condition()
+
+    def _admit(self) -> bool:
+        if self.state == OPEN:
+            if time.monotonic() - self.opened_at < self.open_seconds:
+                return False
+            self.state = HALF_OPEN
+            logger.info(f"upstream {self.host} - circuit half open, probing")
+            return self.in_flight == 0
+        if self.state == HALF_OPEN:
+            # one probe at a time until the upstream has answered
+            return self.in_flight == 0
+        return self.in_flight < int(self.limit)
+
+    def acquire(self, block: bool = True) -> None:
+        """
+        Wait for a request slot
+        :param block: False to raise CircuitOpenError instead of waiting while the circuit is open
+        """
+        with self._condition:
+            while not self._admit():
+                if not block and self.state != CLOSED:
+                    raise CircuitOpenError(f"upstream {self.host} is paused after {self.failures} failures")
+                self._condition.wait(timeout=1.0)
+            self.in_flight += 1
+            self.requests += 1
+
+    async def acquire_async(self) -> None:
+        """acquire() for coroutines, polls for a slot instead of blocking the event loop"""
+        while True:
+            with self._condition:
+                if self._admit():
+                    self.in_flight += 1
+                    self.requests += 1
+                    return
+            await asyncio.sleep(0.05)
+
+    def release(self, latency: float, outcome: str) -> None:
+        """
+        Free the request slot and adapt the limit
+        :param outcome: "ok", "throttled" (429), "timeout" or "error" (connection errors, 5xx)
+        """
+        with self._condition:
+            self.in_flight -= 1
+
+            if outcome == "ok":
+                self.failures = 0
+                if self.state != CLOSED:
+                    self.state = CLOSED
+                    logger.info(f"upstream {self.host} - circuit closed")
+                if latency <= self.latency_target:
+                    self.limit = min(self.maximum, self.limit + 1 / self.limit)
+                else:
+                    self.limit = max(self.minimum, self.limit * self.decrease)
+            else:
+                self.failures += 1
+                if outcome in ("throttled", "timeout"):
+                    self.throttled += 1
+                    self.limit = max(self.minimum, self.limit * self.decrease)
+                if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                    if self.state != OPEN:
+                        logger.warning(
+                            f"upstream {self.host} - circuit open for {self.open_seconds}s after {self.failures} "
+                            f"failures, last outcome {outcome}"
+                        )
+                    self.state = OPEN
+                    self.opened_at = time.monotonic()
+
+            self._condition.notify_all()
+
+    @contextmanager
+    def track(self, block: bool = True):
+        """
+        Acquire a slot for the duration of a request. The outcome is "ok" unless the block sets call.outcome
+        or raises, in which case it is classified from the exception.
+        """
+        self.acquire(block)
+        call = _Call()
+        start = time.monotonic()
+        try:
+            yield call
+        except Exception as e:
+            if call.outcome == "ok":
+                call.outcome = classify(error=e)
+            raise
+        finally:
+            self.release(time.monotonic() - start, call.outcome)
+
+    @asynccontextmanager
+    async def track_async(self):
+        """track() for coroutines, waits for a slot with acquire_async()"""
+        await self.acquire_async()
+        call = _Call()
+        start = time.monotonic()
+        try:
+            yield call
+        except Exception as e:
+            if call.outcome == "ok":
+                call.outcome = classify(error=e)
+            raise
+        finally:
+            self.release(time.monotonic() - start, call.outcome)
+
+    def snapshot(self) -> dict:
+        with self._condition:
+            return {
+                "limit": round(self.limit, 2),
+                "in_flight": self.in_flight,
+                "state": self.state,
+                "failures": self.failures,
+                "requests": self.requests,
+                "throttled": self.throttled,
+            }
+
+
+class _Call:
+    __slots__ = ("outcome",)
+
+    def __init__(self):
+        self.outcome = "ok"
+
+
+class UpstreamLimiters:
+    """AdaptiveLimiter of every upstream host, created on first use with the same settings"""
+
+    def __init__(self, **settings):
+        self.settings = settings
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def for_host(self, host: str) -> AdaptiveLimiter:
+        with self._lock:
+            limiter = self._limiters.get(host)
+            if limiter is None:
+                limiter = self._limiters[host] = AdaptiveLimiter(host, **self.settings)
+            return limiter
+
+    def for_url(self, url: str) -> AdaptiveLimiter:
+        return self.for_host(urlsplit(url).hostname or "")
+
+    def snapshot(self) -> dict:
+        """Current limit and circuit state of every host, for the status logs"""
+        with self._lock:
+            limiters = list(self._limiters.values())
+        return {limiter.host: limiter.snapshot() for limiter in limiters}
+
+
+def classify(status_code: int = None, error: Exception = None) -> str:
+    """Outcome of a request for AdaptiveLimiter.release, from its status code or exception"""
+    if error is not None:
+        text = f"{type(error).__name__} {error}".casefold()
+        if "429" in text or "too many requests" in text:
+            return "throttled"
+        if "timeout" in text or "timed out" in text:
+            return "timeout"
+        return "error"
+    if status_code == 429:
+        return "throttled"
+    if status_code is not None and status_code >= 500:
+        return "error"
+    return "ok"
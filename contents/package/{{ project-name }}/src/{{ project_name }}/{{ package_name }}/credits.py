@@ -1,18 +1,19 @@
 import json
 import requests
 import os
+import threading
 import time
 import requests
 from requests.exceptions import RequestException
 
 
-def make_request(endpoint, params=None):
+def make_request(endpoint, params=None, session=None):
     base_url = "https://api.talkwalker.com/api/v1"
     headers = {
         "accept": "application/json",
     }
     try:
-        response = requests.get(
+        response = (session or requests).get(
             f"{base_url}/{endpoint}",
             params=params,
             headers=headers,
@@ -27,10 +28,10 @@ def make_request(endpoint, params=None):
         return None
 
 
-def retry_request(endpoint, params=None, max_retries=3):
+def retry_request(endpoint, params=None, max_retries=3, session=None):
     retries = 0
     while retries < max_retries:
-        response = make_request(endpoint, params)
+        response = make_request(endpoint, params, session)
         if response:
             return response
         retries += 1
@@ -142,32 +143,61 @@ def search_account_id(response, target_account_id):
 #     return credits_status
 
 
-def is_valid_project_id(api_token, project_id):
+def is_valid_project_id(api_token, project_id, session=None):
     # API 2: Get search results
     search_results_endpoint = f"search/info"
     search_results_params = {
         "access_token": api_token,
     }
-    response = retry_request(search_results_endpoint, search_results_params)
+    response = retry_request(search_results_endpoint, search_results_params, session=session)
 
     return search_account_id(response, project_id)
 
 
-def get_credits_estimation(api_token, topic_id, project_id):
+def get_available_credits(api_token, session=None):
     # API 1: Get status credits
     status_credits_endpoint = "status/credits"
     status_credits_params = {"access_token": api_token}
     status_credits_response = retry_request(
-        status_credits_endpoint, status_credits_params
+        status_credits_endpoint, status_credits_params, session=session
     )
 
-    credits_status = {}
     if status_credits_response:
-        credits_status["available_credits"] = (
+        return (
             status_credits_response["result_creditinfo"]["remaining_credits_monthly"]
             or 0
         )
+    return None
+
+
+class CreditBudget:
+    """
+    Monthly credits left to the topics of an invocation. Every topic reserves the credits it requires before it
+    is pulled, so the concurrent chunks of a backfill do not count the same credits twice. Safe to share
+    between threads.
+    """
+
+    def __init__(self):
+        self._available = None
+        self._lock = threading.Lock()
+
+    def available(self, load):
+        """Credits left, load() fetches the remaining monthly credits the first time they are known"""
+        with self._lock:
+            if self._available is None:
+                self._available = load()
+            return self._available
+
+    def reserve(self, credits: int) -> bool:
+        """Take credits off the budget, False when what is left does not cover them"""
+        with self._lock:
+            if self._available is None or not 0 < credits <= self._available:
+                return False
+            self._available -= credits
+            return True
+
 
+def get_required_credits(api_token, topic_id, project_id, session=None):
     # API 2: Get search results
     search_results_endpoint = f"search/p/{project_id}/results"
     search_results_params = {
@@ -181,25 +211,11 @@ def get_credits_estimation(api_token, topic_id, project_id):
         "access_token": api_token,
     }
     search_results_response = retry_request(
-        search_results_endpoint, search_results_params
+        search_results_endpoint, search_results_params, session=session
     )
 
     if search_results_response:
         if search_results_response.get("result_error"):
-            credits_status["required_credits"] = -1
-        else:
-            credits_status["required_credits"] = (
-                search_results_response["pagination"]["total"] or 0
-            )
-
-    credits_status["enough_credits_available"] = (
-        credits_status["available_credits"] - credits_status["required_credits"]
-    ) > 0
-
-    # special case: if the required_credits is -1, it means the topic_id is invaid
-
-    credits_status["enough_credits_available"] = (
-        False if credits_status["required_credits"] <= 0 else True
-    )
-
-    return credits_status
\ No newline at end of file
+            return -1
+        return search_results_response["pagination"]["total"] or 0
+    return None
@@ -1,20 +1,35 @@
 import os
 import logging
+import itertools
 import json
+import threading
 import time
 import traceback
 import requests
-from datetime import datetime
-from .credits import get_credits_estimation
-from .record import TalkwalkerRecord
+from concurrent.futures import ThreadPoolExecutor
+from .async_source import AsyncTalkwalkerSource
+from .cache import MetadataCache, TweetCache
+from .compact import encode_record, projected_record_class
+from .concurrency import UpstreamLimiters
+from .credits import CreditBudget, get_available_credits, get_required_credits
+from .manifest import ETagDigest, PartitionStats, UploadStats, build_manifest
+from .pagesize import PageSizer
+from .pipeline import Pipeline, RecentKeys, Stage, parse_concurrency
+from .plan import build_plan
+from .preflight import PreflightError, run_preflight
+from .projection import FieldProjection
+from .ratelimit import RateLimiter
+from .replay import ArchiveSession, ResponseArchive, request_key
+from .reprocess import RawPageArchive, reprocess_archive
+from .schedule import DeadlineScheduler, order_windows, parse_offsets, parse_windows
 from .source import TalkwalkerSource
-from twitter_{{ org_name }}_{{ solution_name }}.twitter.source import TwitterSource
-from driver_library_{{ org_name }}_{{ solution_name }}.driver_library.utils.s3.s3_object_store import S3
-from driver_library_{{ org_name }}_{{ solution_name }}.driver_library.utils.md5.MD5Generator import MD5Source
+from .transform import merge_tweet
+
+# NOTE: the twitter and driver_library packages are imported where they are used, so that importing the
+# driver (e.g. for a dry run or a failed preflight) stays cheap.
 
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(level=logging.INFO)
 
 
 class Constants:
@@ -27,6 +42,15 @@ class Constants:
     S3_KEY_TEMPLATE_PREFIX = "raw/{}"  # raw/{application} : for downstream drivers with their own names
     S3_KEY_TEMPLATE_POSTFIX = "/{}/{}_{}/file_{}.jsonl"  # /{hash_id}/{from_date}_{to_date}/file_{int}.jsonl
     XCOM_KEY_TEMPLATE_POSTFIX = "/{}/{}_{}/xcom_{}.json"  # /{hash_id}/{from_date}_{to_date}/xcom_{hash_id}.json
+    # xcom of one shard of a sharded pull, finalize() combines them into the xcom of the pull
+    # /{hash_id}/{from_date}_{to_date}/shards/xcom_{hash_id}_{shard_index}.json
+    SHARD_XCOM_KEY_TEMPLATE_POSTFIX = "/{}/{}_{}/shards/xcom_{}_{}.json"
+    PAGES_KEY_TEMPLATE_POSTFIX = "/{}/{}_{}/pages_{}.jsonl.gz"  # /{hash_id}/{from_date}_{to_date}/pages_{int}.jsonl.gz
+    # per partition counts, sizes, published ranges and checksums, next to the xcom
+    # /{hash_id}/{from_date}_{to_date}/manifest_{hash_id}.json
+    MANIFEST_KEY_TEMPLATE_POSTFIX = "/{}/{}_{}/manifest_{}.json"
+    TWITTER_HOST = "api.twitter.com"
+    PIPELINE_STAGES = ["fetch", "format", "dedupe", "hydrate", "serialize"]
 
 
 class Driver:
@@ -42,6 +66,29 @@ class Driver:
         self.output_bucket = None
         self.application_name = f'{Constants.APPLICATION_NAME} v.{Constants.VERSION} '
         self.params: dict = {}
+        self.s3 = None  # boto3 client of the upload checks
+        self.upload_stats = UploadStats()
+
+        # shared by all the topics pulled in one invocation
+        self.session = None
+        self.rate_limiter = None
+        self.upstreams = None
+        self.page_sizer = None
+        self.archive = None  # ResponseArchive of the record and replay modes
+        self.page_archive = None  # RawPageArchive of the current topic
+        self.shard_index = 0  # this pod fetches the windows i with i % shard_count == shard_index
+        self.shard_count = 1
+        self.deadline = None  # time.monotonic() the invocation must be done by, from tw_run_deadline_seconds
+        self.scheduler = None  # DeadlineScheduler of the current topic
+        self.partition_stats = None  # PartitionStats of the output of the current topic
+        self.twitter = None
+        self.projects = None  # project_id -> project_name
+        self.topics = {}  # project_id -> {topic_id: (topic_name, solution_name)}
+        self.credits = CreditBudget()  # shared with the forks of a backfill
+        self.metadata_cache = None
+        self.tweet_cache = None  # TweetCache of the hydrated tweets, shared by the runs of a pod
+        self.projection = None
+        self.record_class = None
         print(f'{self.application_name} initialized.')
 
     def initialize_buckets(self) -> None:
@@ -56,149 +103,866 @@ class Driver:
     def authenticate_s3(self):
         """Authenticate S3 credentials"""
 
-        obj_storage = S3()
-        if not obj_storage.authenticate():
+        if not self.connect_s3():
             self.logger.error(
                 "AWS Credentials are missing."
             )
             exit(1)
 
+    def connect_s3(self) -> bool:
+        """Authenticate S3 credentials, returns False instead of exiting when they are missing"""
+
+        from driver_library_{{ org_name }}_{{ solution_name }}.driver_library.utils.s3.s3_object_store import S3
+
+        obj_storage = S3()
+        if not obj_storage.authenticate():
+            return False
+
         self.object_storage = obj_storage
+        return True
+
+    def s3_client(self):
+        if self.s3 is None:
+            import boto3
+            self.s3 = boto3.client("s3")
+        return self.s3
 
-    def upload_file(self, file_path, bucket_name, key_name: str) -> bool:
-        """This method copies file from a local directory to the text bucket"""
+    def upload_part_size(self) -> int:
+        return int(self.params["tw_upload_part_size"])
+
+    def object_unchanged(self, bucket_name, key_name: str, digest: ETagDigest) -> bool:
+        """Whether the object at key_name already holds the bytes of digest, by its size and ETag"""
+
+        try:
+            head = self.s3_client().head_object(Bucket=bucket_name, Key=key_name)
+        except Exception as e:
+            # missing object, or no read access: upload
+            self.logger.info(f"{key_name} not checked in bucket {bucket_name}: {e}")
+            return False
+        return head.get("ContentLength") == digest.bytes and digest.matches(head.get("ETag"))
+
+    def upload_file(self, file_path, bucket_name, key_name: str, digest: ETagDigest = None) -> bool:
+        """
+        This method copies file from a local directory to the text bucket, unless the object there already has
+        the same content, e.g. when the same hash_id and date range are pulled again
+        :param digest: ETagDigest of the file computed while it was written, read from the file when not given
+        """
 
         self.logger.info(f"file path = {file_path}")
 
+        if self.params["tw_upload_skip_unchanged"].casefold() == "True".casefold():
+            if digest is None or digest.part_size != self.upload_part_size():
+                digest = ETagDigest.from_file(file_path, self.upload_part_size())
+            if self.object_unchanged(bucket_name, key_name, digest):
+                self.upload_stats.skipped(digest.bytes)
+                self.logger.info(f"File {file_path} is unchanged in bucket {bucket_name}, upload skipped.")
+                return True
+
         self.logger.info(f"{self.application_name} - Uploading file {file_path} to bucket {bucket_name}")
         if not self.object_storage.upload_file(file_path, bucket_name, key_name):
             self.logger.error(f"File {file_path} copy to bucket {bucket_name} failed.")
             return False
         else:
+            self.upload_stats.uploaded(os.path.getsize(file_path))
             self.logger.info(f"File {file_path} was copied to bucket {bucket_name}.")
             return True
 
+    def setup(self, params: dict) -> None:
+        """
+        Set up the buckets, http session and rate limiter shared by all topics. S3 is authenticated by the
+        preflight of the first topic, concurrently with the talkwalker lookups.
+        """
+
+        self.params = params
+
+        self.logger.info(f"{self.application_name} Validating access to s3 buckets.")
+        self.initialize_buckets()
+        self.logger.info(f"{self.application_name} Access to s3 buckets complete.")
+
+        self.logger.info(f"Output Bucket = {self.output_bucket}")
+
+        self.shard_index = int(params.get("shard_index") or 0)
+        self.shard_count = int(params.get("shard_count") or 1)
+        if not 0 <= self.shard_index < self.shard_count:
+            self.logger.error(f"invalid shard {self.shard_index} of {self.shard_count}")
+            exit(1)
+        if self.shard_count > 1:
+            self.logger.info(f"sharded pull - shard {self.shard_index} of {self.shard_count}")
+
+        order_windows([], params["tw_window_order"])  # validates the order before anything is fetched
+        deadline_seconds = float(params["tw_run_deadline_seconds"])
+        if deadline_seconds > 0 and self.deadline is None:
+            # shared by all the topics of the invocation, they run one after the other
+            self.deadline = time.monotonic() + deadline_seconds
+            self.logger.info(
+                f"run deadline in {deadline_seconds}s, {params['tw_deadline_margin_seconds']}s kept for the upload"
+            )
+
+        if self.session is None:
+            mode = params["tw_replay_mode"].casefold()
+            if mode in ("record", "replay"):
+                self.archive = ResponseArchive(params["tw_replay_archive"], mode, params["tw_replay_timing"])
+                self.session = ArchiveSession(self.archive)
+                self.logger.info(f"{mode} mode - talkwalker and twitter responses archive = {self.archive.path}")
+            else:
+                self.session = requests.Session()
+        if self.rate_limiter is None:
+            self.rate_limiter = RateLimiter(0 if self.replaying_fast() else 0.1)
+        if self.upstreams is None:
+            self.upstreams = UpstreamLimiters(
+                maximum=int(params["tw_upstream_max_concurrency"]),
+                latency_target=float(params["tw_upstream_latency_target"]),
+                failure_threshold=int(params["tw_circuit_failures"]),
+                open_seconds=float(params["tw_circuit_open_seconds"]),
+            )
+        if self.page_sizer is None:
+            page_size = int(params["page_size"])
+            maximum = int(params["tw_page_size_max"])
+            if self.archive is not None:
+                # recorded requests are keyed by their hpp, it must not depend on the latencies
+                maximum = page_size
+            self.page_sizer = PageSizer(
+                page_size, maximum=max(maximum, page_size),
+                latency_cap=float(params["tw_page_latency_cap_seconds"]), bytes_cap=int(params["tw_page_bytes_cap"]),
+            )
+        if self.projection is None:
+            self.projection = FieldProjection.parse(params["tw_field_projection"])
+            # also validates the field names before anything is fetched
+            self.record_class = projected_record_class(self.projection)
+            self.logger.info(f"field projection = [{self.projection}]")
+        if self.metadata_cache is None:
+            self.metadata_cache = MetadataCache(
+                int(params["tw_metadata_cache_ttl"]),
+                params["tw_metadata_cache_dir"],
+                bucket=params["tw_metadata_cache_bucket"] or None,
+            )
+        if self.tweet_cache is None and params["tw_tweet_cache"].casefold() == "True".casefold():
+            if self.archive is not None:
+                # the recorded lookups only match when every run looks up the same ids
+                self.logger.info(f"tweet cache - not used in {self.archive.mode} mode")
+            else:
+                self.tweet_cache = TweetCache(
+                    params["tw_tweet_cache_path"],
+                    int(params["tw_tweet_cache_ttl"]),
+                    int(params["tw_tweet_cache_missing_ttl"]),
+                    int(params["tw_tweet_cache_max_entries"]),
+                    bucket=params["tw_tweet_cache_bucket"] or None,
+                )
+
+    def get_project_name(self, project_id):
+        """
+        Resolve the project name. The project list is read from the metadata cache and only fetched from
+        talkwalker, once per invocation, when the cached copy is missing, stale or lacks the project.
+        """
+
+        key = f"projects_{self.metadata_cache.token_key(self.talk_walker.access_token)}"
+
+        if self.projects is None:
+            self.projects = self.metadata_cache.get_or_load(key, self.talk_walker.get_projects)
+
+        if project_id not in self.projects:
+            # the project may have been created after the list was cached
+            self.projects = self.talk_walker.get_projects()
+            self.metadata_cache.put(key, self.projects)
+
+        return self.projects[project_id]
+
+    def get_topic_names(self, project_id, topic_id):
+        """Resolve (topic_name, solution_name) the same way get_project_name() resolves the project name"""
+
+        key = f"topics_{self.metadata_cache.token_key(self.talk_walker.access_token)}_{project_id}"
+
+        if project_id not in self.topics:
+            self.topics[project_id] = self.metadata_cache.get_or_load(
+                key, lambda: self.talk_walker.get_all_topic_ids(project_id)
+            )
+
+        if topic_id not in self.topics[project_id]:
+            self.topics[project_id] = self.talk_walker.get_all_topic_ids(project_id)
+            self.metadata_cache.put(key, self.topics[project_id])
+
+        return tuple(self.topics[project_id][topic_id])
+
+    def get_project_topic_names(self, project_id, topic_id):
+
+        # note:returns project_name, (topic_name, solution_name)
+
+        return self.get_project_name(project_id), self.get_topic_names(project_id, topic_id)
+
+    def get_available_credits(self):
+        """
+        Credits left to this invocation, the remaining monthly credits are fetched once per invocation and
+        served from the metadata cache
+        """
+
+        access_token = self.talk_walker.access_token
+        return self.credits.available(lambda: self.metadata_cache.get_or_load(
+            f"credits_{self.metadata_cache.token_key(access_token)}",
+            lambda: get_available_credits(access_token, self.session),
+            int(self.params["tw_credits_cache_ttl"]),
+        ))
+
+    def get_required_credits(self, topic_id, project_id):
+        """Number of items of the topic, served from the metadata cache"""
+
+        access_token = self.talk_walker.access_token
+        return self.metadata_cache.get_or_load(
+            f"required_{self.metadata_cache.token_key(access_token)}_{project_id}_{topic_id}",
+            lambda: get_required_credits(access_token, topic_id, project_id, self.session),
+            int(self.params["tw_credits_cache_ttl"]),
+        )
+
+    def get_twitter(self):
+        if self.twitter is None:
+            page_size = self.params["page_size"]
+            max_retries = int(self.params["max_retries"])
+            twitter_token = self.params["TWITTER_TOKEN"]
+
+            from twitter_{{ org_name }}_{{ solution_name }}.twitter.source import TwitterSource
+
+            self.twitter = TwitterSource(page_size, max_retries, twitter_token)
+        return self.twitter
+
     def transform_tweet_data(self, tweet_data, item):
         """Method to transform the talkwalker item, tweet data and return it as dict"""
-        created_at = tweet_data["created_at"].replace(" ", "").replace("\n", "")
-        dt_obj = datetime.strptime(created_at, "%Y-%m-%dT%H:%M:%S.%fZ")
-        created_epoch_unix = int(dt_obj.timestamp())
-
-        data = {**item, **tweet_data}
-        # NOTE: only replace the published date with twitter date if the talkwalker date
-        # is not available or is invalid
-        if data["published"] == -1 or data["published"] == 0:
-            data["published"] = created_epoch_unix
-            data["x-p6m-publish-source"] = "twitter"
-        text = data.pop("text")
-        data["content"] = text
-        data["word_count"] = len(text.split())
-        data["external_provider_attributes"] = tweet_data
-        data["url"] = tweet_data["id"]
-
-        if not tweet_data.get("author_id"):
-            self.logger.warning(f'Warning - author id is null for tweet id {tweet_data["id"]}')
-
-        # print(f'tweet text inside merge =  {data["body"]}')
-        return data
+        return merge_tweet(tweet_data, item)
 
     def save_data_to_file(self, data, jsonl_filename):
+        """Append compact records or item dicts, encoded exactly like TalkwalkerRecord.model_dump_json()"""
         with open(jsonl_filename, "a") as f:
             for item in data:
                 # print(item)
-                f.write(TalkwalkerRecord.parse_obj(item).model_dump_json() + "\n")
+                f.write(encode_record(item, self.record_class) + "\n")
 
     @staticmethod
     def get_item_by_id(items, external_id):
+        # compact records hold external_id as an int, twitter ids are strings
         for item in items:
-            if item["external_id"] == external_id:
+            if str(item.external_id) == external_id:
                 return item
         return ""
 
-    def merge_tweet_data(self, items, error_file_path):
+    def asyncio_engine(self) -> bool:
+        return isinstance(self.talk_walker, AsyncTalkwalkerSource)
 
-        page_size = self.params["page_size"]
-        max_retries = int(self.params["max_retries"])
-        twitter_token = self.params["TWITTER_TOKEN"]
+    def create_source(self, params, project_id=None, topic_id=None) -> TalkwalkerSource:
+        """TalkwalkerSource of a topic, of the fetch engine selected by tw_fetch_engine"""
 
-        twitter = TwitterSource(page_size, max_retries, twitter_token)
+        params = {
+            **params, 'project_id': project_id or params['project_id'], 'topic_id': topic_id or params['topic_id']
+        }
+        kwargs = dict(
+            session=self.session, rate_limiter=self.rate_limiter, projection=self.projection, upstreams=self.upstreams,
+            page_sizer=self.page_sizer,
+        )
+        engine = self.params["tw_fetch_engine"].casefold()
+        if engine == "asyncio" and self.archive is not None:
+            # the response archive records and replays the requests session of the threaded engine
+            self.logger.warning("the asyncio fetch engine does not support record and replay, using threads")
+        elif engine == "asyncio":
+            return AsyncTalkwalkerSource(
+                params, int(self.params["max_retries"]), self.params["page_size"], self.params["API_KEY"],
+                max_in_flight=int(self.params["tw_async_max_in_flight"]), **kwargs
+            )
+        elif engine != "threads":
+            raise ValueError(f"unknown fetch engine {engine}, expected threads or asyncio")
 
-        tweets_data = twitter.get_tweets_by_ids(
-            [item["external_id"] for item in items], error_file_path
+        return TalkwalkerSource(
+            params, int(self.params["max_retries"]), self.params["page_size"], self.params["API_KEY"], **kwargs
         )
 
+    def replaying_fast(self) -> bool:
+        """Replay without the original timings, the rate limits are lifted"""
+        return self.archive is not None and self.archive.replaying and self.archive.timing == "fast"
+
+    def get_tweets_by_ids(self, ids, error_file_path):
+        """
+        TwitterSource.get_tweets_by_ids under the adaptive limit and circuit breaker of the twitter api,
+        recorded to or served from the response archive in the record and replay modes
+        """
+
+        key = request_key("GET", f"https://{Constants.TWITTER_HOST}/tweets", {"ids": ",".join(ids)})
+        if self.archive is not None and self.archive.replaying:
+            entry = self.archive.replay(key)
+            if entry is None:
+                # not recorded, the items are saved without hydration
+                return {"data": [], "errors": [{"value": tweet_id} for tweet_id in ids]}
+            return self.archive.body(entry)
+
+        start = time.monotonic()
+        with self.upstreams.for_host(Constants.TWITTER_HOST).track():
+            rc = self.get_twitter().get_tweets_by_ids(ids, error_file_path)
+        if self.archive is not None:
+            self.archive.record(key, 200, rc, time.monotonic() - start)
+        if self.page_archive is not None:
+            self.page_archive.add_tweets(rc)
+        return rc
+
+    def merge_tweet_data(self, items, error_file_path):
+
+        ids = [str(item.external_id) for item in items]
+        cached, known_missing = {}, set()
+        if self.tweet_cache is not None:
+            # only the misses are looked up, ids twitter already reported missing are not retried
+            cached, known_missing, ids = self.tweet_cache.lookup(ids)
+            if cached and self.page_archive is not None:
+                self.page_archive.add_tweets({"data": list(cached.values()), "errors": []})
+
+        if ids:
+            tweets_data = self.get_tweets_by_ids(ids, error_file_path)
+        else:
+            tweets_data = {"data": [], "errors": []}
+
+        # the lookup results are not modified, they may be shared with the response archive; the tweets of
+        # the retries are kept as separate lists instead of concatenating them
+        tweets = [tweets_data["data"]]
+        errors = tweets_data["errors"]
+
         data = []
-        if len(tweets_data["errors"]):
+        if len(errors):
             self.logger.info(
-                f'NOT FOUND BEFORE - second try: {[error["value"] for error in tweets_data["errors"]]}'
+                f'NOT FOUND BEFORE - second try: {[error["value"] for error in errors]}'
             )
             time.sleep(15)
-            tweets_second = twitter.get_tweets_by_ids(
-                [error["value"] for error in tweets_data["errors"]], error_file_path
+            tweets_second = self.get_tweets_by_ids(
+                [error["value"] for error in errors], error_file_path
             )
 
-            tweets_data["data"] = tweets_data["data"] + tweets_second["data"]
-            tweets_data["errors"] = tweets_second["errors"]
+            tweets.append(tweets_second["data"])
+            errors = tweets_second["errors"]
 
             self.logger.info(
-                f"NOT FOUND AFTER - second try: {[error['value'] for error in tweets_data['errors']]}"
+                f"NOT FOUND AFTER - second try: {[error['value'] for error in errors]}"
             )
-            # self.talk_walker.log_error(f"Twitter errors {tweets_data['errors']}")
+            # self.talk_walker.log_error(f"Twitter errors {errors}")
 
-            if len(tweets_data["errors"]):
+            if len(errors):
                 self.logger.info(
-                    f"NOT FOUND BEFORE - third try: {[error['value'] for error in tweets_data['errors']]}"
+                    f"NOT FOUND BEFORE - third try: {[error['value'] for error in errors]}"
                 )
                 time.sleep(15)
-                tweets_third = twitter.get_tweets_by_ids(
-                    [error["value"] for error in tweets_data["errors"]], error_file_path
+                tweets_third = self.get_tweets_by_ids(
+                    [error["value"] for error in errors], error_file_path
                 )
 
-                tweets_data["data"] = tweets_data["data"] + tweets_third["data"]
-                tweets_data["errors"] = tweets_third["errors"]
+                tweets.append(tweets_third["data"])
+                errors = tweets_third["errors"]
 
-                self.talk_walker.twitter_errors = self.talk_walker.twitter_errors + len(
-                    tweets_data["errors"]
-                )
                 self.logger.info(
-                    f"NOT FOUND AFTER - third try: {[error['value'] for error in tweets_data['errors']]}"
+                    f"NOT FOUND AFTER - third try: {[error['value'] for error in errors]}"
                 )
-                # self.talk_walker.log_error(f"Twitter errors {tweets_data['errors']}")
-            self.talk_walker.twitter_errors = self.talk_walker.twitter_errors + len(
-                tweets_data["errors"]
+                # self.talk_walker.log_error(f"Twitter errors {errors}")
+            # the ids still missing after the last try
+            with self.talk_walker.lock:
+                self.talk_walker.twitter_errors = self.talk_walker.twitter_errors + len(errors)
+
+        if self.tweet_cache is not None:
+            self.tweet_cache.store(
+                list(itertools.chain.from_iterable(tweets)), [error["value"] for error in errors]
             )
+            tweets.append(cached.values())
+            errors = errors + [{"value": tweet_id} for tweet_id in known_missing]
+            with self.talk_walker.lock:
+                self.talk_walker.twitter_errors = self.talk_walker.twitter_errors + len(known_missing)
 
         # TODO - the loop below should iterate on TW items
         # instead of tweet items as not all twitter hydration will succeed.
         # this way all un-hydrated twitter items from TW will be present in the output,
         # at lease (even if un-hydrated).
 
-        for tweet in tweets_data["data"]:
+        # compact records hold external_id as an int, twitter ids are strings
+        items_by_id = {}
+        for item in items:
+            items_by_id.setdefault(str(item.external_id), item)
+
+        valid = 0
+        for tweet in itertools.chain.from_iterable(tweets):
+            valid += 1
             try:
-                original_tw_item = self.get_item_by_id(items, tweet["id"])
-                merged_items = self.transform_tweet_data(tweet, original_tw_item)
+                original_tw_item = items_by_id.get(tweet["id"])
+                # to_dict() builds a new dict, the tweet is merged into it in place
+                merged_items = self.transform_tweet_data(tweet, original_tw_item.to_dict())
                 data.append(merged_items)
 
             except Exception as e:
-                self.logger.error(f"Exception in twitter TW merge!")
+                self.logger.error("Exception in twitter TW merge!")
                 self.logger.exception(e)
 
-        for tweet in tweets_data["errors"]:
+        for tweet in errors:
             try:
-                original_tw_item = self.get_item_by_id(items, tweet["value"])
-                original_tw_item["twitter_error"] = tweet
-                original_tw_item.pop("x-p6m-publish-source", None)
+                original_tw_item = items_by_id.get(tweet["value"])
+                if not original_tw_item:
+                    raise ValueError(f"no talkwalker item for tweet id {tweet['value']}")
+                # twitter_error and x-p6m-publish-source are not part of the record, nothing to strip
                 data.append(original_tw_item)
 
             except Exception as e:
-                self.logger.error(f"Exception in twitter Errors and TW merge!")
+                self.logger.error("Exception in twitter Errors and TW merge!")
                 self.logger.exception(e)
 
         self.logger.info(
-            f"Tweets merged. TW = {len(items)}. valid = {len(tweets_data['data'])}.  invalid = {len(tweets_data['errors'])} Merged = {len(data)}"
+            "Tweets merged. TW = %s. valid = %s.  invalid = %s Merged = %s", len(items), valid, len(errors), len(data)
         )
         return data
 
+    def job_status(self, pipeline: Pipeline = None) -> dict:
+        rc = {
+            "total_retrieved": self.talk_walker.total_item_count,
+            "total_twitter": self.talk_walker.total_twitter_count,
+            "twitter_errors": self.talk_walker.twitter_errors,
+            "total_saved": self.talk_walker.total_saved,
+            "latest_errors": self.talk_walker.get_latest_errors(),
+        }
+        if pipeline is not None:
+            rc["queue_depths"] = pipeline.queue_depths()
+        if self.scheduler is not None:
+            rc["windows"] = self.scheduler.status()
+        rc["upstreams"] = self.upstreams.snapshot()
+        return rc
+
+    def build_pipeline(self, error_file_path) -> Pipeline:
+        """
+        Stages of a topic pull, each with the number of threads set in tw_pipeline_concurrency:
+        fetch (one search window per input) -> format -> dedupe (drop repeated items, download news
+        articles) -> hydrate (batch and merge tweets) -> serialize. Every stage passes on lists of items.
+        With the asyncio engine the inputs are pages that were already fetched, the fetch stage only counts them.
+        """
+
+        talk_walker = self.talk_walker
+        url = f"https://api.talkwalker.com/api/v1/search/p/{talk_walker.project_id}/results"
+        seen = RecentKeys(int(self.params["tw_dedupe_window"]))
+        tweet_items = []  # tweets waiting for a full hydration batch
+        tweet_lock = threading.Lock()
+
+        def count_page(page):
+            with talk_walker.lock:
+                talk_walker.total_item_count += len(page)
+            return [page]
+
+        def fetch(window):
+            start, end, label = window
+            count = 0
+            parameters = talk_walker.window_parameters(start, end)
+            parameters["offset"] = self.scheduler.offset(window)
+            pages = talk_walker.fetch_pages(url, parameters)
+            while True:
+                try:
+                    page = next(pages)
+                except StopIteration as stop:
+                    next_offset = stop.value
+                    break
+                count += len(page)
+                with talk_walker.lock:
+                    talk_walker.total_item_count += len(page)
+                yield page
+            self.logger.info("Item retrieved for %s: %s", label, count)
+            # a window given up at the deadline is resumed from its next page by the follow-up run, one whose
+            # last page arrived after the cutoff is complete
+            if next_offset is None:
+                self.scheduler.complete(window, count)
+            else:
+                self.scheduler.give_up(window, next_offset)
+
+        def format_page(page):
+            # the raw items are passed on for the dedupe stage, which needs their url and source type
+            return [list(zip(page, talk_walker.format_page(page, download_news=False)))]
+
+        def dedupe(pairs):
+            records = []
+            for item, data in pairs:
+                url_key = getattr(item.data, "url", None)
+                if url_key and not seen.add(url_key):
+                    with talk_walker.lock:
+                        talk_walker.duplicates += 1
+                    continue
+                talk_walker.add_news_article(item, data)
+                records.append(self.record_class.from_dict(data))
+            return [records]
+
+        def hydrate_batch(batch):
+            self.logger.info("Batched tweeter items = %s ", len(batch))
+            merged_items = self.merge_tweet_data(batch, error_file_path)
+            self.logger.info(
+                "Merged tweeter items = %s from original TW items  = %s", len(merged_items), len(batch)
+            )
+            return merged_items
+
+        def hydrate(records):
+            rc = [[item for item in records if item.external_provider != "twitter"]]
+            batches = []
+            with tweet_lock:
+                tweet_items.extend(item for item in records if item.external_provider == "twitter")
+                # If we've reached 100 items, get the tweets
+                while len(tweet_items) >= Constants.TWITTER_IDS_COUNT:
+                    batches.append(tweet_items[:Constants.TWITTER_IDS_COUNT])
+                    del tweet_items[:Constants.TWITTER_IDS_COUNT]
+            rc.extend(hydrate_batch(batch) for batch in batches)
+            return rc
+
+        def flush_tweets():
+            if tweet_items:
+                return [hydrate_batch(tweet_items)]
+
+        def serialize(items):
+            # the published epochs are passed on for the manifest
+            published = [
+                item.get("published") if isinstance(item, dict) else getattr(item, "published", None) for item in items
+            ]
+            return [([encode_record(item, self.record_class) for item in items], published)]
+
+        concurrency = parse_concurrency(self.params["tw_pipeline_concurrency"], Constants.PIPELINE_STAGES)
+        stages = [
+            Stage("fetch", count_page, 1) if self.asyncio_engine() else Stage("fetch", fetch, concurrency["fetch"]),
+            Stage("format", format_page, concurrency["format"]),
+            Stage("dedupe", dedupe, concurrency["dedupe"]),
+            Stage("hydrate", hydrate, concurrency["hydrate"], flush=flush_tweets),
+            Stage("serialize", serialize, concurrency["serialize"]),
+        ]
+        self.logger.info(f"pipeline stage concurrency = {concurrency}")
+        return Pipeline(stages, int(self.params["tw_pipeline_queue_size"]))
+
+    def build_volume_plan(self):
+        """Volume plan of the current topic at the configured rate limit and fetch concurrency"""
+
+        concurrency = parse_concurrency(self.params["tw_pipeline_concurrency"], Constants.PIPELINE_STAGES)
+        return build_plan(
+            self.talk_walker,
+            self.rate_limiter.min_interval,
+            float(self.params["tw_plan_request_seconds"]),
+            concurrency["fetch"],
+            self.session,
+        )
+
+    def pull(self, jsonl_file_path, error_file_path, plan=None) -> list:
+        """
+        Run the pipeline of the current topic, appending the output lines to jsonl_file_path. With a run
+        deadline, windows are only started while they are projected to complete in time.
+        :param plan: VolumePlan of the topic, when given only its non empty windows are fetched, largest first
+        :return: the windows that were not completed, see DeadlineScheduler.remaining()
+        """
+
+        start_date, end_date = self.talk_walker.get_date_range()
+        self.logger.info(f"starting search from {start_date} till {end_date}")
+        offsets = {}
+        if self.params.get("windows"):
+            # follow-up of a run that reached its deadline
+            windows = [
+                window for n, window in enumerate(parse_windows(self.params["windows"]))
+                if n % self.shard_count == self.shard_index
+            ]
+            windows = order_windows(windows, self.params["tw_window_order"])
+            # windows given up at the deadline go on from their next page
+            offsets = parse_offsets(self.params["windows"])
+        elif plan is None:
+            windows = self.talk_walker.get_windows(self.shard_index, self.shard_count)
+            windows = order_windows(windows, self.params["tw_window_order"])
+        else:
+            windows = plan.schedule(self.shard_index, self.shard_count)
+
+        self.scheduler = self.talk_walker.scheduler = DeadlineScheduler(
+            windows, self.deadline, float(self.params["tw_deadline_margin_seconds"]), offsets=offsets
+        )
+        windows = self.scheduler
+
+        pipeline = self.build_pipeline(error_file_path)
+        self.partition_stats = PartitionStats(self.output_partition(), self.upload_part_size())
+        with open(jsonl_file_path, "ab") as f:
+
+            def sink(output):
+                lines, published = output
+                if not lines:
+                    return
+                data = ("\n".join(lines) + "\n").encode("utf-8")
+                f.write(data)
+                self.partition_stats.add(data, len(lines), published)
+                with self.talk_walker.lock:
+                    self.talk_walker.total_saved += len(lines)
+
+                # the status is only gathered when it is logged
+                if not self.logger.isEnabledFor(logging.INFO):
+                    return
+                job_status_update = self.job_status(pipeline)
+                self.logger.info("### %s status : %s", self.application_name, job_status_update)
+
+                if len(job_status_update["latest_errors"]) != 0:
+                    self.logger.info(
+                        "%s latest errors : %s", self.application_name, job_status_update["latest_errors"])
+
+            if self.asyncio_engine():
+                windows = self.talk_walker.iter_pages(windows, int(self.params["tw_pipeline_queue_size"]))
+            pipeline.run(windows, sink)
+
+        self.logger.info(f"pipeline stats = {pipeline.stats()}")
+        self.logger.info(f"duplicate items dropped = {self.talk_walker.duplicates}")
+        self.logger.info(f"upstream limits = {self.upstreams.snapshot()}")
+        self.logger.info(f"page sizes = {self.talk_walker.page_sizer.status()}")
+
+        remaining = self.scheduler.remaining(self.output_partition())
+        self.logger.info(f"windows = {self.scheduler.status()}, {len(remaining)} not completed")
+        return remaining
+
+    def output_partition(self) -> int:
+        """
+        n of the output file_{n}.jsonl, every shard of a sharded pull writes its own partition and a follow-up
+        run starts at the next_partition of the run it continues
+        """
+        return int(self.params.get("partition") or Constants.PARTITION_NUM) + self.shard_index
+
+    def get_hash_id(self, project_id, topic_id, get_news_links) -> str:
+        # input json for generating MD5 hash
+        hash_input = {
+            'project_id': project_id,
+            'topic_id': topic_id,
+            "get_news_links": get_news_links
+        }
+
+        self.logger.info(f'hash input = {hash_input}')
+
+        from driver_library_{{ org_name }}_{{ solution_name }}.driver_library.utils.md5.MD5Generator import MD5Source
+
+        md5 = MD5Source(input_json=hash_input, keys_to_exclude=['from_date', 'to_date'], delimiter='|')
+        hash_id = md5.generate_md5_hash()
+
+        self.logger.info(f'generated hash = {hash_id}')
+        return hash_id
+
+    def upload_raw_pages(
+            self, page_archive_path, hash_id, from_date, to_date, partition=Constants.PARTITION_NUM
+    ) -> str:
+        """Upload the raw page archive of a topic next to its output, returns its s3 uri"""
+
+        key_name = (Constants.S3_KEY_TEMPLATE_PREFIX + Constants.PAGES_KEY_TEMPLATE_POSTFIX.format(
+            hash_id, from_date, to_date, partition)).format(Constants.APPLICATION_NAME)
+        if not self.upload_file(page_archive_path, self.output_bucket, key_name):
+            return None
+        return f"s3://{self.output_bucket}/{key_name}"
+
+    def upload_manifest(self, manifest: dict, hash_id, from_date, to_date) -> str:
+        """Upload the manifest of a pull next to its xcom, returns its s3 uri"""
+
+        key_name = (Constants.S3_KEY_TEMPLATE_PREFIX + Constants.MANIFEST_KEY_TEMPLATE_POSTFIX.format(
+            hash_id, from_date, to_date, hash_id)).format(Constants.APPLICATION_NAME)
+        manifest_file_name = f'manifest_{hash_id}_{from_date}_{to_date}.json'
+        with open(manifest_file_name, 'w') as f:
+            json.dump(manifest, f)
+        if not self.upload_file(manifest_file_name, self.output_bucket, key_name):
+            return None
+        return f"s3://{self.output_bucket}/{key_name}"
+
+    def publish(
+            self, params, jsonl_file_path, hash_id, project_name, topic_name, solution_name, task_id, raw_pages=None,
+            partition=Constants.PARTITION_NUM, shard=None, stats: PartitionStats = None, remaining=None
+    ) -> dict:
+        """
+        Upload the output file, its manifest and its xcom, returns the xcom
+        :param partition: n of the output file_{n}.jsonl
+        :param shard: shard index of a sharded pull, its xcom is stored under shards/ for finalize()
+        :param stats: PartitionStats of the output file, read from the file when not given
+        :param remaining: windows left for a follow-up run when the run reached its deadline
+        """
+
+        from_date = params['from_date']
+        to_date = params['to_date']
+
+        # s3 object key  = raw/{application}/{hash_id}/{from_date}_{to_date}/file_{int}jsonl
+
+        s3_filled_postfix = Constants.S3_KEY_TEMPLATE_POSTFIX.format(
+            hash_id, from_date, to_date, partition)
+
+        s3_template = Constants.S3_KEY_TEMPLATE_PREFIX + s3_filled_postfix
+
+        if shard is None:
+            xcom_filled_postfix = Constants.XCOM_KEY_TEMPLATE_POSTFIX.format(
+                hash_id, from_date, to_date, hash_id)
+        else:
+            xcom_filled_postfix = Constants.SHARD_XCOM_KEY_TEMPLATE_POSTFIX.format(
+                hash_id, from_date, to_date, hash_id, shard)
+
+        xcom_template = Constants.S3_KEY_TEMPLATE_PREFIX + xcom_filled_postfix
+
+        # object_storage_key_for_results
+
+        s3_jsonl_key_name = s3_template.format(Constants.APPLICATION_NAME)
+        xcom_json_key_name = xcom_template.format(Constants.APPLICATION_NAME)
+
+        if stats is None:
+            stats = PartitionStats.from_file(jsonl_file_path, partition, self.upload_part_size())
+        self.upload_file(jsonl_file_path, self.output_bucket, s3_jsonl_key_name, stats.digest)
+
+        self.logger.info(f'{self.application_name} Status : output has been written to {s3_jsonl_key_name}.')
+
+        data = {
+            "output_template": s3_template,
+            "xcom_template": xcom_template,
+            "talkwalker_output": f"s3://{self.output_bucket}/{s3_jsonl_key_name}",
+            "query_hash": hash_id,
+            "project_id": params['project_id'],
+            "topic_id": params['topic_id'],
+            "from_date": params['from_date'],
+            "to_date": params['to_date'],
+            "project_name": project_name,
+            "topic_name": topic_name,
+            "vendor_name": "talkwalker",
+            "source_format": "json",
+            "solution_name": solution_name,
+        }
+        if raw_pages:
+            data["raw_pages"] = raw_pages
+        if remaining is not None:
+            # a follow-up run takes these as its windows input, and writes the partitions after this run's
+            data["complete"] = not remaining
+            data["remaining_windows"] = remaining
+            if remaining:
+                data["next_partition"] = partition - self.shard_index + self.shard_count
+
+        manifest_partition = {**stats.to_dict(), "output": data["talkwalker_output"]}
+        if shard is None:
+            manifest = build_manifest(data, [manifest_partition])
+            data["manifest"] = self.upload_manifest(manifest, hash_id, from_date, to_date)
+        else:
+            # finalize() writes the manifest of the whole pull
+            data["manifest_partition"] = manifest_partition
+            data["partition"] = partition
+            data["shard_index"] = shard
+            data["shard_count"] = self.shard_count
+
+        self.logger.info(f'talkwalker output = {data}')
+        # upload xcom as a file to s3
+        # the chunks of a backfill share the hash
+        xcom_file_name = f'xcom_{hash_id}_{from_date}_{to_date}.json' if shard is None else \
+            f'xcom_{hash_id}_{from_date}_{to_date}_{shard}.json'
+        with open(xcom_file_name, 'w') as f:
+            json.dump(data, f)
+        self.upload_file(xcom_file_name, self.output_bucket, xcom_json_key_name)
+
+        self.logger.info(f"{self.application_name} Job Id id = {task_id} completed.")
+        self.logger.info(f"\n=========================================\n")
+        self.logger.info(
+            f"\n{self.application_name} == Results for Job id {task_id} is available at "
+            f"s3://{self.output_bucket}/{s3_jsonl_key_name}  ==\n")
+        self.logger.info(f"\n===============Completed=================\n")
+
+        return data
+
+    def finalize_topics(self, params: dict, topics: list) -> list:
+        """
+        Combine the shard xcoms of sharded pulls into the xcom of each pull, once every shard is done
+        :param params: the inputs of the shards, with shard_count
+        :param topics: list of (project_id, topic_id) tuples
+        :return: list with the combined xcom of each topic, in the order of topics
+        """
+
+        self.params = params
+        self.initialize_buckets()
+        self.authenticate_s3()
+
+        shard_count = int(params["shard_count"])
+        s3 = self.s3_client()
+        rc = []
+        for project_id, topic_id in topics:
+            # same hash as run_topic
+            hash_id = self.get_hash_id(
+                project_id or self.params["PROJECT_ID"], topic_id, params['get_news_links']
+            )
+
+            shards, missing = [], []
+            for shard in range(shard_count):
+                key_name = (Constants.S3_KEY_TEMPLATE_PREFIX + Constants.SHARD_XCOM_KEY_TEMPLATE_POSTFIX.format(
+                    hash_id, params['from_date'], params['to_date'], hash_id, shard
+                )).format(Constants.APPLICATION_NAME)
+                try:
+                    shards.append(json.loads(s3.get_object(Bucket=self.output_bucket, Key=key_name)["Body"].read()))
+                except Exception as e:
+                    self.logger.error(f"shard {shard} of topic {topic_id} is not complete, {key_name}: {e}")
+                    missing.append(shard)
+            if missing:
+                self.logger.error(f"finalize failed - missing shards {missing} of {shard_count} for topic {topic_id}")
+                exit(1)
+
+            data = {
+                key: value for key, value in shards[0].items()
+                if key not in (
+                    "partition", "shard_index", "shard_count", "raw_pages", "manifest_partition", "complete",
+                    "remaining_windows", "next_partition"
+                )
+            }
+            data["xcom_template"] = Constants.S3_KEY_TEMPLATE_PREFIX + Constants.XCOM_KEY_TEMPLATE_POSTFIX.format(
+                hash_id, params['from_date'], params['to_date'], hash_id)
+            data["partitions"] = shard_count
+            data["talkwalker_outputs"] = [shard["talkwalker_output"] for shard in shards]
+            raw_pages = [shard["raw_pages"] for shard in shards if shard.get("raw_pages")]
+            if raw_pages:
+                data["raw_pages"] = raw_pages
+            remaining = sorted(
+                (window for shard in shards for window in shard.get("remaining_windows", [])),
+                key=lambda window: window["start"],
+            )
+            data["complete"] = not remaining
+            data["remaining_windows"] = remaining
+            if remaining:
+                data["next_partition"] = max(shard["next_partition"] for shard in shards if "next_partition" in shard)
+            manifest = build_manifest(data, [shard["manifest_partition"] for shard in shards])
+            self.logger.info(
+                f"manifest - {manifest['records']} records, {manifest['bytes']} bytes in {shard_count} partitions"
+            )
+            data["manifest"] = self.upload_manifest(manifest, hash_id, params['from_date'], params['to_date'])
+
+            self.logger.info(f'talkwalker combined output = {data}')
+            xcom_file_name = f'xcom_{hash_id}.json'
+            with open(xcom_file_name, 'w') as f:
+                json.dump(data, f)
+            self.upload_file(
+                xcom_file_name, self.output_bucket, data["xcom_template"].format(Constants.APPLICATION_NAME)
+            )
+            rc.append(data)
+        self.logger.info(f"uploads = {self.upload_stats.to_dict()}")
+        return rc
+
+    def reprocess(self, params: dict, raw_pages: str) -> dict:
+        """
+        Rebuild the output file and the xcom of a pull from its raw page archive, without calling talkwalker
+        or twitter, e.g. after a change of TalkwalkerRecord or of the transforms
+        :param params: configuration, the pull parameters are read from the archive
+        :param raw_pages: s3 uri or local path of the pages_{n}.jsonl.gz archive
+        :return: the new xcom
+        """
+
+        self.params = params
+        self.initialize_buckets()
+        self.authenticate_s3()
+
+        os.makedirs('./data', exist_ok=True)
+        path = raw_pages
+        if raw_pages.startswith("s3://"):
+            bucket, _, key = raw_pages[len("s3://"):].partition("/")
+            path = os.path.join('./data', os.path.basename(key))
+            self.s3_client().download_file(bucket, key, path)
+
+        timestamp = int(time.time())
+        jsonl_file_path = os.path.join('./data', f"{Constants.APPLICATION_NAME}_reprocess_{timestamp}.jsonl")
+
+        run = reprocess_archive(
+            path,
+            jsonl_file_path,
+            FieldProjection.parse(params["tw_field_projection"]),
+            int(params["tw_reprocess_workers"]) or None,
+            int(params["tw_dedupe_window"]),
+        )
+        self.logger.info(f"reprocess = {run}")
+
+        # the partition and shard the archived run was published as, archives that do not record them are from
+        # the single partition of an unsharded pull
+        partition = int(run.get("partition") or Constants.PARTITION_NUM)
+        shard = run.get("shard_index")
+        self.shard_index = shard or 0
+        self.shard_count = int(run.get("shard_count") or 1)
+
+        hash_id = self.get_hash_id(run["project_id"], run["topic_id"], run["get_news_links"])
+        return self.publish(
+            run["params"], jsonl_file_path, hash_id, run["project_name"], run["topic_name"], run["solution_name"],
+            run["params"].get("task_id"), raw_pages, partition, shard, remaining=run.get("remaining_windows")
+        )
+
     def run(self, params: dict) -> dict:
         """
         Main method in Driver class that invokes the entire logic of talkwalker
@@ -206,19 +970,177 @@ class Driver:
         :return: return value is a dictionary with oll outputs (s3 location in this case)
         """
 
-        self.params = params
+        return self.run_topics(params, [(params['project_id'], params['topic_id'])])[0]
+
+    def run_topics(self, params: dict, topics: list) -> list:
+        """
+        Pull several topics, possibly across projects, in a single invocation. S3 authentication, the http
+        session, the rate limiter, project/topic metadata and the available credits are set up once and
+        shared by all topics; every topic gets its own output prefix and xcom. A topic that fails does not
+        abort the others, its output is {"project_id", "topic_id", "error"}; the run fails when all topics do.
+        :param params: all inputs needed to run the program, project_id and topic_id are taken from topics
+        :param topics: list of (project_id, topic_id) tuples
+        :return: list with the outputs of each topic, in the order of topics
+        """
 
         # logger.info(f'combined args = {params}') TODO: Display variables without sensitive information only
 
         agent_name = f"{self.application_name}"
 
-        self.logger.info(f'Running application = {agent_name}')
+        self.logger.info(f'Running application = {agent_name} for {len(topics)} topic(s)')
 
-        self.logger.info(f"{self.application_name} Validating access to s3 buckets.")
-        self.initialize_buckets()
-        self.logger.info(f"{self.application_name} Access to s3 buckets complete.")
+        self.setup(params)
 
-        self.logger.info(f"Output Bucket = {self.output_bucket}")
+        try:
+            if len(topics) == 1:
+                project_id, topic_id = topics[0]
+                return [self.run_topic({**params, 'project_id': project_id, 'topic_id': topic_id})]
+
+            rc, failed = [], []
+            for project_id, topic_id in topics:
+                try:
+                    rc.append(self.run_topic({**params, 'project_id': project_id, 'topic_id': topic_id}))
+                except (SystemExit, Exception) as e:
+                    # run_topic logged the cause, the next topics still run
+                    error = f"exit status {e.code}" if isinstance(e, SystemExit) else f"{type(e).__name__}: {e}"
+                    self.logger.error(f"topic {topic_id} of project {project_id} failed - {error}")
+                    rc.append({"project_id": project_id, "topic_id": topic_id, "error": error})
+                    failed.append((project_id, topic_id))
+                    if self.page_archive is not None:
+                        self.page_archive.close()
+                        self.page_archive = None
+
+            if failed:
+                self.logger.error(f"{len(failed)} of {len(topics)} topics failed: {failed}")
+            if len(failed) == len(topics):
+                exit(1)
+            return rc
+        finally:
+            self.close()
+
+    def run_backfill(self, params: dict, topics: list, chunks: list, workers: int = 1) -> list:
+        """
+        Pull the topics for every date range of a backfill in this process. The http session, limiters, caches
+        and S3 client are set up once and shared by all the chunks, every chunk is published under its own
+        from_date_to_date prefix with its own xcom. A topic that fails for a chunk does not abort the backfill,
+        its output is {"project_id", "topic_id", "from_date", "to_date", "error"}; the backfill fails when all do.
+        :param chunks: list of (from_date, to_date) tuples, see schedule.date_chunks()
+        :param workers: chunks pulled concurrently, each by its own fork() of this driver
+        :return: list with the outputs of each chunk, in the order of chunks, each a list in the order of topics
+        """
+
+        self.logger.info(f"backfill of {len(topics)} topic(s) in {len(chunks)} chunks, {workers} at a time")
+        self.setup(params)
+
+        def run_chunk(driver, chunk):
+            from_date, to_date = chunk
+            self.logger.info(f"backfill chunk {from_date} - {to_date}")
+            rc = []
+            for project_id, topic_id in topics:
+                try:
+                    rc.append(driver.run_topic({
+                        **params, 'project_id': project_id, 'topic_id': topic_id, 'from_date': from_date,
+                        'to_date': to_date,
+                    }))
+                except (SystemExit, Exception) as e:
+                    # run_topic logged the cause, the other topics and chunks still run
+                    error = f"exit status {e.code}" if isinstance(e, SystemExit) else f"{type(e).__name__}: {e}"
+                    self.logger.error(
+                        f"topic {topic_id} of project {project_id} failed for {from_date} - {to_date} - {error}")
+                    rc.append({
+                        "project_id": project_id, "topic_id": topic_id, "from_date": from_date,
+                        "to_date": to_date, "error": error,
+                    })
+                    if driver.page_archive is not None:
+                        driver.page_archive.close()
+                        driver.page_archive = None
+            return rc
+
+        try:
+            if workers <= 1:
+                rc = [run_chunk(self, chunk) for chunk in chunks]
+            else:
+                with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="backfill") as executor:
+                    rc = list(executor.map(lambda chunk: run_chunk(self.fork(), chunk), chunks))
+
+            failed = [output for outputs in rc for output in outputs if "error" in output]
+            if failed:
+                self.logger.error(f"{len(failed)} of {len(topics) * len(chunks)} backfill pulls failed")
+            if len(failed) == len(topics) * len(chunks):
+                exit(1)
+            return rc
+        finally:
+            self.close()
+
+    def fork(self):
+        """
+        Driver sharing the resources set up by setup() with this one, to pull another topic concurrently: the
+        per topic state (source, scheduler, output stats) is its own. The forks reserve their credits from the
+        same CreditBudget.
+        """
+
+        rc = type(self)()
+        for name in (
+                "params", "output_bucket", "object_storage", "session", "rate_limiter", "upstreams", "page_sizer",
+                "archive", "shard_index", "shard_count", "deadline", "twitter", "projects", "topics",
+                "credits", "metadata_cache", "tweet_cache", "projection", "record_class", "s3",
+                "upload_stats",
+        ):
+            setattr(rc, name, getattr(self, name))
+        return rc
+
+    def close(self) -> None:
+        """Close the response archive and the tweet cache of the invocation, log what it uploaded"""
+
+        self.logger.info(f"uploads = {self.upload_stats.to_dict()}")
+        if self.archive is not None:
+            self.logger.info(f"response archive = {self.archive.stats()}")
+            self.archive.close()
+        if self.tweet_cache is not None:
+            self.tweet_cache.close()
+            self.tweet_cache = None
+
+    def plan_topics(self, params: dict, topics: list) -> dict:
+        """
+        Dry run: estimate the requests, credits and runtime of pulling topics without fetching any results
+        :param params: all inputs needed to run the program, project_id and topic_id are taken from topics
+        :param topics: list of (project_id, topic_id) tuples
+        :return: the volume plan of every topic and the credit check of the whole invocation
+        """
+
+        self.logger.info(f"{self.application_name} dry run for {len(topics)} topic(s)")
+        self.setup(params)
+
+        plans = []
+        for project_id, topic_id in topics:
+            self.talk_walker = self.create_source(params, project_id, topic_id)
+            plan = self.build_volume_plan()
+            if plan is None:
+                plans.append({"project_id": project_id, "topic_id": topic_id, "error": "histogram not available"})
+            else:
+                plans.append(plan.to_dict())
+
+        available_credits = self.get_available_credits()
+        estimated_credits = sum(plan.get("estimated_credits", 0) for plan in plans)
+        rc = {
+            "dry_run": True,
+            "available_credits": available_credits,
+            "estimated_credits": estimated_credits,
+            "estimated_requests": sum(plan.get("estimated_requests", 0) for plan in plans),
+            "estimated_seconds": sum(plan.get("estimated_seconds", 0) for plan in plans),
+            "enough_credits_available": available_credits is not None and available_credits >= estimated_credits,
+            "plans": plans,
+        }
+        summary = {key: value for key, value in rc.items() if key != "plans"}
+        self.logger.info(f"dry run = {summary}")
+        return rc
+
+    def run_topic(self, params: dict) -> dict:
+        """
+        Pull a single topic with the resources set up by setup()
+        :param params: args is a dictionary with all inputs needed to run the program
+        :return: return value is a dictionary with oll outputs (s3 location in this case)
+        """
 
         # NOTE  sample payload
         """
@@ -263,52 +1185,52 @@ class Driver:
         self.logger.info(
             f"{self.application_name} New task id = {task_id} running at timestamp = {timestamp} topic id = {topic_id}")
 
-        self.authenticate_s3()
         try:
 
-            max_retries = int(self.params["max_retries"])
-            access_token = self.params["API_KEY"]
-            page_size = self.params["page_size"]
-
-            self.talk_walker = TalkwalkerSource(params, max_retries, page_size, access_token)
+            self.talk_walker = self.create_source(params)
+            if self.replaying_fast():
+                self.talk_walker.page_interval = 0
 
             # validate project id and topic id
 
-            project_name, (topic_name, solution_name) = self.talk_walker.get_project_topic_names(project_id, topic_id)
-
             """
-            check if the topic is valid and that we have enough credits
+            check if the topic is valid and that we have enough credits, concurrently with S3 authentication
             """
-            can_exec_topic = get_credits_estimation(
-                self.talk_walker.access_token, topic_id, self.talk_walker.project_id
-            )
-            print(can_exec_topic)
-            available_credits = can_exec_topic["available_credits"]
-            self.talk_walker.required_credits = can_exec_topic["required_credits"]
-
-            if self.talk_walker.required_credits == -1:
-                logging.error(f"invalid topic id: {topic_id}")
+            try:
+                report = run_preflight(self, project_id, topic_id)
+            except PreflightError as e:
+                for error in e.report.errors:
+                    self.logger.error(error)
+                self.logger.error(f"preflight report = {e.report.to_dict()}")
                 exit(1)
 
-            if not can_exec_topic["enough_credits_available"]:
-                logging.error(f"Not enough credits available for: {topic_id}")
-                logging.error(
-                    f"Available credits: {available_credits}, required credits: {self.talk_walker.required_credits}"
-                )
-                exit(1)
+            self.logger.info(f"preflight report = {report.to_dict()}")
+            project_name, topic_name, solution_name = report.project_name, report.topic_name, report.solution_name
+            self.talk_walker.required_credits = report.required_credits
 
             self.logger.info(
-                f"{self.application_name} Topic: {topic_id},  total items to be retrieved: {self.talk_walker.required_credits}"
+                f"{self.application_name} Topic: {topic_id},  "
+                f"total items to be retrieved: {self.talk_walker.required_credits}"
             )
 
-            jsonl_filename = f"{Constants.APPLICATION_NAME}_{topic_id}_{timestamp}.jsonl"  # Include timestamp in the filename
-            error_filename = f"{Constants.APPLICATION_NAME}_{topic_id}_{timestamp}.errors.txt"  # Include timestamp in the filename
+            # the credits left for the next topics of this invocation, and for the concurrent chunks of a backfill
+            if not self.credits.reserve(self.talk_walker.required_credits):
+                self.logger.error(
+                    f"Not enough credits left for: {topic_id}, the other topics of the invocation took them. "
+                    f"Required credits: {self.talk_walker.required_credits}"
+                )
+                exit(1)
+
+            # the date range tells the concurrent chunks of a backfill apart
+            local_name = f"{Constants.APPLICATION_NAME}_{topic_id}_{from_date}_{to_date}_{timestamp}"
+            jsonl_filename = f"{local_name}.jsonl"  # Include timestamp in the filename
+            error_filename = f"{local_name}.errors.txt"  # Include timestamp in the filename
 
             path = './data'
 
             # check whether directory already exists
             if not os.path.exists(path):
-                os.mkdir(path)
+                os.makedirs(path, exist_ok=True)  # the concurrent chunks of a backfill may race here
                 self.logger.info(f"{self.application_name} Folder {path} created!")
             else:
                 self.logger.info(f"{self.application_name} Folder {path} already exists")
@@ -319,62 +1241,36 @@ class Driver:
             self.logger.info(f'local json file path = {jsonl_file_path}')
             self.logger.info(f'local error file path = {error_file_path}')
 
-            tweet_items = []  # list to hold tweet items for batching
-
-            job_status_update = {
-                "total_retrieved": 0,
-                "total_twitter": 0,
-                "twitter_errors": 0,
-                "self.talk_walker.total_saved": 0,
-                "latest_errors": [],
-            }
-
-            loop_count = 0
-
-            for data in self.talk_walker.retrieve_data():
-                for item in data:
-
-                    loop_count += 1
-
-                    if item.get("external_provider", "") == "twitter":
-                        tweet_items.append(item)  # add the item to the batch list
-
-                        # If we've reached 100 items, get the tweets and write to the file
-                        if len(tweet_items) == Constants.TWITTER_IDS_COUNT:
-                            self.logger.info(
-                                f"Batched tweeter items = {len(tweet_items)} "
-                            )
-                            merged_items = self.merge_tweet_data(
-                                tweet_items, error_file_path
-                            )
-                            self.logger.info(
-                                f"Merged tweeter items = {len(merged_items)} from original TW items  = {len(tweet_items)}"
-                            )
-                            self.talk_walker.total_saved += len(merged_items)
-                            self.save_data_to_file(merged_items, jsonl_file_path)
-                            tweet_items = []
-                    else:
-                        self.talk_walker.total_saved += 1
-                        self.save_data_to_file([item], jsonl_file_path)
-
-                    job_status_update = {
-                        "total_retrieved": self.talk_walker.total_item_count,
-                        "total_twitter": self.talk_walker.total_twitter_count,
-                        "twitter_errors": self.talk_walker.twitter_errors,
-                        "total_saved": self.talk_walker.total_saved,
-                        "latest_errors": self.talk_walker.get_latest_errors(),
-                    }
-
-                    self.logger.info(f"### {self.application_name} status : {job_status_update}")
-
-                    if len(self.talk_walker.get_latest_errors()) != 0:
-                        self.logger.info(
-                            f'{self.application_name} latest errors : {self.talk_walker.get_latest_errors()}')
-
-            if tweet_items:
-                merged_items = self.merge_tweet_data(tweet_items, error_file_path)
-                self.talk_walker.total_saved += len(merged_items)
-                self.save_data_to_file(merged_items, jsonl_file_path)
+            page_archive_path = None
+            if self.params["tw_raw_archive"].casefold() == "True".casefold():
+                # raw pages for reprocess(), uploaded next to the output
+                page_archive_path = os.path.join(path, f"{local_name}.pages.jsonl.gz")
+                self.page_archive = self.talk_walker.page_archive = RawPageArchive(page_archive_path)
+                self.page_archive.add_run({
+                    "project_id": project_id,
+                    "topic_id": topic_id,
+                    "get_news_links": get_news_links,
+                    "project_name": project_name,
+                    "topic_name": topic_name,
+                    "solution_name": solution_name,
+                    "params": {
+                        key: params[key]
+                        for key in ('project_id', 'topic_id', 'from_date', 'to_date', 'task_id', 'get_news_links')
+                    },
+                    # reprocess() publishes to the same file_{n}.jsonl and xcom
+                    "partition": self.output_partition(),
+                    "shard_index": self.shard_index if self.shard_count > 1 else None,
+                    "shard_count": self.shard_count,
+                })
+                self.logger.info(f'local raw page archive path = {page_archive_path}')
+
+            plan = None
+            if self.params["tw_plan_schedule"].casefold() == "True".casefold() or \
+                    self.params["tw_window_order"] == "volume":
+                # fall back to fetching every window when the histogram is not available
+                plan = self.build_volume_plan()
+
+            remaining = self.pull(jsonl_file_path, error_file_path, plan)
 
             self.logger.info(
                 f"### {self.application_name} ### Final Total items retrieved: {self.talk_walker.total_item_count}"
@@ -392,71 +1288,20 @@ class Driver:
             self.logger.info(
                 f'{self.application_name} Status : talkwalker job is complete. Next step is to save results to S3 now.')
 
-            # input json for generating MD5 hash
-            hash_input = {
-                'project_id': project_id,
-                'topic_id': topic_id,
-                "get_news_links": get_news_links
-            }
-
-            self.logger.info(f'hash input = {hash_input}')
-
-            md5 = MD5Source(input_json=hash_input, keys_to_exclude=['from_date', 'to_date'], delimiter='|')
-            hash_id = md5.generate_md5_hash()
-
-            self.logger.info(f'generated hash = {hash_id}')
-
-            # s3 object key  = raw/{application}/{hash_id}/{from_date}_{to_date}/file_{int}jsonl
-
-            s3_filled_postfix = Constants.S3_KEY_TEMPLATE_POSTFIX.format(
-                hash_id, from_date, to_date, Constants.PARTITION_NUM)
-
-            s3_template = Constants.S3_KEY_TEMPLATE_PREFIX + s3_filled_postfix
-
-            xcom_filled_postfix = Constants.XCOM_KEY_TEMPLATE_POSTFIX.format(
-                hash_id, from_date, to_date, hash_id)
-
-            xcom_template = Constants.S3_KEY_TEMPLATE_PREFIX + xcom_filled_postfix
-
-            # object_storage_key_for_results
-
-            s3_jsonl_key_name = s3_template.format(Constants.APPLICATION_NAME)
-            xcom_json_key_name = xcom_template.format(Constants.APPLICATION_NAME)
-
-            self.upload_file(jsonl_file_path, self.output_bucket, s3_jsonl_key_name)
-
-            self.logger.info(f'{self.application_name} Status : output has been written to {s3_jsonl_key_name}.')
-
-            data = {
-                "output_template": s3_template,
-                "xcom_template": xcom_template,
-                "talkwalker_output": f"s3://{self.output_bucket}/{s3_jsonl_key_name}",
-                "query_hash": hash_id,
-                "project_id": params['project_id'],
-                "topic_id": params['topic_id'],
-                "from_date": params['from_date'],
-                "to_date": params['to_date'],
-                "project_name": project_name,
-                "topic_name": topic_name,
-                "vendor_name": "talkwalker",
-                "source_format": "json",
-                "solution_name": solution_name,
-            }
-
-            self.logger.info(f'talkwalker output = {data}')
-            # upload xcom as a file to s3
-            xcom_file_name = f'xcom_{hash_id}.json'
-            with open(xcom_file_name, 'w') as f:
-                json.dump(data, f)
-            self.upload_file(xcom_file_name, self.output_bucket, xcom_json_key_name)
+            hash_id = self.get_hash_id(project_id, topic_id, get_news_links)
 
-            self.logger.info(f"{self.application_name} Job Id id = {task_id} completed.")
-            self.logger.info(f"\n=========================================\n")
-            self.logger.info(
-                f"\n{self.application_name} == Results for Job id {task_id} is available at s3://{self.output_bucket}/{s3_jsonl_key_name}  ==\n")
-            self.logger.info(f"\n===============Completed=================\n")
+            partition = self.output_partition()
+            raw_pages = None
+            if self.page_archive is not None:
+                self.page_archive.add_remaining(remaining)
+                self.page_archive.close()
+                self.talk_walker.page_archive = self.page_archive = None
+                raw_pages = self.upload_raw_pages(page_archive_path, hash_id, from_date, to_date, partition)
 
-            return data
+            return self.publish(
+                params, jsonl_file_path, hash_id, project_name, topic_name, solution_name, task_id, raw_pages,
+                partition, self.shard_index if self.shard_count > 1 else None, self.partition_stats, remaining
+            )
 
         except (KeyboardInterrupt, TypeError, Exception) as e:
 
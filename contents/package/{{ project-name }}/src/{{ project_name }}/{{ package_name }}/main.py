@@ -1,12 +1,14 @@
+import argparse
+import json
 import os
 import sys
 import logging
 from datetime import datetime
 from .driver import Driver
-from driver_library_{{ org_name }}_{{ solution_name }}.driver_library.utils.core.environment import CheckEnvironment
+from .schedule import date_chunks
+from ..utils.configuration import configure_logging
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(level=logging.INFO)
 
 
 class Constants:
@@ -20,6 +22,46 @@ class Constants:
     configuration_variables = ["max_retries", "page_size", "bucket_location", "tw_backfill_start_date",
                                 "tw_project_id", "tw_topic_id", "tw_download_news"]
 
+    # optional configuration parameters and their defaults
+    optional_configuration_variables = {
+        "tw_metadata_cache_ttl": "3600",  # seconds, project and topic names
+        "tw_credits_cache_ttl": "300",  # seconds, available and required credits
+        "tw_metadata_cache_dir": "./data/cache",
+        "tw_metadata_cache_bucket": "",  # mirror the metadata cache to this bucket when set
+        "tw_field_projection": "",  # comma separated record fields to drop, e.g. tokens_title,news_article_attributes.text
+        "tw_pipeline_concurrency": "",  # threads per stage, e.g. fetch=2,dedupe=4; unlisted stages get 1
+        "tw_pipeline_queue_size": "8",  # item lists waiting in front of each stage
+        "tw_dedupe_window": "0",  # recent item urls remembered to drop repeated items, 0 keeps them all
+        "tw_plan_request_seconds": "1.0",  # expected duration of a results request, for the dry run estimates
+        "tw_plan_schedule": "False",  # fetch only the hours with results in the published date histogram
+        "tw_upstream_max_concurrency": "16",  # adaptive in-flight request cap per host, bounded by the stage threads
+        "tw_upstream_latency_target": "2.0",  # seconds, slower answers lower the limit of their host
+        "tw_circuit_failures": "5",  # consecutive failures that pause a host
+        "tw_circuit_open_seconds": "30",
+        "tw_replay_mode": "off",  # record: archive the api responses, replay: serve them back without network access
+        "tw_replay_archive": "./data/replay/responses.jsonl.gz",
+        "tw_replay_timing": "fast",  # original: replay with the recorded latencies
+        "tw_raw_archive": "False",  # upload the raw result pages next to the output, for reprocess()
+        "tw_reprocess_workers": "0",  # decoding processes of reprocess(), 0 for one per cpu
+        "tw_fetch_engine": "threads",  # threads or asyncio
+        "tw_async_max_in_flight": "200",  # open requests of the asyncio engine
+        "tw_shard_count": "1",  # pods of a sharded pull, when shard_count is not an input
+        "tw_tweet_cache": "False",  # keep hydrated tweets in a local sqlite cache across runs
+        "tw_tweet_cache_path": "./data/cache/tweets.sqlite",
+        "tw_tweet_cache_ttl": "604800",  # seconds, hydrated tweets
+        "tw_tweet_cache_missing_ttl": "86400",  # seconds, ids twitter reported missing, they are not retried
+        "tw_tweet_cache_max_entries": "1000000",
+        "tw_tweet_cache_bucket": "",  # snapshot the cache to this bucket when set
+        "tw_window_order": "oldest",  # oldest, recent or volume (largest first)
+        "tw_run_deadline_seconds": "0",  # seconds from the invocation start, shared by its topics, 0 for none
+        "tw_deadline_margin_seconds": "120",  # kept before the deadline for the upload
+        "tw_page_size_max": "500",  # largest hpp of adaptive page sizes, page_size for fixed pages
+        "tw_page_latency_cap_seconds": "5",  # pages are sized to answer within this
+        "tw_page_bytes_cap": "8388608",  # and to stay under this
+        "tw_upload_skip_unchanged": "True",  # leave out uploads whose object in the bucket has the same ETag
+        "tw_upload_part_size": "8388608",  # multipart part size of the uploads, their ETags depend on it
+    }
+
 
 def parse_date(date_time_value: str) -> str:
 
@@ -59,6 +101,8 @@ def fix_scheduled_inputs(args: dict, env_vars: dict) -> dict:
         args["project_id"] = env_vars["tw_project_id"]
         args["topic_id"] = env_vars["tw_topic_id"]
         args["get_news_links"] = env_vars["tw_download_news"]
+        # scheduled topics come from tw_topic_id, which may be a comma separated list
+        args.pop("topics", None)
 
         logger.info(f"scheduled run - project_id = {args['project_id']} from config map")
         logger.info(f"scheduled run - topic_id = {args['topic_id']} from config map")
@@ -71,6 +115,16 @@ def fix_scheduled_inputs(args: dict, env_vars: dict) -> dict:
     return args
 
 
+def get_optional_env() -> dict:
+    rc = {}
+
+    for key, default in Constants.optional_configuration_variables.items():
+        rc[key] = os.getenv(key, default)
+        logger.info(f"Optional variable {key} = [{rc[key]}] .")
+
+    return rc
+
+
 def get_talkwalker_inputs(args: dict, env_vars: dict) -> dict:
     args_dict = {}
 
@@ -88,37 +142,265 @@ def get_talkwalker_inputs(args: dict, env_vars: dict) -> dict:
     return args_dict
 
 
-def run(args: dict) -> dict:
+def get_topics(args: dict) -> list:
     """
-    Main entry point into talkwalker driver called from Arflow DAG.
-    :param args: args is a dictionary with all inputs needed to run the program
-    :return: return value is a dictionary with oll outputs (s3 location in this case)
+    Topics to pull in this invocation, as a list of (project_id, topic_id) tuples.
+
+    `topics` is either a list of {"project_id": ..., "topic_id": ...} dicts or a comma separated string whose
+    entries are a topic id of `project_id` or a `project_id:topic_id` pair. When `topics` is not supplied,
+    `topic_id` is read the same way, so a comma separated tw_topic_id fans out scheduled runs too.
     """
 
-    logger.info(f"Talkwalker - started.")
+    topics = args.get("topics") or args["topic_id"]
+
+    if isinstance(topics, str):
+        topics = [entry.strip() for entry in topics.split(",") if entry.strip()]
 
-    logger.info(f'input args = {args}')
+    rc = []
+    for entry in topics:
+        if isinstance(entry, dict):
+            project_id, topic_id = entry.get("project_id", args["project_id"]), entry["topic_id"]
+        elif ":" in entry:
+            project_id, topic_id = entry.split(":", 1)
+        else:
+            project_id, topic_id = args["project_id"], entry
+        rc.append((project_id.strip(), topic_id.strip()))
+
+    if not rc:
+        rc.append((args["project_id"], args["topic_id"]))
+
+    logger.info(f"topics = {rc}")
+    return rc
+
+
+def get_run_inputs(args: dict):
+    """Validate the environment and the inputs, returns (all variables, topics)"""
+
+    from driver_library_{{ org_name }}_{{ solution_name }}.driver_library.utils.core.environment import CheckEnvironment
 
     env_vars = CheckEnvironment.get_env(Constants.secret_variables + Constants.configuration_variables)
 
     # logger.info(f'env vars = {env_vars}') # TODO: Display variables without sensitive information only
 
     if not CheckEnvironment.check_keys(Constants.secret_variables + Constants.configuration_variables, env_vars):
-        logger.error(f"Required environment variables for talkwalker are not present.")
+        logger.error("Required environment variables for talkwalker are not present.")
         sys.exit(1)
 
     if not CheckEnvironment.check_keys(Constants.docker_variables, args):
-        logger.error(f"Required variables for talkwalker are not present.")
+        logger.error("Required variables for talkwalker are not present.")
         sys.exit(1)
 
     args_dict = get_talkwalker_inputs(args, env_vars)
 
-    all_vars = {**args_dict, **env_vars}
+    topics = get_topics(args_dict)
+
+    all_vars = {**args_dict, **get_optional_env(), **env_vars}
+
+    # sharded backfills, e.g. a kubernetes indexed job: every pod pulls its own subset of the hours
+    if args_dict.get("shard_index") is None:
+        all_vars["shard_index"] = os.getenv("JOB_COMPLETION_INDEX", "0")
+    if args_dict.get("shard_count") is None:
+        all_vars["shard_count"] = all_vars["tw_shard_count"]
+
+    return all_vars, topics
+
+
+def setup_logging() -> None:
+    """Logging as configured in logging.yaml (json lines, sampled, written by a background thread), set up once"""
+    try:
+        configure_logging()
+    except FileNotFoundError:
+        # e.g. a local run from outside of the project
+        logging.basicConfig(level=logging.INFO)
+
+
+def run(args: dict) -> dict:
+    """
+    Main entry point into talkwalker driver called from Arflow DAG.
+    :param args: args is a dictionary with all inputs needed to run the program
+    :return: return value is a dictionary with oll outputs (s3 location in this case)
+    """
+
+    setup_logging()
+
+    logger.info("Talkwalker - started.")
+
+    logger.info('input args = %s', args)
+
+    all_vars, topics = get_run_inputs(args)
 
     driver = Driver()
 
-    rc = driver.run(all_vars)
+    # a dry run only plans the pull, from the published date histogram of each topic
+    if str(args.get("dry_run", False)).casefold() == "True".casefold():
+        rc = driver.plan_topics(all_vars, topics)
+        logger.info("Talkwalker - dry run completed.")
+        return rc
+
+    outputs = driver.run_topics(all_vars, topics)
+
+    # a single topic keeps the original output, fan-out runs return one output per topic
+    rc = outputs[0] if len(outputs) == 1 else {"talkwalker_outputs": outputs}
 
-    logger.info(f"Talkwalker - completed.")
+    logger.info("Talkwalker - completed.")
 
     return rc
+
+
+def finalize(args: dict) -> dict:
+    """
+    Combine the shard xcoms of a sharded pull into its xcom, run once after all the shards of run() completed.
+    :param args: the same inputs as the shards, shard_count included
+    :return: the combined xcom, like run()
+    """
+
+    setup_logging()
+
+    logger.info("Talkwalker finalize - started.")
+
+    all_vars, topics = get_run_inputs(args)
+
+    outputs = Driver().finalize_topics(all_vars, topics)
+    rc = outputs[0] if len(outputs) == 1 else {"talkwalker_outputs": outputs}
+
+    logger.info("Talkwalker finalize - completed.")
+
+    return rc
+
+
+def reprocess(args: dict) -> dict:
+    """
+    Rebuild the output and the xcom of an earlier run from its raw page archive, without calling talkwalker.
+    :param args: {"raw_pages": s3 uri of the pages_{n}.jsonl.gz archive, listed as raw_pages in the run's xcom}
+    :return: the new xcom
+    """
+
+    from driver_library_{{ org_name }}_{{ solution_name }}.driver_library.utils.core.environment import CheckEnvironment
+
+    setup_logging()
+
+    logger.info("Talkwalker reprocess - started.")
+
+    logger.info('input args = %s', args)
+
+    env_vars = CheckEnvironment.get_env(Constants.configuration_variables)
+
+    if not CheckEnvironment.check_keys(Constants.configuration_variables, env_vars):
+        logger.error("Required environment variables for talkwalker are not present.")
+        sys.exit(1)
+
+    if not args.get("raw_pages"):
+        logger.error("raw_pages is missing.")
+        sys.exit(1)
+
+    rc = Driver().reprocess({**get_optional_env(), **env_vars}, args["raw_pages"])
+
+    logger.info("Talkwalker reprocess - completed.")
+
+    return rc
+
+
+def backfill(args: dict, chunk: str = "week", workers: int = 1) -> dict:
+    """
+    Pull the date range of args in chunks, all in this process: the http session, caches and S3 client are
+    shared by the chunks instead of starting a pod per date range. Every chunk is published on its own, under
+    its from_date_to_date prefix with its own xcom.
+    :param args: the same inputs as run(), from_date and to_date are the range of the whole backfill
+    :param chunk: "day", "week", "month" or a number of days, see schedule.date_chunks()
+    :param workers: chunks pulled concurrently
+    :return: the outputs of every chunk, in date order
+    """
+
+    setup_logging()
+
+    logger.info("Talkwalker backfill - started.")
+
+    logger.info('input args = %s', args)
+
+    all_vars, topics = get_run_inputs(args)
+
+    try:
+        chunks = date_chunks(all_vars["from_date"], all_vars["to_date"], chunk)
+    except ValueError as e:
+        logger.error(f"{e}")
+        sys.exit(1)
+
+    outputs = Driver().run_backfill(all_vars, topics, chunks, max(1, workers))
+    rc = {
+        "talkwalker_backfill": [
+            {"from_date": from_date, "to_date": to_date, "talkwalker_outputs": chunk_outputs}
+            for (from_date, to_date), chunk_outputs in zip(chunks, outputs)
+        ]
+    }
+
+    logger.info("Talkwalker backfill - completed.")
+
+    return rc
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog="main", description="Talkwalker driver")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    inputs = argparse.ArgumentParser(add_help=False)
+    inputs.add_argument("--args", type=json.loads, default={}, help="inputs as a json object, e.g. a DAG run conf")
+    inputs.add_argument("--project-id")
+    inputs.add_argument("--topic-id")
+    inputs.add_argument("--topics", help="comma separated topic ids or project_id:topic_id pairs")
+    inputs.add_argument("--from-date")
+    inputs.add_argument("--to-date")
+    inputs.add_argument("--task-id")
+    inputs.add_argument("--get-news-links", choices=["True", "False"])
+    inputs.add_argument("--scheduled", action="store_true", default=None, help="take the topic from the config map")
+
+    run_command = commands.add_parser("run", parents=[inputs], help="pull the topics")
+    run_command.add_argument("--dry-run", action="store_true", help="only plan the pull")
+    commands.add_parser("finalize", parents=[inputs], help="combine the shard xcoms of a sharded pull")
+    reprocess_command = commands.add_parser("reprocess", help="rebuild an output from its raw page archive")
+    reprocess_command.add_argument("--raw-pages", required=True, help="s3 uri listed as raw_pages in the xcom")
+    backfill_command = commands.add_parser("backfill", parents=[inputs], help="pull a date range in chunks")
+    backfill_command.add_argument("--chunk", default="week", help="day, week, month or a number of days")
+    backfill_command.add_argument("--workers", type=int, default=1, help="chunks pulled concurrently")
+
+    return parser.parse_args(argv)
+
+
+def get_cli_inputs(options: argparse.Namespace) -> dict:
+    """Inputs of run() from the command line, the options override --args"""
+
+    args = {
+        "project_id": "", "task_id": "cli", "get_news_links": "False", "scheduled": False, **options.args,
+    }
+    for key in ("project_id", "topic_id", "topics", "from_date", "to_date", "task_id", "get_news_links", "scheduled"):
+        value = getattr(options, key)
+        if value is not None:
+            args[key] = value
+    if args.get("topics") and not args.get("topic_id"):
+        args["topic_id"] = args["topics"]
+    return args
+
+
+def main(argv=None) -> int:
+    """
+    Command line entry point, the main script of pyproject.toml, prints the output of the command as json
+        main run --topic-id <topic> --from-date 2024-01-01 --to-date 2024-01-07
+        main backfill --topic-id <topic> --from-date 2024-01-01 --to-date 2024-03-31 --chunk week --workers 2
+    """
+
+    options = parse_args(argv)
+
+    if options.command == "reprocess":
+        rc = reprocess({"raw_pages": options.raw_pages})
+    elif options.command == "finalize":
+        rc = finalize(get_cli_inputs(options))
+    elif options.command == "backfill":
+        rc = backfill(get_cli_inputs(options), options.chunk, options.workers)
+    else:
+        rc = run({**get_cli_inputs(options), "dry_run": options.dry_run})
+
+    print(json.dumps(rc, indent=2, default=str))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
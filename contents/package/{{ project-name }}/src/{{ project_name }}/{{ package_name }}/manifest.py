@@ -0,0 +1,173 @@
+import hashlib
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# multipart_threshold and multipart_chunksize of boto3's default TransferConfig
+MULTIPART_PART_SIZE = 8 * 2 ** 20
+
+
+class ETagDigest:
+    """
+    md5 of a file, and the ETag s3 reports for it after a multipart upload in parts of part_size bytes: the md5
+    of the concatenated md5 of the parts, followed by -<number of parts>. Fed incrementally while the file is
+    written, so it never has to be read again to tell whether the object in the bucket holds the same bytes.
+    """
+
+    def __init__(self, part_size: int = MULTIPART_PART_SIZE):
+        self.part_size = part_size
+        self.bytes = 0
+        self._md5 = hashlib.md5()
+        self._part = hashlib.md5()
+        self._part_bytes = 0
+        self._parts = []  # digests of the complete parts
+
+    def update(self, data: bytes) -> None:
+        self._md5.update(data)
+        self.bytes += len(data)
+        view = memoryview(data)
+        while view:
+            n = min(len(view), self.part_size - self._part_bytes)
+            self._part.update(view[:n])
+            self._part_bytes += n
+            view = view[n:]
+            if self._part_bytes == self.part_size:
+                self._parts.append(self._part.digest())
+                self._part = hashlib.md5()
+                self._part_bytes = 0
+
+    @classmethod
+    def from_file(cls, path: str, part_size: int = MULTIPART_PART_SIZE) -> "ETagDigest":
+        digest = cls(part_size)
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(2 ** 20), b""):
+                digest.update(block)
+        return digest
+
+    @property
+    def md5(self) -> str:
+        return self._md5.hexdigest()
+
+    @property
+    def multipart_etag(self) -> str:
+        parts = self._parts + ([self._part.digest()] if self._part_bytes else [])
+        return f"{hashlib.md5(b''.join(parts)).hexdigest()}-{len(parts)}"
+
+    def matches(self, etag: str) -> bool:
+        """
+        Whether an s3 ETag is the one of these bytes. ETags of objects encrypted with SSE-KMS or uploaded in
+        parts of another size never match, those objects are uploaded again.
+        """
+        etag = (etag or "").strip('"')
+        return etag == (self.multipart_etag if "-" in etag else self.md5)
+
+
+class UploadStats:
+    """Files and bytes uploaded, and left out because the bucket already had them. Safe to share between threads."""
+
+    def __init__(self):
+        self.uploaded_files = 0
+        self.uploaded_bytes = 0
+        self.skipped_files = 0
+        self.skipped_bytes = 0
+        self._lock = threading.Lock()
+
+    def uploaded(self, size: int) -> None:
+        with self._lock:
+            self.uploaded_files += 1
+            self.uploaded_bytes += size
+
+    def skipped(self, size: int) -> None:
+        with self._lock:
+            self.skipped_files += 1
+            self.skipped_bytes += size
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                "uploaded_files": self.uploaded_files,
+                "uploaded_bytes": self.uploaded_bytes,
+                "skipped_files": self.skipped_files,
+                "skipped_bytes": self.skipped_bytes,
+            }
+
+
+class PartitionStats:
+    """
+    Record count, byte size, published range and md5 of one output partition, accumulated while the file is
+    written so the output never has to be read again. The md5 is the ETag s3 reports for a single part upload,
+    digest also has the one of a multipart upload.
+    """
+
+    def __init__(self, partition: int, part_size: int = MULTIPART_PART_SIZE):
+        self.partition = partition
+        self.records = 0
+        self.bytes = 0
+        self.min_published = None
+        self.max_published = None
+        self.digest = ETagDigest(part_size)
+
+    def add(self, data: bytes, records: int, published=()) -> None:
+        """
+        :param data: bytes appended to the partition file
+        :param records: number of records in data
+        :param published: published epochs of the records, 0 (missing) and -1 (invalid) are left out of the range
+        """
+        self.digest.update(data)
+        self.bytes += len(data)
+        self.records += records
+        published = [epoch for epoch in published if epoch is not None and epoch > 0]
+        if published:
+            low, high = min(published), max(published)
+            self.min_published = low if self.min_published is None else min(self.min_published, low)
+            self.max_published = high if self.max_published is None else max(self.max_published, high)
+
+    @classmethod
+    def from_file(cls, path: str, partition: int, part_size: int = MULTIPART_PART_SIZE) -> "PartitionStats":
+        """Stats of an existing output file, for outputs that were not written through add()"""
+        stats = cls(partition, part_size)
+        with open(path, "rb") as f:
+            for line in f:
+                published = json.loads(line).get("published") if line.strip() else None
+                stats.add(line, 1 if line.strip() else 0, [published] if isinstance(published, int) else ())
+        return stats
+
+    @property
+    def md5(self) -> str:
+        return self.digest.md5
+
+    def to_dict(self) -> dict:
+        return {
+            "partition": self.partition,
+            "records": self.records,
+            "bytes": self.bytes,
+            "min_published": self.min_published,
+            "max_published": self.max_published,
+            "md5": self.md5,
+        }
+
+
+def build_manifest(xcom: dict, partitions: list) -> dict:
+    """
+    Manifest of a pull: the identity of the pull from its xcom and one entry per partition, in partition order
+    :param partitions: PartitionStats.to_dict() of every partition, with the s3 uri of its file under "output"
+    """
+
+    partitions = sorted(partitions, key=lambda p: p["partition"])
+    published = [p[key] for p in partitions for key in ("min_published", "max_published") if p[key] is not None]
+    return {
+        "query_hash": xcom["query_hash"],
+        "project_id": xcom["project_id"],
+        "topic_id": xcom["topic_id"],
+        "from_date": xcom["from_date"],
+        "to_date": xcom["to_date"],
+        "created_at": int(time.time()),
+        "records": sum(p["records"] for p in partitions),
+        "bytes": sum(p["bytes"] for p in partitions),
+        "min_published": min(published) if published else None,
+        "max_published": max(published) if published else None,
+        "partitions": partitions,
+    }
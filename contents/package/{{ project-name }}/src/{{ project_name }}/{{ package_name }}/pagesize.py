@@ -0,0 +1,93 @@
+import logging
+import math
+import threading
+
+logger = logging.getLogger(__name__)
+
+# largest hpp the search results api accepts
+API_MAX_PAGE_SIZE = 500
+
+
+class PageSizer:
+    """
+    Chooses the hpp of the pages of the search windows.
+
+    Response latency and size per item are tracked as moving averages over every page fetched. They cap hpp
+    so that a page is expected to answer within latency_cap seconds and to stay under bytes_cap bytes; the
+    per item latency includes the fixed cost of a request, so the cap is conservative for small pages. The
+    first page of a window is fetched at the cap (initial until a page was observed), the following ones
+    split what pagination.total says is left into as few pages of equal size as the cap allows, so a window
+    never ends with a nearly empty page. With maximum equal to initial every page is fetched at initial.
+    Safe to share between threads.
+    """
+
+    def __init__(
+            self, initial: int = 100, maximum: int = API_MAX_PAGE_SIZE, minimum: int = 10,
+            latency_cap: float = 5.0, bytes_cap: int = 8 * 2 ** 20, smoothing: float = 0.3
+    ):
+        self.initial = int(initial)
+        self.maximum = max(min(int(maximum), API_MAX_PAGE_SIZE), self.initial)
+        self.minimum = min(int(minimum), self.initial)
+        self.latency_cap = latency_cap
+        self.bytes_cap = bytes_cap
+        self.smoothing = smoothing
+
+        self.seconds_per_item = None
+        self.bytes_per_item = None
+        self.pages = 0
+        self.items = 0
+        self._lock = threading.Lock()
+
+    @property
+    def adaptive(self) -> bool:
+        return self.maximum > self.initial
+
+    def observe(self, items: int, seconds: float, size: int) -> None:
+        """Record the latency and size of a page of items"""
+        if items <= 0:
+            return
+        with self._lock:
+            self.pages += 1
+            self.items += items
+            if self.seconds_per_item is None:
+                self.seconds_per_item = seconds / items
+                self.bytes_per_item = size / items
+            else:
+                a = self.smoothing
+                self.seconds_per_item += a * (seconds / items - self.seconds_per_item)
+                self.bytes_per_item += a * (size / items - self.bytes_per_item)
+
+    def cap(self) -> int:
+        """Largest hpp expected to answer within latency_cap and bytes_cap"""
+        with self._lock:
+            if self.seconds_per_item is None:
+                return self.initial
+            rc = self.maximum
+            if self.seconds_per_item > 0:
+                rc = min(rc, int(self.latency_cap / self.seconds_per_item))
+            if self.bytes_per_item > 0:
+                rc = min(rc, int(self.bytes_cap / self.bytes_per_item))
+        return max(rc, self.minimum)
+
+    def next_size(self, total=None, fetched: int = 0) -> int:
+        """
+        hpp of the next page of a window
+        :param total: pagination.total of the window, None before its first page
+        :param fetched: items of the window fetched so far
+        """
+        if not self.adaptive:
+            return self.initial
+        cap = self.cap()
+        if total is None or total - fetched <= 0:
+            return cap
+        left = total - fetched
+        return math.ceil(left / math.ceil(left / cap))
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                "pages": self.pages,
+                "items_per_page": round(self.items / self.pages, 1) if self.pages else None,
+                "ms_per_item": round(self.seconds_per_item * 1000, 2) if self.seconds_per_item is not None else None,
+                "bytes_per_item": round(self.bytes_per_item) if self.bytes_per_item is not None else None,
+            }
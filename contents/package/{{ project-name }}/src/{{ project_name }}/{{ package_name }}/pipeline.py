@@ -0,0 +1,223 @@
+import logging
+import queue
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# end of stream marker, every worker of a stage receives one
+_DONE = object()
+
+
+class PipelineStopped(Exception):
+    """Raised inside workers blocked on a queue once another stage has failed"""
+
+
+class Stage:
+    """
+    One step of a Pipeline.
+
+    process(item) is called by each of the concurrency worker threads and returns an iterable of outputs
+    for the next stage (None for no output). flush(), when given, is called once after every worker of the
+    stage is done, for stages that hold items back (e.g. batching); its outputs go downstream as well.
+    """
+
+    def __init__(self, name: str, process, concurrency: int = 1, flush=None):
+        if concurrency < 1:
+            raise ValueError(f"stage {name}: concurrency must be at least 1, got {concurrency}")
+        self.name = name
+        self.process = process
+        self.concurrency = concurrency
+        self.flush = flush
+        self.processed = 0
+
+
+class Pipeline:
+    """
+    Stages connected by bounded queues, each stage runs in its own pool of threads.
+
+    A stage blocks when the queue of the next stage is full, so a slow stage throttles the stages in front of
+    it instead of letting items pile up in memory: at most queue_size items wait in front of each stage.
+    The sink is called in the thread that runs the pipeline. The first exception raised by a stage or by the
+    sink stops all the workers and is raised again by run().
+    """
+
+    def __init__(self, stages: list, queue_size: int = 8):
+        if queue_size < 1:
+            raise ValueError(f"queue size must be at least 1, got {queue_size}")
+        self.stages = stages
+        self.queue_size = queue_size
+        self._queues = []
+        self._stop = threading.Event()
+        self._error = None
+        self._lock = threading.Lock()
+
+    def queue_depths(self) -> dict:
+        """Number of items waiting in front of each stage and of the sink"""
+        names = [stage.name for stage in self.stages] + ["sink"]
+        return {name: q.qsize() for name, q in zip(names, self._queues)}
+
+    def stats(self) -> dict:
+        return {
+            "queue_depths": self.queue_depths(),
+            "processed": {stage.name: stage.processed for stage in self.stages},
+        }
+
+    def _put(self, q: queue.Queue, item) -> None:
+        while True:
+            if self._stop.is_set():
+                raise PipelineStopped()
+            try:
+                q.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def _get(self, q: queue.Queue):
+        while True:
+            if self._stop.is_set():
+                raise PipelineStopped()
+            try:
+                return q.get(timeout=0.5)
+            except queue.Empty:
+                continue
+
+    def _fail(self, e: Exception) -> None:
+        with self._lock:
+            if self._error is None:
+                self._error = e
+        self._stop.set()
+
+    def _feed(self, inputs) -> None:
+        try:
+            for item in inputs:
+                self._put(self._queues[0], item)
+            for _ in range(self.stages[0].concurrency):
+                self._put(self._queues[0], _DONE)
+        except PipelineStopped:
+            pass
+        except Exception as e:
+            logger.exception(f"pipeline input failed: {e}")
+            self._fail(e)
+
+    def _work(self, index: int, remaining: list) -> None:
+        stage = self.stages[index]
+        q_in, q_out = self._queues[index], self._queues[index + 1]
+        try:
+            while True:
+                item = self._get(q_in)
+                if item is _DONE:
+                    break
+                for output in stage.process(item) or ():
+                    self._put(q_out, output)
+                with self._lock:
+                    stage.processed += 1
+
+            with self._lock:
+                remaining[index] -= 1
+                last = remaining[index] == 0
+
+            # the last worker out flushes the stage and tells the next one that its input is complete
+            if last:
+                if stage.flush is not None:
+                    for output in stage.flush() or ():
+                        self._put(q_out, output)
+                downstream = self.stages[index + 1].concurrency if index + 1 < len(self.stages) else 1
+                for _ in range(downstream):
+                    self._put(q_out, _DONE)
+        except PipelineStopped:
+            pass
+        except Exception as e:
+            logger.exception(f"pipeline stage {stage.name} failed: {e}")
+            self._fail(e)
+
+    def run(self, inputs, sink) -> None:
+        """
+        Push inputs through the stages and call sink(output) for every output of the last stage
+        :param inputs: iterable of items for the first stage, consumed lazily in a feeder thread
+        :param sink: callable, runs in the calling thread
+        """
+
+        self._stop.clear()
+        self._error = None
+        self._queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        remaining = [stage.concurrency for stage in self.stages]
+
+        threads = [threading.Thread(target=self._feed, args=(inputs,), name="pipeline-input", daemon=True)]
+        for index, stage in enumerate(self.stages):
+            for n in range(stage.concurrency):
+                threads.append(
+                    threading.Thread(
+                        target=self._work, args=(index, remaining), name=f"pipeline-{stage.name}-{n}", daemon=True
+                    )
+                )
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                output = self._get(self._queues[-1])
+                if output is _DONE:
+                    break
+                sink(output)
+        except PipelineStopped:
+            pass
+        except BaseException as e:
+            self._fail(e)
+            raise
+        finally:
+            # a failed stage or sink stops the others, they give up on their queues within a timeout
+            if self._error is not None:
+                self._stop.set()
+            for thread in threads:
+                thread.join()
+
+        if self._error is not None:
+            raise self._error
+
+
+def parse_concurrency(spec: str, stage_names) -> dict:
+    """
+    Parse the tw_pipeline_concurrency setting, e.g. "fetch=2,format=4"; stages not listed get 1 worker
+    :raises ValueError: for unknown stage names and for counts below 1
+    """
+
+    rc = {name: 1 for name in stage_names}
+    for entry in (spec or "").split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        name, _, count = entry.partition("=")
+        name = name.strip()
+        if name not in rc:
+            raise ValueError(f"unknown pipeline stage {name}, expected one of {', '.join(rc)}")
+        rc[name] = int(count)
+        if rc[name] < 1:
+            raise ValueError(f"pipeline stage {name}: concurrency must be at least 1, got {rc[name]}")
+    return rc
+
+
+class RecentKeys:
+    """
+    Bounded set of the most recently seen keys, for dropping repeated items without keeping every key
+    of a run in memory. With a maxsize of 0 no key is remembered and every key is new. Safe to share between
+    threads.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, key) -> bool:
+        """Remember key, returns False when it was already seen"""
+        if self.maxsize <= 0:
+            return True
+        with self._lock:
+            if key in self._keys:
+                self._keys.move_to_end(key)
+                return False
+            self._keys[key] = None
+            if len(self._keys) > self.maxsize:
+                self._keys.popitem(last=False)
+            return True
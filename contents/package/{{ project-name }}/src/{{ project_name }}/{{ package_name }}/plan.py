@@ -0,0 +1,158 @@
+import logging
+import math
+from bisect import bisect_left
+from dataclasses import dataclass, field
+from typing import List
+from .credits import retry_request
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class WindowPlan:
+    """Expected volume of one 1 hour search window"""
+
+    start: int
+    end: int
+    label: str
+    items: int
+    requests: int
+
+
+@dataclass
+class VolumePlan:
+    """
+    Per hour volume of a topic over the requested date range, from the published date histogram.
+
+    Estimates the requests, credits and runtime of a pull without fetching any results. The fetcher can
+    use schedule() to skip empty windows and start with the largest ones.
+    """
+
+    project_id: str
+    topic_id: str
+    from_date: str
+    to_date: str
+    page_size: int
+    min_interval: float  # seconds between requests, from the shared rate limiter
+    request_seconds: float  # expected duration of a results request
+    fetch_concurrency: int = 1
+    windows: List[WindowPlan] = field(default_factory=list)
+
+    @property
+    def total_items(self) -> int:
+        return sum(window.items for window in self.windows)
+
+    @property
+    def total_requests(self) -> int:
+        return sum(window.requests for window in self.windows)
+
+    @property
+    def estimated_credits(self) -> int:
+        # every retrieved result costs one credit
+        return self.total_items
+
+    @property
+    def estimated_seconds(self) -> float:
+        # parallel fetch workers overlap their requests, the rate limiter still spaces all of them
+        fetching = self.total_requests * max(self.request_seconds, self.min_interval)
+        return max(fetching / self.fetch_concurrency, self.total_requests * self.min_interval)
+
+    def schedule(self, shard_index: int = 0, shard_count: int = 1) -> list:
+        """(start, end, label) of the windows with results, largest first, of one shard like get_windows()"""
+        windows = sorted(
+            (window for n, window in enumerate(self.windows) if window.items and n % shard_count == shard_index),
+            key=lambda w: w.items, reverse=True
+        )
+        return [(window.start, window.end, window.label) for window in windows]
+
+    def summary(self) -> dict:
+        return {
+            "project_id": self.project_id,
+            "topic_id": self.topic_id,
+            "from_date": self.from_date,
+            "to_date": self.to_date,
+            "windows": len(self.windows),
+            "empty_windows": sum(1 for window in self.windows if not window.items),
+            "estimated_items": self.total_items,
+            "estimated_requests": self.total_requests,
+            "estimated_credits": self.estimated_credits,
+            "estimated_seconds": round(self.estimated_seconds, 1),
+        }
+
+    def to_dict(self) -> dict:
+        return {
+            **self.summary(),
+            "hours": [
+                {"start": window.start, "label": window.label, "items": window.items, "requests": window.requests}
+                for window in self.windows
+            ],
+        }
+
+
+def get_published_histogram(api_token, project_id, topic_id, start, end, session=None):
+    """
+    Number of results of the topic published in every hour of [start, end)
+    :return: dict of hour start (epoch seconds) -> count, None when the histogram is not available
+    """
+
+    endpoint = f"search/p/{project_id}/histogram/published"
+    params = {
+        "interval": "hour",
+        "timezone": "UTC",
+        "topic": topic_id,
+        "q": f"(published:>={start} AND published:<{end})",
+        "access_token": api_token,
+    }
+    response = retry_request(endpoint, params, session=session)
+
+    if not response or response.get("result_error") or "result_histogram" not in response:
+        logger.error(f"published histogram not available for topic {topic_id}: {response}")
+        return None
+
+    rc = {}
+    for bucket in response["result_histogram"].get("data", []):
+        t = bucket["t"]
+        t = t // 1000 if t > 10 ** 11 else t  # bucket times are in milliseconds
+        rc[t - t % 3600] = rc.get(t - t % 3600, 0) + (bucket["v"][0] if bucket.get("v") else 0)
+    return rc
+
+
+def build_plan(source, min_interval: float, request_seconds: float = 1.0, fetch_concurrency: int = 1, session=None):
+    """
+    Volume plan of the date range and topic of a TalkwalkerSource
+    :return: the VolumePlan, None when the histogram is not available
+    """
+
+    windows = list(source.get_windows())
+    if not windows:
+        return None
+
+    histogram = get_published_histogram(
+        source.access_token, source.project_id, source.topic_id, windows[0][0], windows[-1][1], session
+    )
+    if histogram is None:
+        return None
+
+    page_size = int(source.page_size)
+    plan = VolumePlan(
+        project_id=source.project_id,
+        topic_id=source.topic_id,
+        from_date=source.start_date,
+        to_date=source.end_date,
+        page_size=page_size,
+        min_interval=min_interval,
+        request_seconds=request_seconds,
+        fetch_concurrency=fetch_concurrency,
+    )
+    # running totals of the hours in order, the items of a window are the difference at its two ends
+    hours = sorted(histogram)
+    totals = [0]
+    for hour in hours:
+        totals.append(totals[-1] + histogram[hour])
+    for start, end, label in windows:
+        items = totals[bisect_left(hours, end)] - totals[bisect_left(hours, start)]
+        # an empty window still costs the request that finds it empty
+        plan.windows.append(WindowPlan(start, end, label, items, max(1, math.ceil(items / page_size))))
+
+    logger.info(f"volume plan = {plan.summary()}")
+    return plan
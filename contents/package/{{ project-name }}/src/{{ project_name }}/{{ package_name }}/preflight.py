@@ -0,0 +1,118 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass, field, asdict
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PreflightReport:
+    """Outcome of the checks made before a topic is pulled"""
+
+    project_id: str
+    topic_id: str
+    s3_authenticated: bool = False
+    project_name: Optional[str] = None
+    topic_name: Optional[str] = None
+    solution_name: Optional[str] = None
+    available_credits: Optional[int] = None
+    required_credits: Optional[int] = None
+    elapsed: float = 0.0
+    errors: List[str] = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return not self.errors
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+class PreflightError(Exception):
+    """Raised on the first fatal preflight result, carries the (partial) report"""
+
+    def __init__(self, report: PreflightReport):
+        super().__init__("; ".join(report.errors))
+        self.report = report
+
+
+def run_preflight(driver, project_id: str, topic_id: str, max_workers: int = 5) -> PreflightReport:
+    """
+    Run S3 authentication, project and topic validation and the two credit lookups concurrently.
+    None of them depend on each other, so startup latency is the slowest check instead of their sum.
+    :param driver: Driver with setup() done and talk_walker created for the topic
+    :return: the report, with all fields filled in
+    :raises PreflightError: as soon as one check fails, without waiting for the others
+    """
+
+    report = PreflightReport(project_id=project_id, topic_id=topic_id)
+    start = time.monotonic()
+
+    checks = {
+        "project": lambda: driver.get_project_name(project_id),
+        "topic": lambda: driver.get_topic_names(project_id, topic_id),
+        "available_credits": driver.get_available_credits,
+        "required_credits": lambda: driver.get_required_credits(topic_id, project_id),
+    }
+    if driver.object_storage is None:
+        checks["s3"] = driver.connect_s3
+    else:
+        report.s3_authenticated = True
+
+    executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="preflight")
+    try:
+        futures = {executor.submit(check): name for name, check in checks.items()}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                _apply(report, name, future.result())
+            except KeyError:
+                report.errors.append(f"invalid {name} id: {project_id if name == 'project' else topic_id}")
+            except Exception as e:
+                report.errors.append(f"{name} check failed: {e}")
+
+            if not report.errors and report.available_credits is not None and report.required_credits is not None:
+                _check_credits(report)
+
+            if report.errors:
+                # fail fast, the remaining lookups are not needed any more
+                report.elapsed = time.monotonic() - start
+                raise PreflightError(report)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    report.elapsed = time.monotonic() - start
+    logger.info(f"preflight for topic {topic_id} completed in {report.elapsed:.2f}s")
+    return report
+
+
+def _check_credits(report: PreflightReport) -> None:
+    """A topic without items cannot be pulled, nor one with more items than the credits left"""
+    if not 0 < report.required_credits <= report.available_credits:
+        report.errors.append(
+            f"Not enough credits available for: {report.topic_id}. "
+            f"Available credits: {report.available_credits}, required credits: {report.required_credits}"
+        )
+
+
+def _apply(report: PreflightReport, name: str, value) -> None:
+    if name == "s3":
+        report.s3_authenticated = value
+        if not value:
+            report.errors.append("AWS Credentials are missing.")
+    elif name == "project":
+        report.project_name = value
+    elif name == "topic":
+        report.topic_name, report.solution_name = value
+    elif name == "available_credits":
+        report.available_credits = value
+        if value is None:
+            report.errors.append("could not retrieve the available credits")
+    elif name == "required_credits":
+        report.required_credits = value
+        if value is None:
+            report.errors.append("could not retrieve the number of items of the topic")
+        elif value == -1:
+            report.errors.append(f"invalid topic id: {report.topic_id}")
@@ -0,0 +1,54 @@
+class FieldProjection:
+    """
+    Record fields dropped for a deployment, configured in the configmap as tw_field_projection.
+
+    The spec is a comma separated list of dotted field paths, e.g.
+    "tokens_title,tokens_content,matched_profile,news_article_attributes.text". Dropped fields are skipped
+    when items are formatted, so they are never copied out of the API response, and they are left out of
+    the output records.
+    """
+
+    def __init__(self, dropped=frozenset(), nested=None):
+        self.dropped = frozenset(dropped)
+        self.nested = nested or {}  # field -> FieldProjection of its sub fields
+
+    @classmethod
+    def parse(cls, spec: str) -> "FieldProjection":
+        dropped = set()
+        nested = {}
+        for path in (spec or "").split(","):
+            path = path.strip()
+            if not path:
+                continue
+            head, _, rest = path.partition(".")
+            if rest:
+                nested.setdefault(head, []).append(rest)
+            else:
+                dropped.add(head)
+
+        return cls(
+            dropped,
+            {name: cls.parse(",".join(paths)) for name, paths in nested.items() if name not in dropped},
+        )
+
+    def __bool__(self) -> bool:
+        return bool(self.dropped or self.nested)
+
+    def __str__(self) -> str:
+        """Canonical spec, equal projections have equal strings"""
+        paths = sorted(self.dropped)
+        for name in sorted(self.nested):
+            paths.extend(f"{name}.{path}" for path in str(self.nested[name]).split(","))
+        return ",".join(paths)
+
+    def child(self, name: str):
+        """Projection of the sub fields of name, None when they are all kept"""
+        return self.nested.get(name)
+
+    def to_exclude(self) -> dict:
+        """The projection as a pydantic exclude argument, e.g. for TalkwalkerRecord.model_dump_json()"""
+        rc = {name: True for name in self.dropped}
+        for name, projection in self.nested.items():
+            # "__all__" applies the exclusion to every element of list fields, it is ignored by model fields
+            rc[name] = {"__all__": projection.to_exclude(), **projection.to_exclude()}
+        return rc
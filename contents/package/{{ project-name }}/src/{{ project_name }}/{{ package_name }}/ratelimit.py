@@ -0,0 +1,29 @@
+import threading
+import time
+
+
+class RateLimiter:
+    """
+    Minimum-interval rate limiter shared by every Talkwalker call made in the process.
+
+    Topics fanned out from a single driver invocation go through the same limiter, so running
+    several topics in one pod does not multiply the request rate seen by the API.
+    """
+
+    def __init__(self, min_interval: float = 0.1):
+        self.min_interval = min_interval
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """Reserve the next request slot and return how long the caller has to wait for it"""
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.min_interval
+            return slot - now
+
+    def wait(self) -> None:
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
@@ -0,0 +1,149 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from urllib.parse import parse_qsl, urlsplit, urlunsplit
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# never part of a request key, archives must not depend on (or leak) the credentials of the recording run
+SECRET_PARAMS = frozenset(["access_token"])
+
+
+def request_key(method: str, url: str, params=None) -> str:
+    """Key of a request: method, url and the query and params without the access token, in a stable order"""
+    parts = urlsplit(url)
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k not in SECRET_PARAMS]
+    query += [(str(k), str(v)) for k, v in (params or {}).items() if k not in SECRET_PARAMS]
+    base = urlunsplit((parts.scheme, parts.netloc, parts.path, "", ""))
+    return hashlib.sha1(json.dumps([method.upper(), base, sorted(query)]).encode()).hexdigest()
+
+
+class ResponseArchive:
+    """
+    Gzip compressed json lines archive of raw responses, keyed by request_key().
+
+    In "record" mode every response is appended, with its status and latency. In "replay" mode the whole
+    archive is loaded and responses are served back in the order they were recorded for their key, the last
+    one is repeated when a key is requested more often than it was recorded. timing "original" sleeps the
+    recorded latency before serving a response, "fast" serves them at once.
+    """
+
+    def __init__(self, path: str, mode: str, timing: str = "fast"):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"unknown replay mode {mode}, expected record or replay")
+        if timing not in ("original", "fast"):
+            raise ValueError(f"unknown replay timing {timing}, expected original or fast")
+
+        self.path = path
+        self.mode = mode
+        self.timing = timing
+        self.recorded = 0
+        self.served = 0
+        self.missed = 0
+        self._lock = threading.Lock()
+        self._file = None
+        self._entries = {}  # key -> list of entries
+        self._next = {}  # key -> index of the next entry to serve
+
+        if mode == "record":
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            # appends a new gzip member, earlier recordings stay readable
+            self._file = gzip.open(path, "at", encoding="utf-8")
+        else:
+            self._load()
+
+    @property
+    def replaying(self) -> bool:
+        return self.mode == "replay"
+
+    def _load(self) -> None:
+        with gzip.open(self.path, "rt", encoding="utf-8") as f:
+            for line in f:
+                entry = json.loads(line)
+                self._entries.setdefault(entry["key"], []).append(entry)
+        logger.info(f"replay archive {self.path} - {sum(map(len, self._entries.values()))} responses loaded")
+
+    def record(self, key: str, status: int, body, elapsed: float) -> None:
+        """
+        :param body: bytes of an http response, or any json value (e.g. the result of a twitter lookup)
+        """
+        if isinstance(body, bytes):
+            entry = {"key": key, "status": status, "elapsed": elapsed, "text": body.decode("utf-8", "surrogateescape")}
+        else:
+            entry = {"key": key, "status": status, "elapsed": elapsed, "json": body}
+        line = json.dumps(entry) + "\n"
+
+        with self._lock:
+            self._file.write(line)
+            # a sync flush keeps the archive readable if the run is killed
+            self._file.flush()
+            self.recorded += 1
+
+    def replay(self, key: str):
+        """The next recorded entry of key, None when the request was never recorded"""
+        with self._lock:
+            entries = self._entries.get(key)
+            if not entries:
+                self.missed += 1
+                return None
+            index = self._next.get(key, 0)
+            self._next[key] = index + 1
+            entry = entries[min(index, len(entries) - 1)]
+            self.served += 1
+
+        if self.timing == "original":
+            time.sleep(entry["elapsed"])
+        return entry
+
+    @staticmethod
+    def body(entry):
+        """Body of an entry, as recorded"""
+        if "text" in entry:
+            return entry["text"].encode("utf-8", "surrogateescape")
+        return entry["json"]
+
+    def stats(self) -> dict:
+        return {"mode": self.mode, "recorded": self.recorded, "served": self.served, "missed": self.missed}
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class ArchiveSession(requests.Session):
+    """
+    requests.Session that records every response to a ResponseArchive, or serves them from it without any
+    network access. Everything that takes a session (results, projects, topics, credits, histogram) is covered.
+    """
+
+    def __init__(self, archive: ResponseArchive):
+        super().__init__()
+        self.archive = archive
+
+    def request(self, method, url, params=None, **kwargs):
+        key = request_key(method, url, params)
+
+        if self.archive.replaying:
+            entry = self.archive.replay(key)
+            response = requests.Response()
+            response.url = url
+            response.encoding = "utf-8"
+            if entry is None:
+                logger.warning(f"replay archive - no response recorded for {method} {urlsplit(url).path}")
+                response.status_code = 404
+                response._content = b"{}"
+            else:
+                response.status_code = entry["status"]
+                response._content = self.archive.body(entry)
+            return response
+
+        response = super().request(method, url, params=params, **kwargs)
+        self.archive.record(key, response.status_code, response.content, response.elapsed.total_seconds())
+        return response
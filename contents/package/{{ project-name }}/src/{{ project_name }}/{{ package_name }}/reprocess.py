@@ -0,0 +1,170 @@
+import gzip
+import json
+import logging
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from types import SimpleNamespace
+from .compact import encode_record, projected_record_class
+from .pipeline import RecentKeys
+from .projection import FieldProjection
+from .transform import merge_tweet, transform_page
+
+logger = logging.getLogger(__name__)
+
+_PAGE_PREFIX = b'{"kind": "page", "response": '
+
+
+class RawPageArchive:
+    """
+    Gzip compressed json lines archive of the raw result pages of a topic pull.
+
+    The first line describes the run (its parameters, the project and topic names of the xcom and the partition
+    and shard it was published as), then every results response is stored as fetched, together with the twitter
+    lookups, so reprocess_archive() can rebuild the output without calling talkwalker or twitter. The last line
+    lists the windows the run did not complete. Safe to share between threads.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.pages = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._file = gzip.open(path, "wb")
+
+    def _write(self, line: bytes) -> None:
+        with self._lock:
+            self._file.write(line)
+
+    def add_run(self, run: dict) -> None:
+        self._write(json.dumps({"kind": "run", "run": run}).encode() + b"\n")
+
+    def add_page(self, content: bytes) -> None:
+        # line breaks only occur as whitespace between json tokens, inside strings they are escaped
+        self._write(_PAGE_PREFIX + content.strip().replace(b"\r", b" ").replace(b"\n", b" ") + b"}\n")
+        self.pages += 1
+
+    def add_tweets(self, tweets: dict) -> None:
+        self._write(json.dumps({"kind": "tweets", "result": tweets}).encode() + b"\n")
+
+    def add_remaining(self, windows: list) -> None:
+        """The remaining_windows of the xcom of the run"""
+        self._write(json.dumps({"kind": "remaining", "windows": windows}).encode() + b"\n")
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+# state of the reprocess worker processes, set once by _init_worker
+_worker = {}
+
+
+def _init_worker(projection_spec: str, tweets: dict) -> None:
+    projection = FieldProjection.parse(projection_spec)
+    _worker["projection"] = projection
+    _worker["record_class"] = projected_record_class(projection)
+    _worker["tweets"] = tweets
+
+
+def _process_pages(lines: list) -> list:
+    """(url, output line) of every item of the pages, in page order, tweets merged like Driver.merge_tweet_data"""
+
+    projection, record_class, tweets = _worker["projection"], _worker["record_class"], _worker["tweets"]
+    rc = []
+    for line in lines:
+        response = json.loads(line, object_hook=lambda d: SimpleNamespace(**d)).response
+        content = getattr(response, "result_content", None)
+        page = getattr(content, "data", None) if content is not None else None
+        if not page:
+            continue
+
+        formatted, _ = transform_page(page, projection)
+        for item, data in zip(page, formatted):
+            url = getattr(item.data, "url", None)
+            record = record_class.from_dict(data)
+            if record.external_provider == "twitter":
+                tweet = tweets.get(str(record.external_id))
+                if tweet is not None:
+                    try:
+                        rc.append((url, encode_record(merge_tweet(tweet, record.to_dict()), record_class)))
+                    except Exception as e:
+                        logger.error(f"Exception in twitter TW merge! {e}")
+                    continue
+            rc.append((url, encode_record(record, record_class)))
+    return rc
+
+
+def read_archive(path: str):
+    """The run description with its remaining_windows, and the {tweet id: tweet} of the twitter lookups of an archive"""
+
+    run, tweets = {}, {}
+    with gzip.open(path, "rb") as f:
+        for line in f:
+            if line.startswith(_PAGE_PREFIX):
+                continue
+            entry = json.loads(line)
+            if entry["kind"] == "run":
+                run = {**run, **entry["run"]}
+            elif entry["kind"] == "remaining":
+                run["remaining_windows"] = entry["windows"]
+            elif entry["kind"] == "tweets":
+                for tweet in entry["result"].get("data", []):
+                    tweets[str(tweet["id"])] = tweet
+    return run, tweets
+
+
+def reprocess_archive(
+        path: str, jsonl_file_path: str, projection: FieldProjection = None, workers: int = None,
+        dedupe_window: int = 0, pages_per_task: int = 8
+) -> dict:
+    """
+    Rebuild the output lines of a pull from its raw page archive.
+
+    Pages are decoded, formatted and encoded in a pool of worker processes, the gzip stream is read and the
+    output written in this one. At most two tasks per worker are pending, so memory use does not depend on
+    the size of the archive.
+    :return: the run description stored in the archive, with the number of items and duplicates
+    """
+
+    run, tweets = read_archive(path)
+    workers = workers or os.cpu_count() or 1
+    seen = RecentKeys(dedupe_window)
+    saved = duplicates = pages = 0
+
+    def tasks(f):
+        batch = []
+        for line in f:
+            if line.startswith(_PAGE_PREFIX):
+                batch.append(line)
+                if len(batch) == pages_per_task:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
+
+    with ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker, initargs=(str(projection or ""), tweets)
+    ) as executor, gzip.open(path, "rb") as f, open(jsonl_file_path, "w") as out:
+        pending = deque()
+
+        def drain():
+            nonlocal saved, duplicates
+            for url, line in pending.popleft().result():
+                if url and not seen.add(url):
+                    duplicates += 1
+                    continue
+                out.write(line + "\n")
+                saved += 1
+
+        for batch in tasks(f):
+            pages += len(batch)
+            pending.append(executor.submit(_process_pages, batch))
+            if len(pending) >= 2 * workers:
+                drain()
+        while pending:
+            drain()
+
+    logger.info(f"reprocessed {pages} pages of {path} with {workers} workers: {saved} items, {duplicates} duplicates")
+    return {**run, "pages": pages, "total_saved": saved, "duplicates": duplicates}
@@ -0,0 +1,204 @@
+import json
+import logging
+import threading
+import time
+from datetime import date, timedelta
+
+logger = logging.getLogger(__name__)
+
+# oldest: in date order, recent: most recent first, volume: largest first, from the published date histogram
+WINDOW_ORDERS = ("oldest", "recent", "volume")
+
+
+def order_windows(windows, order: str) -> list:
+    """(start, end, label) windows in the given order, volume ordered windows come from VolumePlan.schedule()"""
+    if order not in WINDOW_ORDERS:
+        raise ValueError(f"unknown window order {order}, expected one of {', '.join(WINDOW_ORDERS)}")
+    windows = list(windows)
+    if order == "recent":
+        windows.sort(key=lambda window: window[0], reverse=True)
+    return windows
+
+
+def parse_windows(value) -> list:
+    """
+    Windows of a follow-up run, as listed under remaining_windows in the xcom of the interrupted run
+    :param value: list of {"start", "end", "label"} dicts or [start, end, label] lists, or its json
+    :return: list of (start, end, label) tuples
+    """
+    if isinstance(value, str):
+        value = json.loads(value)
+    rc = []
+    for window in value:
+        if isinstance(window, dict):
+            start, end = int(window["start"]), int(window["end"])
+            rc.append((start, end, window.get("label") or str(start)))
+        else:
+            start, end = int(window[0]), int(window[1])
+            rc.append((start, end, window[2] if len(window) > 2 else str(start)))
+    return rc
+
+
+def parse_offsets(value) -> dict:
+    """
+    Offsets a follow-up run resumes the windows given up at the deadline from, as listed with their offset under
+    remaining_windows in the xcom of the interrupted run
+    :return: dict of (start, end, label) -> (offset, partition holding the pages before offset), windows without
+        an offset start from the first page
+    """
+    if isinstance(value, str):
+        value = json.loads(value)
+    entries = [window for window in value if isinstance(window, dict) and window.get("offset")]
+    return {
+        window: (int(entry["offset"]), entry.get("partition"))
+        for window, entry in zip(parse_windows(entries), entries)
+    }
+
+
+def date_chunks(from_date: str, to_date: str, chunk: str = "week") -> list:
+    """
+    Split the days from from_date to to_date, both included, into the date ranges of a backfill
+    :param chunk: "day", "week" (monday to sunday), "month" or a number of days
+    :return: list of (from_date, to_date) tuples of %Y-%m-%d dates, in date order, that do not overlap
+    """
+    start, end = sorted((date.fromisoformat(from_date), date.fromisoformat(to_date)))
+    if chunk not in ("day", "week", "month") and not (chunk.isdigit() and int(chunk) > 0):
+        raise ValueError(f"unknown chunk {chunk}, expected day, week, month or a number of days")
+
+    rc = []
+    while start <= end:
+        if chunk == "week":
+            last = start + timedelta(days=6 - start.weekday())
+        elif chunk == "month":
+            first_of_next = (start.replace(day=1) + timedelta(days=32)).replace(day=1)
+            last = first_of_next - timedelta(days=1)
+        else:
+            last = start + timedelta(days=(1 if chunk == "day" else int(chunk)) - 1)
+        last = min(last, end)
+        rc.append((start.isoformat(), last.isoformat()))
+        start = last + timedelta(days=1)
+    return rc
+
+
+class DeadlineScheduler:
+    """
+    Hands out the search windows of a pull, in order, until the run deadline comes near.
+
+    Throughput is measured from the windows completed so far. A window is only handed out when the windows
+    already handed out and this one are projected to complete before deadline - margin, so the run stops
+    early enough to upload what it has. Fetchers check expired() between pages and give up the window they
+    are fetching once deadline - margin has passed; the pages of such a window that were already fetched stay
+    in the output, the window is listed in remaining() with the offset of its next page, so the follow-up run
+    resumes it there instead of fetching those pages again. Windows never handed out are listed without an
+    offset. Without a deadline every window is handed out. Safe to share between threads.
+    """
+
+    def __init__(self, windows, deadline: float = None, margin: float = 0.0, clock=time.monotonic, offsets=None):
+        """
+        :param deadline: clock() time the run must be done by, None for no deadline
+        :param margin: seconds kept for the upload and the xcom before the deadline
+        :param offsets: (offset, partition) of the windows resumed from an interrupted run, see parse_offsets()
+        """
+        self.windows = list(windows)
+        self.deadline = deadline
+        self.margin = margin
+        self.clock = clock
+        self.started_at = clock()
+        self.dispatched = 0
+        self.completed = set()  # indexes of the completed windows
+        self.offsets = dict(offsets or {})  # window -> (offset of its next page, partition of the pages before)
+        self.given_up = set()  # windows given up at the deadline by this run
+        self.items = 0
+        self.stop_reason = None
+        self._index = {window: n for n, window in enumerate(self.windows)}
+        self._lock = threading.Lock()
+
+    def _cutoff(self) -> float:
+        return self.deadline - self.margin
+
+    def expired(self) -> bool:
+        return self.deadline is not None and self.clock() >= self._cutoff()
+
+    def throughput(self):
+        """Completed windows per second so far, None before the first one completes"""
+        elapsed = self.clock() - self.started_at
+        if not self.completed or elapsed <= 0:
+            return None
+        return len(self.completed) / elapsed
+
+    def _may_dispatch(self) -> bool:
+        if self.deadline is None:
+            return True
+        if self.expired():
+            self.stop_reason = "deadline"
+            return False
+        rate = self.throughput()
+        if rate is None:
+            return True
+        # the windows in flight and this one
+        backlog = self.dispatched - len(self.completed) + 1
+        if self.clock() + backlog / rate > self._cutoff():
+            self.stop_reason = "projected past the deadline"
+            return False
+        return True
+
+    def __iter__(self):
+        for window in self.windows:
+            with self._lock:
+                if not self._may_dispatch():
+                    left = len(self.windows) - self.dispatched
+                    logger.warning(f"deadline scheduler - {self.stop_reason}, {left} windows not started")
+                    return
+                self.dispatched += 1
+            yield window
+
+    def complete(self, window, items: int = 0) -> None:
+        """Called by the fetcher when every page of window was fetched"""
+        with self._lock:
+            self.completed.add(self._index[window])
+            self.items += items
+
+    def offset(self, window) -> int:
+        """Offset of the first page to fetch of window"""
+        with self._lock:
+            return self.offsets.get(window, (0, None))[0]
+
+    def give_up(self, window, offset: int) -> None:
+        """Called by the fetcher that stopped fetching window at the deadline, offset is the one of its next page"""
+        with self._lock:
+            self.offsets[window] = (offset, None)
+            self.given_up.add(window)
+
+    def remaining(self, partition: int = None) -> list:
+        """
+        Windows that were not completed, in date order, for the xcom of the run. Windows given up at the
+        deadline have the offset of their next page and the partition their last fetched pages were written to.
+        """
+        with self._lock:
+            windows = sorted(window for n, window in enumerate(self.windows) if n not in self.completed)
+            rc = []
+            for window in windows:
+                start, end, label = window
+                entry = {"start": start, "end": end, "label": label}
+                if window in self.offsets:
+                    entry["offset"], held_by = self.offsets[window]
+                    # a resumed window that was not started again keeps the partition of the run that gave it up
+                    held_by = partition if window in self.given_up else held_by
+                    if held_by is not None:
+                        entry["partition"] = held_by
+                rc.append(entry)
+            return rc
+
+    def status(self) -> dict:
+        with self._lock:
+            rate = self.throughput()
+            left = len(self.windows) - len(self.completed)
+            rc = {
+                "windows": len(self.windows),
+                "dispatched": self.dispatched,
+                "completed": len(self.completed),
+                "projected_seconds": round(left / rate, 1) if rate else None,
+            }
+            if self.deadline is not None:
+                rc["seconds_to_deadline"] = round(self.deadline - self.clock(), 1)
+            return rc
@@ -1,29 +1,39 @@
 import json, random, time
-import boto3
 import logging
+import threading
 import requests
-from pprint import pprint
-from fake_useragent import UserAgent
 from datetime import date, timedelta
 from datetime import datetime
 from types import SimpleNamespace
-from urllib.parse import urlparse
-from newspaper import Article
+from .compact import projected_record_class
+from .concurrency import UpstreamLimiters, classify
+from .pagesize import PageSizer
+from .projection import FieldProjection
+from .ratelimit import RateLimiter
+from .transform import convert_epoch, get_domain_name, is_news, namespace_to_dict, transform_page
+from .useragent import get_user_agent
+
+# NOTE: newspaper (which pulls in nltk and lxml) is imported where it is used, news download is off by
+# default and most pods never need it. fake_useragent is loaded once, on first use, by the user agent pool.
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(level=logging.INFO)
 
 
 class TalkwalkerSource:
-    def __init__(self, params: dict, max_retries, page_size, access_token):
+    def __init__(
+            self, params: dict, max_retries, page_size, access_token, session=None, rate_limiter=None,
+            projection: FieldProjection = None, upstreams: UpstreamLimiters = None, page_sizer: PageSizer = None
+    ):
         self.max_retries = max_retries
         self.total = 0  # total items per request
         self.total_twitter_count = 0
         self.twitter_errors = 0
         self.total_item_count = 0  # total items retrieved so far
         self.total_saved = 0
+        self.duplicates = 0  # repeated items dropped by the pipeline
         self.required_credits = 0
         self.latest_errors = []
+        self.lock = threading.Lock()  # counters and log files are updated by the pipeline worker threads
 
         # talkwalker params
         self.access_token = access_token
@@ -35,6 +45,21 @@ class TalkwalkerSource:
 
         self.page_size = page_size
         self.parameters = {}
+        # hpp of the pages, every page is fetched at page_size unless an adaptive sizer is given
+        self.page_sizer = page_sizer or PageSizer(int(page_size), maximum=int(page_size))
+
+        # the session and rate limiter are shared by all the topics of a multi-topic run
+        self.session = session or requests.Session()
+        self.rate_limiter = rate_limiter or RateLimiter()
+        # adaptive concurrency limit and circuit breaker of talkwalker and of the article sites
+        self.upstreams = upstreams or UpstreamLimiters()
+        self.page_interval = 1  # seconds, pause between the pages of a window that is fetched quickly
+        self.page_archive = None  # RawPageArchive the raw result pages are stored in, when set
+        self.scheduler = None  # DeadlineScheduler of the pull, windows are given up once it has expired
+
+        # fields dropped for this deployment are never copied out of the responses
+        self.projection = projection or FieldProjection()
+        self.record_class = projected_record_class(self.projection)
 
         timestamp = int(time.time())  # Generate a unique timestamp
         self.log_file_path = f"talkwalker_{self.topic_id}_attribution_logs_{timestamp}.jsonl"  # Include timestamp in the filename
@@ -46,7 +71,7 @@ class TalkwalkerSource:
         rc = {}
 
         url = f"https://api.talkwalker.com/api/v1/search/info?access_token={self.access_token}"
-        response = requests.get(url)
+        response = self.session.get(url)
 
         if response.status_code != 200:
             raise ValueError("invalid access token or talkwalker service is down")
@@ -66,7 +91,7 @@ class TalkwalkerSource:
         rc = {}
 
         url = f"https://api.talkwalker.com/api/v2/talkwalker/p/{project_id}/resources?type=search&access_token={self.access_token}&type=search"
-        response = requests.get(url)
+        response = self.session.get(url)
         data = response.json()
 
         if response.status_code != 200:
@@ -92,52 +117,45 @@ class TalkwalkerSource:
         return projects[project_id], topics[topic_id]
 
     def convert_epoch_to_unix(self, epoch_timestamp):
-        try:
-            # Find the length of the input epoch timestamp
-            length = len(str(epoch_timestamp))
-            # return 0 if there is no published date available from talkwalker
-            if length < 1:
-                return 0
-            # raise error if there is no published date is not valid
-            if length < 10:
-                raise ValueError("Epoch timestamp is too short")
-
-            # Conversion factor for seconds (epoch is in seconds)
-            seconds_factor = 10 ** (length - 10)
-
-            # Convert to seconds
-            seconds = epoch_timestamp / seconds_factor
-
-            return int(seconds)
-        except Exception as e:
-            # print(e)
-            return -1
+        return convert_epoch(epoch_timestamp)
 
     def log_error(self, error_message):
-        self.latest_errors.append(error_message)
-        if len(self.latest_errors) > 10:
-            self.latest_errors.pop(0)
+        with self.lock:
+            self.latest_errors.append(error_message)
+            if len(self.latest_errors) > 10:
+                self.latest_errors.pop(0)
 
     def get_latest_errors(self):
-        return self.latest_errors
+        with self.lock:
+            return list(self.latest_errors)
 
-    def download_as_object(self, url):
-        ua = UserAgent()
-        headers = {"User-Agent": ua.random}
+    def download_as_object(self, url, parameters=None):
+        headers = {"User-Agent": get_user_agent()}
+        limiter = self.upstreams.for_url(url)
         for i in range(self.max_retries):
             try:
-                response = requests.get(
-                    url, params=self.parameters, headers=headers, timeout=10
-                )
+                # waits while talkwalker is paused by the circuit breaker instead of burning the retries
+                with limiter.track() as call:
+                    start = time.monotonic()
+                    response = self.session.get(
+                        url, params=self.parameters if parameters is None else parameters, headers=headers, timeout=10
+                    )
+                    seconds = time.monotonic() - start
+                    call.outcome = classify(response.status_code)
                 response_json = response.json()
                 response.raise_for_status()
 
                 x = json.loads(
                     response.content, object_hook=lambda d: SimpleNamespace(**d)
                 )
-                return {"data": x, "pagination": response_json.get("pagination", {})}
+                if self.page_archive is not None:
+                    self.page_archive.add_page(response.content)
+                return {
+                    "data": x, "pagination": response_json.get("pagination", {}), "seconds": seconds,
+                    "bytes": len(response.content),
+                }
             except requests.exceptions.Timeout:
-                self.logger.error(f"Request timed out. Attempt: {i + 1}")
+                self.logger.error("Request timed out. Attempt: %s", i + 1)
                 self.log_error(f"Request timed out. Attempt: {i + 1}")
                 if (
                         i < self.max_retries - 1
@@ -146,111 +164,78 @@ class TalkwalkerSource:
                 else:
                     break
             except Exception as e:
-                self.logger.error(f"{e}")
+                self.logger.error("%s", e)
                 self.log_error(f"{e}")
 
     @staticmethod
     def get_domain_name(url):
-        # Parse the URL using urlparse
-        parsed_url = urlparse(url)
-        # Extract the netloc (network location) and split by '.' to get the domain components
-        domain_components = parsed_url.netloc.split(".")
-        # Return the second-to-last component, which is typically the main domain name
-        return domain_components[-2] if len(domain_components) > 1 else ""
+        # second-to-last component of the network location, which is typically the main domain name
+        return get_domain_name(url)
 
     def save_attribution_logs_to_file(self, data):
-        with open(self.log_file_path, "a") as f:
+        with self.lock, open(self.log_file_path, "a") as f:
             f.write(json.dumps(data) + "\n")
 
-    def format_data_item(self, item, published):
-        if getattr(item.data, "external_provider", "") == "twitter":
-            source = "twitter"
-            self.total_twitter_count += 1
-        else:
-            source = self.get_domain_name(getattr(item.data, "url", ""))
-
-        # Project all the input fields and update the published and source fields
-        data = self.nested_namespace_to_dict(item.data)
-        data["published"] = published
-        data["source"] = source
-        if published != 0 or published != -1:
-            data["x-p6m-publish-source"] = "talkwalker"
-
-        sources_to_check = [
-            "BLOG_OTHER",
-            "ONLINENEWS",
-            "ONLINENEWS_AGENCY",
-            "ONLINENEWS_MAGAZINE",
-            "ONLINENEWS_NEWSPAPER",
-            "ONLINENEWS_OTHER",
-            "ONLINENEWS_PRESSRELEASES",
-            "ONLINENEWS_TVRADIO",
-            "PODCAST_OTHER",
-        ]
-        is_news = any(
-            element in getattr(item.data, "source_type", "")
-            for element in sources_to_check
-        )
-        if is_news and self.get_news_links:
+    def add_news_article(self, item, data):
+        """Download the article of news items into data["news_article"], when get_news_links is set"""
+        if not self.get_news_links or not is_news(getattr(item.data, "source_type", "")):
+            return
+
+        source = data["source"]
+        article_dict = {}
+        attributions = {}
+        attributions["url"] = getattr(item.data, "url", "")
+        attributions["source"] = (source,)
+        attributions["snippet"] = True
+        try:
+            from newspaper import Article
 
-            article_dict = {}
-            attributions = {}
-            attributions["url"] = getattr(item.data, "url", "")
-            attributions["source"] = (source,)
-            attributions["snippet"] = True
-            try:
-                url = getattr(item.data, "url", "")
-                article = Article(
-                    url=url,
-                    # language=getattr(item.data, "lang", ""),
-                )
-                self.logger.info(f"Fetching Article {url}")
+            url = getattr(item.data, "url", "")
+            article = Article(
+                url=url,
+                browser_user_agent=get_user_agent(),
+                # language=getattr(item.data, "lang", ""),
+            )
+            self.logger.info("Fetching Article %s", url)
+            # articles of a paused site are skipped, they are optional
+            with self.upstreams.for_url(url).track(block=False):
                 article.download()
-                article.parse()
-                #                 article.nlp()
-                # print(article)
+            article.parse()
+            #                 article.nlp()
+            # print(article)
+
+            if article.publish_date is not None:
+                article_dict["datetime"] = article.publish_date.isoformat()
+            else:
+                article_dict[
+                    "datetime"
+                ] = None  # Or any other default value you prefer
+            article_dict["media"] = source
+            article_dict["title"] = article.title
+            article_dict["authors"] = article.authors
+            article_dict["text"] = article.text
+            article_dict["summary"] = article.summary
+            article_dict["url"] = article.url
+
+            # print("dict#: ", dict)
+            data["news_article"] = article_dict
+            attributions["successful_traversal"] = True
 
-                if article.publish_date is not None:
-                    article_dict["datetime"] = article.publish_date.isoformat()
-                else:
-                    article_dict[
-                        "datetime"
-                    ] = None  # Or any other default value you prefer
-                article_dict["media"] = source
-                article_dict["title"] = article.title
-                article_dict["authors"] = article.authors
-                article_dict["text"] = article.text
-                article_dict["summary"] = article.summary
-                article_dict["url"] = article.url
-
-                # print("dict#: ", dict)
-                data["news_article"] = article_dict
-                attributions["successful_traversal"] = True
+        except Exception as e:
+            attributions["successful_traversal"] = f"{e}"
+            self.logger.info(e)
+            self.logger.info("Ignoring this article")
+            article_url = attributions["url"]
+            self.log_error(f"error: {e} article: {article_url}")
 
-            except Exception as e:
-                attributions["successful_traversal"] = f"{e}"
-                self.logger.info(e)
-                self.logger.info("Ignoring this article")
-                article_url = attributions["url"]
-                self.log_error(f"error: {e} article: {article_url}")
+        try:
+            self.save_attribution_logs_to_file(attributions)
+        except Exception as e:
+            self.logger.info(e)
+            self.log_error(f"error in article: {e}")
 
-            try:
-                self.save_attribution_logs_to_file(attributions)
-            except Exception as e:
-                self.logger.info(e)
-                self.log_error(f"error in article: {e}")
-        return data
-
-    def nested_namespace_to_dict(self, obj):
-        if isinstance(obj, SimpleNamespace):
-            return {
-                key: self.nested_namespace_to_dict(value)
-                for key, value in obj.__dict__.items()
-            }
-        elif isinstance(obj, list):
-            return [self.nested_namespace_to_dict(item) for item in obj]
-        else:
-            return obj
+    def nested_namespace_to_dict(self, obj, projection: FieldProjection = None):
+        return namespace_to_dict(obj, projection)
 
     def extract_offset_from_next(self, next_url):
         """
@@ -265,17 +250,18 @@ class TalkwalkerSource:
                 return int(next_url[offset_start_index:offset_end_index])
         return None
 
-    def search_results(self, url):
+    def fetch_pages(self, url, parameters):
+        """
+        Page through the results of one search, yields the list of result items of every page
+        :param parameters: search parameters, their offset is advanced and their hpp chosen page by page
+        :return: offset of the next page when the search was given up at the deadline before its last page,
+            None when all its pages were fetched
+        """
         scrape_start_time = time.time()  # Record the start time of the scrape function
-        items = []  # list to hold tweet items for batching
 
         while True:
-            time.sleep(0.1)  # we are still getting rate limit 429s
-            x = self.download_as_object(url)
-
-            # print("==object downloaded==")
-            # pprint(x)
-            self.total = 0
+            self.rate_limiter.wait()  # we are still getting rate limit 429s
+            x = self.download_as_object(url, parameters)
 
             if x is None:
                 # print("==skipping as x is None==")
@@ -291,40 +277,50 @@ class TalkwalkerSource:
                 # print("==skipping as data is None==")
                 break
 
-            for item in data:
-                self.total += 1
-
-                published = self.convert_epoch_to_unix(
-                    getattr(item.data, "published", "")
-                )
-                items.append(self.format_data_item(item, published))
+            self.page_sizer.observe(len(data), x["seconds"], x["bytes"])
+            yield data
 
-            next_offset = self.extract_offset_from_next(
-                x.get("pagination", {}).get("next", "")
-            )
+            pagination = x.get("pagination", {})
+            next_offset = self.extract_offset_from_next(pagination.get("next", ""))
             if next_offset is None:
                 break
 
-            self.parameters["offset"] = next_offset
+            parameters["offset"] = next_offset
+            parameters["hpp"] = self.page_sizer.next_size(pagination.get("total"), next_offset)
+
+            if self.scheduler is not None and self.scheduler.expired():
+                self.logger.warning("Deadline reached, giving up the window at offset %s", next_offset)
+                return next_offset
+
+            # Check if the scrape function has run for more than page_interval seconds
+            if time.time() - scrape_start_time < self.page_interval:
+                time.sleep(self.page_interval)
+        return None
+
+    def format_page(self, page, download_news=True) -> list:
+        """Formatted dicts of the result items of a page, see transform_page()"""
+        rc, news = transform_page(page, self.projection)
 
-            # Check if the scrape function has run for more than 1 second
-            if time.time() - scrape_start_time < 1:
-                time.sleep(1)
-        return items
+        twitter_count = sum(1 for item in page if getattr(item.data, "external_provider", "") == "twitter")
+        if twitter_count:
+            with self.lock:
+                self.total_twitter_count += twitter_count
+
+        if download_news and self.get_news_links:
+            for item, data, item_is_news in zip(page, rc, news):
+                if item_is_news:
+                    self.add_news_article(item, data)
+        return rc
 
     @staticmethod
     def get_epoch_time(day, month, year):
+        # midnight in the local time zone of the pod, build_plan() sums the UTC histogram buckets into these windows
         date = datetime(year, month, day)
         epoch_time = int(time.mktime(date.timetuple()))
         return epoch_time
 
-    def retrieve_data(self):
-        start_time = time.time()  # Record the start time
-        url = f"https://api.talkwalker.com/api/v1/search/p/{self.project_id}/results"
-
-        total_twitter_error_count = 0
-        # Calculate the start and end dates
-
+    def get_date_range(self):
+        """(start_date, end_date) of the search, in ascending order"""
         start_date = (
             datetime.strptime(self.start_date, "%Y-%m-%d")
             if self.start_date
@@ -340,8 +336,16 @@ class TalkwalkerSource:
         # Swap start_date with end_date if start_date is greater
         if start_date > end_date:
             start_date, end_date = end_date, start_date
+        return start_date, end_date
 
-        self.logger.info(f"starting search from {start_date} till {end_date}")
+    def get_windows(self, shard_index=0, shard_count=1):
+        """
+        Yields the 1 hour search windows of the date range as (start, end, label) tuples
+        :param shard_index: of a sharded pull, only every shard_count-th window, starting at shard_index, is
+            yielded. Consecutive hours go to different shards, so busy days are spread over all of them.
+        """
+        start_date, end_date = self.get_date_range()
+        index = 0
 
         # Loop through each day from the start_date to the end_date
         for n in range(int((end_date - start_date).days) + 1):
@@ -351,47 +355,22 @@ class TalkwalkerSource:
             day = current_day.day
 
             start = self.get_epoch_time(day, month, year)
-            self.logger.info(f"Fetching Day - {month}/{day}/{year}")
             # Loop through 24 hours with 1-hour intervals
             for i in range(24):
                 # Calculate the end time, which is 1 hour apart from the start time
                 end = start + 3600  # 3600 seconds = 1 hour
-
-                self.parameters = {
-                    "access_token": self.access_token,
-                    "topic": self.topic_id,
-                    "hpp": self.page_size,
-                    "offset": 0,
-                    "project_id": self.project_id,
-                    "q": f"(published:>={start} AND published:<{end})",
-                }
-                self.logger.info(f"Fetching Hour - {month}/{day}/{year} - {i}")
-                # yield self.search_results(url)
-                yield self.search_results(url)
-
-                # break
-                self.total_item_count += self.total
-
-                # Update the start time for the next interval
+                if index % shard_count == shard_index:
+                    yield start, end, f"{month}/{day}/{year} hour {i}"
+                index += 1
                 start = end
-                # self.logger.info(f"Fetching  {month}/{day}/{year} Hour = {i}")
-                self.logger.info(
-                    f"Item retrieved for {month}/{day}/{year} hour {i}: {self.total}"
-                )
-                self.logger.info(
-                    f"\r### Total: {self.required_credits}, Remaining: {self.required_credits - self.total_item_count}  Retrieved: {self.total_item_count}, Saved: {self.total_saved}, Twitter: {self.total_twitter_count}, Twitter errors: {self.twitter_errors} ###"
-                )
-
-            # break
 
-        end_time = time.time()  # Record the end time
-        execution_time = str(timedelta(seconds=int(end_time - start_time)))
-        # Log the final report
-        self.logger.info(f"=========================================")
-        self.logger.info(f"=========== Execution Summary ===========")
-
-        self.logger.info(f"Execution Time: {execution_time}")
-        self.logger.info(
-            f"Number of Twitter Errors Encountered: {total_twitter_error_count}"
-        )
-        # self.logger.info(f"Total Items Collected: {total_item_count}")
+    def window_parameters(self, start, end) -> dict:
+        """Search parameters of the results published in [start, end)"""
+        return {
+            "access_token": self.access_token,
+            "topic": self.topic_id,
+            "hpp": self.page_sizer.next_size(),
+            "offset": 0,
+            "project_id": self.project_id,
+            "q": f"(published:>={start} AND published:<{end})",
+        }
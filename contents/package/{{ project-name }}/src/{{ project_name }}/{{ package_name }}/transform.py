@@ -0,0 +1,142 @@
+import logging
+from datetime import datetime
+from functools import lru_cache
+from types import SimpleNamespace
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+# source types whose items link to an article that can be downloaded
+NEWS_SOURCE_TYPES = (
+    "BLOG_OTHER",
+    "ONLINENEWS",
+    "ONLINENEWS_AGENCY",
+    "ONLINENEWS_MAGAZINE",
+    "ONLINENEWS_NEWSPAPER",
+    "ONLINENEWS_OTHER",
+    "ONLINENEWS_PRESSRELEASES",
+    "ONLINENEWS_TVRADIO",
+    "PODCAST_OTHER",
+)
+_NEWS_SOURCE_TYPES = frozenset(NEWS_SOURCE_TYPES)
+
+# 10 ** (number of digits - 10), talkwalker sends seconds, milliseconds and longer epochs
+_EPOCH_FACTORS = {length: 10 ** (length - 10) for length in range(10, 25)}
+
+
+def convert_epoch(epoch_timestamp) -> int:
+    """Epoch of any precision in seconds, 0 when missing and -1 when invalid"""
+    try:
+        # Find the length of the input epoch timestamp
+        length = len(str(epoch_timestamp))
+        # return 0 if there is no published date available from talkwalker
+        if length < 1:
+            return 0
+        # raise error if there is no published date is not valid
+        if length < 10:
+            raise ValueError("Epoch timestamp is too short")
+
+        seconds_factor = _EPOCH_FACTORS.get(length) or 10 ** (length - 10)
+        return int(epoch_timestamp / seconds_factor)
+    except Exception:
+        return -1
+
+
+@lru_cache(maxsize=4096)
+def _domain_of_netloc(netloc: str) -> str:
+    # Split the network location by '.' and return the second-to-last component, which is typically the main
+    # domain name
+    domain_components = netloc.split(".")
+    return domain_components[-2] if len(domain_components) > 1 else ""
+
+
+def get_domain_name(url) -> str:
+    return _domain_of_netloc(urlsplit(url).netloc)
+
+
+def is_news(source_type) -> bool:
+    """True when the source type (a list of types, or a single string) is one of NEWS_SOURCE_TYPES"""
+    if isinstance(source_type, list):
+        return not _NEWS_SOURCE_TYPES.isdisjoint(source_type)
+    return any(element in source_type for element in NEWS_SOURCE_TYPES)
+
+
+def namespace_to_dict(obj, projection=None):
+    """SimpleNamespace tree to dicts, leaving out the fields dropped by the projection"""
+    if type(obj) is SimpleNamespace:
+        if not projection:
+            return {key: namespace_to_dict(value) for key, value in obj.__dict__.items()}
+        dropped = projection.dropped
+        return {
+            key: namespace_to_dict(value, projection.child(key))
+            for key, value in obj.__dict__.items()
+            if key not in dropped
+        }
+    elif type(obj) is list:
+        return [namespace_to_dict(value, projection) for value in obj]
+    return obj
+
+
+def transform_page(page, projection=None):
+    """
+    Format every result item of a page in one pass.
+
+    The fields the derived values are computed from are first gathered column by column, then published,
+    source and the news flag are computed over the whole columns, so per item work is reduced to dict
+    building. Domains are memoized per network location.
+    :return: (list of formatted dicts, list of news flags) in page order
+    """
+
+    items = [item.data for item in page]
+
+    # columns
+    providers = [getattr(data, "external_provider", "") for data in items]
+    urls = [getattr(data, "url", "") for data in items]
+    epochs = [getattr(data, "published", "") for data in items]
+    source_types = [getattr(data, "source_type", "") for data in items]
+
+    # derived columns
+    published = [convert_epoch(epoch) for epoch in epochs]
+    sources = [
+        "twitter" if provider == "twitter" else get_domain_name(url) for provider, url in zip(providers, urls)
+    ]
+    news = [is_news(source_type) for source_type in source_types]
+
+    rc = []
+    for data, item_published, source in zip(items, published, sources):
+        # Project all the input fields and update the published and source fields
+        formatted = namespace_to_dict(data, projection)
+        formatted["published"] = item_published
+        formatted["source"] = source
+        # NOTE: always "talkwalker", the original per item formatting tested `published != 0 or published != -1`
+        formatted["x-p6m-publish-source"] = "talkwalker"
+        rc.append(formatted)
+    return rc, news
+
+
+def merge_tweet(tweet_data: dict, item: dict) -> dict:
+    """
+    Merge the hydrated tweet into the dict of its talkwalker item, in place: item is updated and returned and
+    tweet_data is referenced (not copied) as external_provider_attributes.
+    """
+    # a tweet without a valid created_at fails here and goes to the error file, whatever its published date
+    created_at = tweet_data["created_at"].replace(" ", "").replace("\n", "")
+    dt_obj = datetime.strptime(created_at, "%Y-%m-%dT%H:%M:%S.%fZ")
+    created_epoch_unix = int(dt_obj.timestamp())
+
+    item.update(tweet_data)
+    # NOTE: only replace the published date with twitter date if the talkwalker date
+    # is not available or is invalid
+    if item["published"] == -1 or item["published"] == 0:
+        item["published"] = created_epoch_unix
+        item["x-p6m-publish-source"] = "twitter"
+    text = item.pop("text")
+    item["content"] = text
+    item["word_count"] = len(text.split())
+    item["external_provider_attributes"] = tweet_data
+    item["url"] = tweet_data["id"]
+
+    if not tweet_data.get("author_id"):
+        logger.warning(f'Warning - author id is null for tweet id {tweet_data["id"]}')
+
+    return item
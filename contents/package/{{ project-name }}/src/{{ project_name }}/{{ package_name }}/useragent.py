@@ -0,0 +1,71 @@
+import logging
+import random
+import threading
+
+logger = logging.getLogger(__name__)
+
+# used when fake_useragent is not installed or its browser database cannot be loaded
+STATIC_USER_AGENTS = [
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
+    "Chrome/124.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
+    "Chrome/124.0.0.0 Safari/537.36 Edg/124.0.0.0",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:125.0) Gecko/20100101 Firefox/125.0",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) "
+    "Chrome/124.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) "
+    "Version/17.4.1 Safari/605.1.15",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 14.4; rv:125.0) Gecko/20100101 Firefox/125.0",
+    "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:125.0) Gecko/20100101 Firefox/125.0",
+]
+
+
+class UserAgentPool:
+    """
+    Process wide pool of browser User-Agent strings.
+
+    fake_useragent loads its browser database every time a UserAgent() is created, so the pool samples it
+    once, on first use, and then hands out the sampled agents round robin. Falls back to the bundled
+    STATIC_USER_AGENTS when fake_useragent is unavailable. Safe to share between threads.
+    """
+
+    def __init__(self, size: int = 50, use_fake_useragent: bool = True):
+        self.size = size
+        self.use_fake_useragent = use_fake_useragent
+        self._agents = None
+        self._index = 0
+        self._lock = threading.Lock()
+
+    def _load(self) -> list:
+        agents = []
+        if self.use_fake_useragent:
+            try:
+                from fake_useragent import UserAgent
+
+                ua = UserAgent()
+                # dict.fromkeys drops duplicates and keeps the sampling order
+                agents = list(dict.fromkeys(ua.random for _ in range(self.size)))
+            except Exception as e:
+                logger.warning(f"fake_useragent unavailable, using the bundled user agents: {e}")
+
+        if not agents:
+            agents = list(STATIC_USER_AGENTS)
+            random.shuffle(agents)
+        return agents
+
+    def next(self) -> str:
+        with self._lock:
+            if self._agents is None:
+                self._agents = self._load()
+            agent = self._agents[self._index % len(self._agents)]
+            self._index += 1
+            return agent
+
+
+_pool = UserAgentPool()
+
+
+def get_user_agent() -> str:
+    """Next User-Agent of the process wide pool, shared by the talkwalker and article fetchers"""
+    return _pool.next()
@@ -1,8 +1,1013 @@
-from unittest import TestCase
+import asyncio
+import hashlib
+import io
+import json
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from types import SimpleNamespace
+from unittest import TestCase, mock
 import {{ project_name }}.{{ package_name }} as {{ package_name }}
+from {{ project_name }}.{{ package_name }}.async_source import AsyncTalkwalkerSource
+from {{ project_name }}.{{ package_name }}.cache import MetadataCache, TweetCache
+from {{ project_name }}.{{ package_name }}.concurrency import AdaptiveLimiter, CircuitOpenError
+from {{ project_name }}.{{ package_name }}.compact import CompactRecord, encode_record, projected_record_class
+from {{ project_name }}.{{ package_name }} import main
+from {{ project_name }}.{{ package_name }}.driver import Driver
+from {{ project_name }}.{{ package_name }}.manifest import ETagDigest, PartitionStats, build_manifest
+from {{ project_name }}.{{ package_name }}.pagesize import PageSizer
+from {{ project_name }}.{{ package_name }}.pipeline import Pipeline, Stage
+from {{ project_name }}.{{ package_name }}.plan import build_plan
+from {{ project_name }}.{{ package_name }}.preflight import PreflightError, run_preflight
+from {{ project_name }}.{{ package_name }}.projection import FieldProjection
+from {{ project_name }}.{{ package_name }}.ratelimit import RateLimiter
+from {{ project_name }}.{{ package_name }}.record import TalkwalkerRecord
+from {{ project_name }}.{{ package_name }}.reprocess import RawPageArchive, reprocess_archive
+from {{ project_name }}.{{ package_name }}.replay import ArchiveSession, ResponseArchive, request_key
+from {{ project_name }}.{{ package_name }}.schedule import (
+    DeadlineScheduler, date_chunks, order_windows, parse_offsets, parse_windows,
+)
+from {{ project_name }}.{{ package_name }}.source import TalkwalkerSource
+from {{ project_name }}.{{ package_name }}.transform import merge_tweet, transform_page
+from {{ project_name }}.{{ package_name }}.useragent import STATIC_USER_AGENTS, UserAgentPool, get_user_agent
+from {{ project_name }}.utils.structured_logging import JsonFormatter, SamplingFilter
 
 
 class Test(TestCase):
     def test_execute(self):
         {{ package_name }}.execute()
         print("It works!")
+
+
+class TestMetadataCache(TestCase):
+    def test_loads_once_until_stale(self):
+        cache = MetadataCache(ttl=1, directory=tempfile.mkdtemp())
+        calls = []
+
+        def loader():
+            calls.append(1)
+            return {"project": "name"}
+
+        self.assertEqual(cache.get_or_load("projects", loader), {"project": "name"})
+        self.assertEqual(cache.get_or_load("projects", loader), {"project": "name"})
+        self.assertEqual(len(calls), 1)
+
+        time.sleep(1.1)
+        cache.get_or_load("projects", loader)
+        self.assertEqual(len(calls), 2)
+
+    def test_failed_lookups_are_not_cached(self):
+        cache = MetadataCache(ttl=60, directory=tempfile.mkdtemp())
+
+        self.assertIsNone(cache.get_or_load("credits", lambda: None))
+        self.assertEqual(cache.get_or_load("credits", lambda: 10), 10)
+
+
+class TestTweetCache(TestCase):
+    def test_hits_known_missing_ids_and_bounds(self):
+        path = f"{tempfile.mkdtemp()}/tweets.sqlite"
+        cache = TweetCache(path, ttl=60, missing_ttl=60, max_entries=10)
+        cache.store([{"id": "1", "text": "one"}, {"id": "2", "text": "two"}], ["3"])
+
+        found, missing, misses = cache.lookup(["1", "3", "4", "4"])
+        self.assertEqual((found, missing, misses), ({"1": {"id": "1", "text": "one"}}, {"3"}, ["4"]))
+
+        # kept across runs, stale entries are dropped, then the oldest above max_entries
+        cache.close()
+        cache = TweetCache(path, ttl=60, missing_ttl=0, max_entries=1)
+        found, missing, misses = cache.lookup(["1", "2", "3"])
+        self.assertEqual((len(found), missing, misses), (2, set(), ["3"]))
+        self.assertEqual(cache.prune(), 2)
+
+    def test_cached_tweets_skip_the_lookup(self):
+        def item(external_id):
+            return SimpleNamespace(
+                external_id=external_id, to_dict=lambda: {"external_id": external_id, "published": 5, "text": "tw"}
+            )
+
+        def get_tweets_by_ids(ids, error_file_path):
+            found = [
+                {"id": tweet_id, "text": "hydrated", "author_id": "a", "created_at": "2024-04-10T00:00:00.000Z"}
+                for tweet_id in ids if tweet_id == "1"
+            ]
+            return {"data": found, "errors": [{"value": tweet_id} for tweet_id in ids if tweet_id != "1"]}
+
+        driver = Driver()
+        driver.tweet_cache = TweetCache(f"{tempfile.mkdtemp()}/tweets.sqlite", 60, 60, 100)
+        driver.talk_walker = SimpleNamespace(lock=threading.Lock(), twitter_errors=0)
+        driver.get_tweets_by_ids = mock.Mock(side_effect=get_tweets_by_ids)
+        items = [item(1), item(2)]
+
+        with mock.patch("{{ project_name }}.{{ package_name }}.driver.time.sleep"):
+            first = driver.merge_tweet_data(items, "errors.txt")
+        # tweet 2 is retried twice, then counted once as missing
+        self.assertEqual(
+            [call.args[0] for call in driver.get_tweets_by_ids.call_args_list], [["1", "2"], ["2"], ["2"]]
+        )
+        self.assertEqual(driver.talk_walker.twitter_errors, 1)
+
+        driver.get_tweets_by_ids.reset_mock()
+        second = driver.merge_tweet_data(items, "errors.txt")
+        driver.get_tweets_by_ids.assert_not_called()
+        self.assertEqual(driver.tweet_cache.hits, 1)
+        self.assertEqual(driver.talk_walker.twitter_errors, 2)
+
+        for data in (first, second):
+            self.assertEqual(data[0]["content"], "hydrated")
+            self.assertIs(data[1], items[1])
+
+
+SAMPLE_ITEM = {
+    "url": "https://www.example.com/news/1",
+    "matched_profile": ["profile1"],
+    "indexed": 1712700000123,
+    "published": 1712700000,
+    "title": "Example \u00e9 \"title\"",
+    "content": "line\nbreak",
+    "lang": "en",
+    "source_type": ["ONLINENEWS", "ONLINENEWS_NEWSPAPER"],
+    "images": [{"url": "https://www.example.com/1.jpg"}],
+    "extra_author_attributes": {"world_data": {"country": "Luxembourg", "longitude": 6.13, "latitude": 1e-7}},
+    "article_extended_attributes": {"num_comments": "12"},
+    "engagement": True,
+    "external_provider": "twitter",
+    "external_id": "1789123456789012345",
+    "external_provider_attributes": {
+        "id": "1789123456789012345",
+        "conversation_id": "1789123456789012345",
+        "referenced_tweets": [{"type": "quoted", "id": "1"}],
+        "context_annotations": [{"domain": {"id": "10", "name": "Person"}}],
+        "author": {"username": "someone"},
+    },
+    "source": "example",
+    "x-p6m-publish-source": "talkwalker",
+}
+
+
+class TestCompactRecord(TestCase):
+    def test_json_is_identical_to_talkwalker_record(self):
+        expected = TalkwalkerRecord.model_validate(SAMPLE_ITEM).model_dump_json()
+
+        self.assertEqual(encode_record(SAMPLE_ITEM), expected)
+        self.assertEqual(CompactRecord.from_dict(SAMPLE_ITEM).to_json(), expected)
+        self.assertEqual(encode_record(CompactRecord.from_dict(SAMPLE_ITEM).to_dict()), expected)
+
+    def test_invalid_items_are_rejected_like_talkwalker_record(self):
+        with self.assertRaises(ValueError):
+            TalkwalkerRecord.model_validate({"word_count": None})
+        with self.assertRaises(ValueError):
+            CompactRecord.from_dict({"word_count": None})
+
+    def test_repeated_values_are_shared_between_records(self):
+        # decoded separately, like the items of two pages
+        first, second = json.loads(json.dumps(SAMPLE_ITEM)), json.loads(json.dumps(SAMPLE_ITEM))
+        second["extra_author_attributes"]["world_data"]["longitude"] = -0.0
+
+        a, b = CompactRecord.from_dict(first), CompactRecord.from_dict(second)
+
+        self.assertIs(a.lang, b.lang)
+        self.assertIs(a.source_type, b.source_type)
+        self.assertIs(a.matched_profile, b.matched_profile)
+        self.assertIsNot(a.extra_author_attributes.world_data, b.extra_author_attributes.world_data)
+        self.assertIs(CompactRecord.from_dict(second).extra_author_attributes.world_data,
+                      b.extra_author_attributes.world_data)
+        self.assertEqual(b.to_json(), TalkwalkerRecord.model_validate(second).model_dump_json())
+
+
+class TestFieldProjection(TestCase):
+    def test_dropped_fields_are_left_out_of_the_output(self):
+        projection = FieldProjection.parse(
+            "tokens_title, matched_profile,external_provider_attributes.context_annotations,"
+            "extra_author_attributes.world_data.latitude,images.url"
+        )
+        expected = TalkwalkerRecord.model_validate(SAMPLE_ITEM).model_dump_json(exclude=projection.to_exclude())
+
+        self.assertEqual(encode_record(SAMPLE_ITEM, projected_record_class(projection)), expected)
+        self.assertNotIn("tokens_title", expected)
+
+    def test_unknown_fields_are_rejected(self):
+        with self.assertRaises(ValueError):
+            projected_record_class(FieldProjection.parse("tokens_titel"))
+        with self.assertRaises(ValueError):
+            projected_record_class(FieldProjection.parse("url.host"))
+
+
+class TestPipeline(TestCase):
+    def test_all_items_reach_the_sink_and_batches_are_flushed(self):
+        batch = []
+
+        def batcher(n):
+            batch.append(n)
+            if len(batch) == 3:
+                rc = [list(batch)]
+                batch.clear()
+                return rc
+
+        pipeline = Pipeline(
+            [Stage("square", lambda n: [n * n], 4), Stage("batch", batcher, flush=lambda: [list(batch)])],
+            queue_size=2,
+        )
+        output = []
+        pipeline.run(range(10), output.extend)
+
+        self.assertEqual(sorted(output), [n * n for n in range(10)])
+        self.assertEqual(pipeline.stats()["processed"], {"square": 10, "batch": 10})
+
+    def test_stage_errors_stop_the_pipeline(self):
+        def fail(n):
+            if n == 5:
+                raise ValueError("bad item")
+            return [n]
+
+        pipeline = Pipeline([Stage("fail", fail, 2)], queue_size=1)
+        with self.assertRaises(ValueError):
+            pipeline.run(iter(range(1000)), lambda n: None)
+
+
+class FanOutDriver(Driver):
+    """Driver whose topics are pulled by a stub, topic "broken" fails like a failed preflight"""
+
+    def __init__(self):
+        super().__init__()
+        self.pulled = []
+        self.closed = False
+
+    def setup(self, params):
+        self.params = params
+
+    def close(self):
+        self.closed = True
+
+    def run_topic(self, params):
+        self.pulled.append((params["project_id"], params["topic_id"]))
+        if params["topic_id"] == "broken":
+            exit(1)
+        return {"topic_id": params["topic_id"]}
+
+
+class TestFanOut(TestCase):
+    def test_topics_of_several_projects(self):
+        self.assertEqual(
+            main.get_topics({"project_id": "p", "topic_id": "t1, q:t2,,t3"}),
+            [("p", "t1"), ("q", "t2"), ("p", "t3")],
+        )
+        self.assertEqual(
+            main.get_topics({
+                "project_id": "p", "topic_id": "",
+                "topics": [{"topic_id": "t1"}, {"project_id": "q", "topic_id": "t2"}],
+            }),
+            [("p", "t1"), ("q", "t2")],
+        )
+        self.assertEqual(main.get_topics({"project_id": "p", "topic_id": "t"}), [("p", "t")])
+
+    def test_a_failed_topic_does_not_abort_the_others(self):
+        driver = FanOutDriver()
+        topics = [("p", "t1"), ("p", "broken"), ("q", "t2")]
+
+        outputs = driver.run_topics({"task_id": "task"}, topics)
+
+        self.assertEqual(driver.pulled, topics)
+        self.assertEqual(
+            outputs,
+            [
+                {"topic_id": "t1"}, {"project_id": "p", "topic_id": "broken", "error": "exit status 1"},
+                {"topic_id": "t2"},
+            ],
+        )
+        self.assertTrue(driver.closed)
+
+        with self.assertRaises(SystemExit):
+            FanOutDriver().run_topics({}, [("p", "broken"), ("q", "broken")])
+        with self.assertRaises(SystemExit):
+            FanOutDriver().run_topics({}, [("p", "broken")])
+
+    def test_a_failed_topic_does_not_abort_the_backfill(self):
+        chunks = [("2024-01-01", "2024-01-07"), ("2024-01-08", "2024-01-10")]
+        for workers in (1, 2):
+            with self.subTest(workers=workers):
+                outputs = FanOutDriver().run_backfill({"task_id": "task"}, [("p", "broken"), ("p", "t1")], chunks,
+                                                      workers)
+                self.assertEqual(
+                    outputs,
+                    [
+                        [
+                            {
+                                "project_id": "p", "topic_id": "broken", "from_date": from_date,
+                                "to_date": to_date, "error": "exit status 1",
+                            },
+                            {"topic_id": "t1"},
+                        ]
+                        for from_date, to_date in chunks
+                    ],
+                )
+
+        with self.assertRaises(SystemExit):
+            FanOutDriver().run_backfill({}, [("p", "broken")], chunks, 2)
+
+    def test_forks_reserve_the_same_credits(self):
+        driver = Driver()
+        forks = [driver.fork() for _ in range(8)]
+        self.assertEqual(forks[0].credits.available(lambda: 500), 500)
+        reserved = []
+
+        def reserve(fork):
+            reserved.append(fork.credits.reserve(100))
+
+        threads = [threading.Thread(target=reserve, args=(fork,)) for fork in forks]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(reserved.count(True), 5)
+        self.assertEqual(driver.credits.available(lambda: 500), 0)
+        self.assertFalse(driver.credits.reserve(0))
+
+
+class TestUserAgentPool(TestCase):
+    def test_sampled_agents_are_handed_out_round_robin(self):
+        agents = iter(["a", "b", "a", "c"] * 10)
+        created = []
+
+        class UserAgent:
+            def __init__(self):
+                created.append(self)
+
+            @property
+            def random(self):
+                return next(agents)
+
+        pool = UserAgentPool(size=4)
+        with mock.patch.dict(sys.modules, {"fake_useragent": SimpleNamespace(UserAgent=UserAgent)}):
+            handed_out = [pool.next() for _ in range(7)]
+
+        # the browser database is loaded once, duplicates of the sample are dropped
+        self.assertEqual(len(created), 1)
+        self.assertEqual(handed_out, ["a", "b", "c", "a", "b", "c", "a"])
+
+    def test_bundled_agents_without_fake_useragent(self):
+        pool = UserAgentPool()
+        with mock.patch.dict(sys.modules, {"fake_useragent": None}):
+            handed_out = [pool.next() for _ in range(len(STATIC_USER_AGENTS))]
+
+        self.assertEqual(sorted(handed_out), sorted(STATIC_USER_AGENTS))
+        self.assertEqual(pool.next(), handed_out[0])
+        self.assertIn(UserAgentPool(use_fake_useragent=False).next(), STATIC_USER_AGENTS)
+        self.assertTrue(get_user_agent())
+
+
+class TestPreflight(TestCase):
+    def driver(self, available_credits=1000, required_credits=100):
+        return SimpleNamespace(
+            object_storage=object(),
+            get_project_name=lambda project_id: "project name",
+            get_topic_names=lambda project_id, topic_id: ("topic name", "solution"),
+            get_available_credits=lambda: available_credits,
+            get_required_credits=lambda topic_id, project_id: required_credits,
+        )
+
+    def test_report_of_a_topic_that_can_be_pulled(self):
+        report = run_preflight(self.driver(), "project", "topic")
+
+        self.assertTrue(report.ok)
+        self.assertEqual(
+            (report.project_name, report.topic_name, report.solution_name, report.s3_authenticated),
+            ("project name", "topic name", "solution", True),
+        )
+        self.assertEqual((report.available_credits, report.required_credits), (1000, 100))
+
+    def test_insufficient_credits_fail(self):
+        for available_credits, required_credits in ((50, 100), (1000, 0)):
+            with self.subTest(available_credits=available_credits, required_credits=required_credits):
+                with self.assertRaises(PreflightError) as raised:
+                    run_preflight(self.driver(available_credits, required_credits), "project", "topic")
+                self.assertEqual(
+                    raised.exception.report.errors,
+                    [
+                        f"Not enough credits available for: topic. Available credits: {available_credits}, "
+                        f"required credits: {required_credits}"
+                    ],
+                )
+
+    def test_failed_lookups_fail(self):
+        driver = self.driver(available_credits=None)
+        with self.assertRaises(PreflightError) as raised:
+            run_preflight(driver, "project", "topic")
+        self.assertEqual(raised.exception.report.errors, ["could not retrieve the available credits"])
+
+        driver = self.driver()
+        driver.get_project_name = mock.Mock(side_effect=KeyError("project"))
+        with self.assertRaises(PreflightError) as raised:
+            run_preflight(driver, "project", "topic")
+        self.assertEqual(raised.exception.report.errors, ["invalid project id: project"])
+
+
+class TestVolumePlan(TestCase):
+    def test_plan_from_histogram(self):
+        day = 1704067200  # 2024-01-01 UTC
+        windows = [(day + 3600 * n, day + 3600 * (n + 1), f"hour {n}") for n in range(3)]
+        source = SimpleNamespace(
+            access_token="token", project_id="project", topic_id="topic", start_date="2024-01-01",
+            end_date="2024-01-01", page_size="100", get_windows=lambda: iter(windows),
+        )
+        histogram = {
+            "result_histogram": {"data": [{"t": day * 1000, "v": [250]}, {"t": (day + 7200) * 1000, "v": [100]}]}
+        }
+
+        with mock.patch("{{ project_name }}.{{ package_name }}.plan.retry_request", return_value=histogram):
+            plan = build_plan(source, min_interval=0.1, request_seconds=1.0)
+
+        self.assertEqual([window.items for window in plan.windows], [250, 0, 100])
+        self.assertEqual(plan.total_requests, 3 + 1 + 1)
+        self.assertEqual(plan.estimated_credits, 350)
+        self.assertEqual(plan.estimated_seconds, 5.0)
+        self.assertEqual(plan.schedule(), [windows[0], windows[2]])
+
+    def test_windows_in_local_time_are_planned_from_utc_buckets(self):
+        params = {
+            "project_id": "project", "topic_id": "topic", "from_date": "2024-01-01", "to_date": "2024-01-01",
+            "get_news_links": "False",
+        }
+        utc_day = 1704067200  # 2024-01-01 UTC
+        histogram = {"result_histogram": {"data": [{"t": utc_day * 1000, "v": [10]}]}}
+        # a pod whose local hours are not UTC hours
+        try:
+            with mock.patch.dict(os.environ, {"TZ": "Asia/Kolkata"}):
+                time.tzset()
+                source = TalkwalkerSource(params, 1, 100, "token")
+                windows = list(source.get_windows())
+                with mock.patch("{{ project_name }}.{{ package_name }}.plan.retry_request", return_value=histogram):
+                    plan = build_plan(source, min_interval=0.1)
+        finally:
+            time.tzset()
+
+        day = utc_day - 19800  # local midnight, UTC+5:30
+        self.assertEqual(windows, [(day + 3600 * n, day + 3600 * (n + 1), f"1/1/2024 hour {n}") for n in range(24)])
+        # the bucket of 00:00 UTC is 05:30 local time
+        self.assertEqual([window.items for window in plan.windows], [0] * 5 + [10] + [0] * 18)
+
+
+class TestTransformPage(TestCase):
+    def test_derived_fields(self):
+        page = [
+            SimpleNamespace(data=SimpleNamespace(
+                url="https://www.bbc.co.uk/news/1", published=1700000000123, source_type=["ONLINENEWS"],
+            )),
+            SimpleNamespace(data=SimpleNamespace(
+                url="https://twitter.com/a/status/1", published=123, source_type=["SOCIAL"],
+                external_provider="twitter",
+            )),
+            SimpleNamespace(data=SimpleNamespace(url="", source_type="ONLINENEWS_OTHER")),
+        ]
+
+        rc, news = transform_page(page)
+
+        self.assertEqual([data["published"] for data in rc], [1700000000, -1, 0])
+        self.assertEqual([data["source"] for data in rc], ["co", "twitter", ""])
+        self.assertEqual(news, [True, False, True])
+        self.assertEqual({data["x-p6m-publish-source"] for data in rc}, {"talkwalker"})
+
+    def test_tweets_are_merged_in_place(self):
+        tweet = {"id": "1", "author_id": "2", "created_at": "2024-04-10T00:00:00.000Z", "text": "a short tweet"}
+        item = {"url": "https://twitter.com/a/status/1", "published": 0, "content": ""}
+
+        merged = merge_tweet(tweet, item)
+
+        self.assertIs(merged, item)
+        self.assertIs(merged["external_provider_attributes"], tweet)
+        # created_at is read as local time, like the talkwalker to twitter merge always did
+        published = int(datetime(2024, 4, 10).timestamp())
+        self.assertEqual((merged["published"], merged["x-p6m-publish-source"]), (published, "twitter"))
+        self.assertEqual((merged["content"], merged["word_count"], merged["url"]), ("a short tweet", 3, "1"))
+        self.assertNotIn("text", merged)
+        self.assertIn("text", tweet)
+
+        # a tweet without created_at is an error even when talkwalker has its published date
+        with self.assertRaises(KeyError):
+            merge_tweet({"id": "2", "text": "no date"}, {"published": 1712700000, "text": ""})
+
+
+class TestAdaptiveLimiter(TestCase):
+    def test_limit_grows_while_healthy_and_backs_off_on_429(self):
+        limiter = AdaptiveLimiter("api.talkwalker.com", initial=2, maximum=4)
+        for _ in range(20):
+            with limiter.track():
+                pass
+        self.assertEqual(limiter.limit, 4)
+
+        with limiter.track() as call:
+            call.outcome = "throttled"
+        self.assertEqual(limiter.limit, 2)
+
+    def test_circuit_pauses_a_failing_upstream(self):
+        limiter = AdaptiveLimiter("example.com", failure_threshold=2, open_seconds=0.2)
+        for _ in range(2):
+            with self.assertRaises(ConnectionError):
+                with limiter.track():
+                    raise ConnectionError("connection refused")
+
+        with self.assertRaises(CircuitOpenError):
+            limiter.acquire(block=False)
+
+        # the probe after open_seconds closes the circuit again
+        with limiter.track():
+            pass
+        self.assertEqual(limiter.snapshot()["state"], "closed")
+
+
+class FakeResponse:
+    def __init__(self, status, body):
+        self.status = status
+        self.body = body
+
+    async def __aenter__(self):
+        await asyncio.sleep(0.01)
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def read(self):
+        return self.body
+
+
+class FakeHttp:
+    """Stands in for the aiohttp session: 3 pages per window, the windows starting at 7200 answer 429"""
+
+    def __init__(self):
+        self.requests = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def get(self, url, params, headers):
+        self.requests += 1
+        if params["q"].startswith("(published:>=7200 "):
+            return FakeResponse(429, b'{"status_code": "429"}')
+        offset = int(params["offset"]) + 1
+        body = {
+            "result_content": {"data": [{"data": {"id": f"{params['q']}-{offset}"}}]},
+            "pagination": {"next": f"/results?offset={offset}&hpp=1" if offset < 3 else ""},
+        }
+        return FakeResponse(200, json.dumps(body).encode())
+
+
+class TestAsyncEngine(TestCase):
+    def setUp(self):
+        params = {
+            "project_id": "project", "topic_id": "topic", "from_date": "2024-01-01", "to_date": "2024-01-01",
+            "get_news_links": "False",
+        }
+        self.http = FakeHttp()
+        self.source = AsyncTalkwalkerSource(params, 1, 1, "token", rate_limiter=RateLimiter(0), max_in_flight=4)
+        self.source.page_interval = 0
+
+        def client_session():
+            self.source._in_flight = asyncio.Semaphore(self.source.max_in_flight)
+            return self.http
+
+        self.source._client_session = client_session
+
+    def test_pages_go_through_the_upstream_limiter(self):
+        windows = [(start, start + 3600, f"w{start}") for start in range(0, 3 * 3600, 3600)]
+        self.source.scheduler = DeadlineScheduler(windows)
+
+        pages = list(self.source.iter_pages(self.source.scheduler))
+
+        self.assertEqual(len(pages), 6)
+        limiter = self.source.upstreams.snapshot()["api.talkwalker.com"]
+        self.assertEqual((limiter["requests"], limiter["throttled"], limiter["in_flight"]), (7, 1, 0))
+
+    def test_fetching_goes_on_while_the_caller_is_busy(self):
+        windows = [(start, start + 3600, f"w{start}") for start in range(0, 2 * 3600, 3600)]
+        pages = self.source.iter_pages(windows, queue_size=8)
+
+        next(pages)
+        deadline = time.monotonic() + 2
+        while self.http.requests < 6 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.http.requests, 6)
+        self.assertEqual(len(list(pages)), 5)
+
+
+class TestResponseArchive(TestCase):
+    def test_replay_serves_recorded_responses_without_the_access_token(self):
+        path = f"{tempfile.mkdtemp()}/responses.jsonl.gz"
+        url = "https://api.talkwalker.com/api/v1/search/p/project/results"
+
+        archive = ResponseArchive(path, "record")
+        archive.record(request_key("GET", url, {"offset": 0, "access_token": "a"}), 200, b'{"page": 1}', 0.5)
+        archive.record(request_key("GET", url, {"offset": 0, "access_token": "a"}), 200, b'{"page": 2}', 0.5)
+        archive.close()
+
+        session = ArchiveSession(ResponseArchive(path, "replay"))
+        pages = [session.get(url, params={"access_token": "b", "offset": 0}).json() for _ in range(3)]
+        self.assertEqual(pages, [{"page": 1}, {"page": 2}, {"page": 2}])
+
+        missing = session.get(url, params={"offset": 100})
+        self.assertEqual(missing.status_code, 404)
+        self.assertEqual(session.archive.stats()["missed"], 1)
+
+
+class TestReprocess(TestCase):
+    def test_output_is_rebuilt_from_the_raw_pages(self):
+        directory = tempfile.mkdtemp()
+        news = {**SAMPLE_ITEM, "url": "https://www.example.com/news/2", "external_provider": "", "external_id": "2"}
+        tweet = {"id": SAMPLE_ITEM["external_id"], "created_at": "2024-04-10T00:00:00.000Z", "text": "a tweet"}
+
+        archive = RawPageArchive(f"{directory}/pages.jsonl.gz")
+        archive.add_run({"project_id": "project", "topic_id": "topic"})
+        page = {"result_content": {"data": [{"data": SAMPLE_ITEM}, {"data": news}]}}
+        archive.add_page(json.dumps(page, indent=2).encode())
+        archive.add_page(json.dumps(page).encode())  # same items again, dropped as duplicates
+        archive.add_tweets({"data": [tweet], "errors": []})
+        archive.close()
+
+        run = reprocess_archive(
+            f"{directory}/pages.jsonl.gz", f"{directory}/file_1.jsonl", workers=2, dedupe_window=100
+        )
+
+        self.assertEqual((run["topic_id"], run["pages"], run["total_saved"], run["duplicates"]), ("topic", 2, 2, 2))
+        with open(f"{directory}/file_1.jsonl") as f:
+            lines = [json.loads(line) for line in f]
+        self.assertEqual([line["content"] for line in lines], ["a tweet", SAMPLE_ITEM["content"]])
+
+        # without a dedupe window the repeated items are kept
+        run = reprocess_archive(f"{directory}/pages.jsonl.gz", f"{directory}/file_2.jsonl", workers=2)
+        self.assertEqual((run["total_saved"], run["duplicates"]), (4, 0))
+
+    def test_archive_of_a_shard_is_published_as_its_partition(self):
+        directory = tempfile.mkdtemp()
+        remaining = [{"start": 7200, "end": 10800, "label": "w2"}]
+        archive = RawPageArchive(f"{directory}/pages_4.jsonl.gz")
+        archive.add_run({
+            "project_id": "project", "topic_id": "topic", "get_news_links": "False", "project_name": "p",
+            "topic_name": "t", "solution_name": "s",
+            "params": {
+                "project_id": "project", "topic_id": "topic", "from_date": "2024-01-01", "to_date": "2024-01-02",
+            },
+            "partition": 4, "shard_index": 1, "shard_count": 3,
+        })
+        archive.add_page(json.dumps({"result_content": {"data": [{"data": SAMPLE_ITEM}]}}).encode())
+        archive.add_remaining(remaining)
+        archive.close()
+
+        uploads = []
+        driver = Driver()
+        driver.authenticate_s3 = mock.Mock()
+        driver.get_hash_id = mock.Mock(return_value="hash")
+        driver.upload_file = lambda file_path, bucket_name, key_name, digest=None: uploads.append(key_name) or True
+        params = {
+            **main.Constants.optional_configuration_variables, "bucket_location": "bucket", "tw_reprocess_workers": "1",
+        }
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            xcom = driver.reprocess(params, f"{directory}/pages_4.jsonl.gz")
+        finally:
+            os.chdir(cwd)
+
+        prefix = "raw/talkwalker/hash/2024-01-01_2024-01-02"
+        self.assertEqual(uploads, [f"{prefix}/file_4.jsonl", f"{prefix}/shards/xcom_hash_1.json"])
+        self.assertEqual((xcom["partition"], xcom["shard_index"], xcom["shard_count"]), (4, 1, 3))
+        self.assertEqual((xcom["remaining_windows"], xcom["next_partition"]), (remaining, 6))
+        self.assertEqual(xcom["manifest_partition"]["records"], 1)
+
+
+class TestShards(TestCase):
+    def test_shards_split_the_windows_evenly(self):
+        params = {
+            "project_id": "project", "topic_id": "topic", "from_date": "2024-01-01", "to_date": "2024-01-10",
+            "get_news_links": "False",
+        }
+        source = TalkwalkerSource(params, 1, 100, "token")
+
+        windows = list(source.get_windows())
+        shards = [list(source.get_windows(index, 3)) for index in range(3)]
+
+        self.assertEqual(sorted(sum(shards, [])), sorted(windows))
+        self.assertEqual([len(shard) for shard in shards], [80, 80, 80])
+
+    def test_finalize_combines_the_shard_xcoms(self):
+        prefix = "raw/talkwalker/hash/2024-01-01_2024-01-10"
+        shards = {}
+        for shard, (records, published, remaining) in enumerate([
+            (3, (100, 200), []), (2, (50, 150), [{"start": 7200, "end": 10800, "label": "w2"}])
+        ]):
+            partition = {
+                "partition": 1 + shard, "records": records, "bytes": 10 * records, "min_published": published[0],
+                "max_published": published[1], "md5": "md5", "output": f"s3://bucket/{prefix}/file_{1 + shard}.jsonl",
+            }
+            shards[f"{prefix}/shards/xcom_hash_{shard}.json"] = {
+                "query_hash": "hash", "project_id": "project", "topic_id": "topic", "from_date": "2024-01-01",
+                "to_date": "2024-01-10", "talkwalker_output": partition["output"], "partition": 1 + shard,
+                "shard_index": shard, "shard_count": 2, "manifest_partition": partition,
+                "raw_pages": f"s3://bucket/{prefix}/pages_{1 + shard}.jsonl.gz", "complete": not remaining,
+                "remaining_windows": remaining, **({"next_partition": 3} if remaining else {}),
+            }
+
+        s3 = mock.Mock()
+        s3.get_object.side_effect = lambda Bucket, Key: {"Body": io.BytesIO(json.dumps(shards[Key]).encode())}
+        uploads = {}
+
+        def upload_file(file_path, bucket_name, key_name, digest=None):
+            with open(file_path) as f:
+                uploads[key_name] = json.load(f)
+            return True
+
+        driver = Driver()
+        driver.s3 = s3
+        driver.authenticate_s3 = mock.Mock()
+        driver.get_hash_id = mock.Mock(return_value="hash")
+        driver.upload_file = upload_file
+        params = {
+            "bucket_location": "bucket", "shard_count": "2", "get_news_links": "False", "from_date": "2024-01-01",
+            "to_date": "2024-01-10",
+        }
+        cwd = os.getcwd()
+        os.chdir(tempfile.mkdtemp())
+        try:
+            xcom = driver.finalize_topics(params, [("project", "topic")])[0]
+        finally:
+            os.chdir(cwd)
+
+        self.assertEqual(uploads[f"{prefix}/xcom_hash.json"], xcom)
+        self.assertEqual(
+            xcom["talkwalker_outputs"], [f"s3://bucket/{prefix}/file_1.jsonl", f"s3://bucket/{prefix}/file_2.jsonl"]
+        )
+        self.assertEqual(len(xcom["raw_pages"]), 2)
+        self.assertEqual(
+            (xcom["partitions"], xcom["complete"], xcom["next_partition"], xcom["manifest"]),
+            (2, False, 3, f"s3://bucket/{prefix}/manifest_hash.json"),
+        )
+        self.assertEqual(xcom["remaining_windows"], [{"start": 7200, "end": 10800, "label": "w2"}])
+        self.assertNotIn("shard_index", xcom)
+
+        manifest = uploads[f"{prefix}/manifest_hash.json"]
+        self.assertEqual([p["partition"] for p in manifest["partitions"]], [1, 2])
+        self.assertEqual(
+            (manifest["records"], manifest["bytes"], manifest["min_published"], manifest["max_published"]),
+            (5, 50, 50, 200),
+        )
+
+
+class TestDeadlineScheduler(TestCase):
+    def test_windows_projected_past_the_deadline_are_not_started(self):
+        now = [0.0]
+        windows = [(start, start + 3600, f"w{start}") for start in range(0, 5 * 3600, 3600)]
+        scheduler = DeadlineScheduler(order_windows(windows, "recent"), deadline=100, margin=10, clock=lambda: now[0])
+
+        started = []
+        for window in scheduler:
+            started.append(window)
+            now[0] += 20
+            scheduler.complete(window, 1)
+
+        # the fifth window would complete at 100, after deadline - margin
+        self.assertEqual(started, sorted(windows, reverse=True)[:4])
+        self.assertEqual(scheduler.stop_reason, "projected past the deadline")
+        self.assertEqual(parse_windows(json.dumps(scheduler.remaining())), windows[:1])
+        self.assertFalse(scheduler.expired())
+        now[0] = 90
+        self.assertTrue(scheduler.expired())
+        self.assertEqual(list(DeadlineScheduler(windows)), windows)
+
+    def test_window_finished_after_the_cutoff_is_complete(self):
+        now = [0.0]
+        windows = [(0, 3600, "w0"), (3600, 7200, "w1")]
+        pages = {0: 2, 3600: 3}  # pages of each window
+
+        def download(url, parameters):
+            # the cutoff at 90 passes while the second page of each window is fetched
+            now[0] += 50
+            start = int(parameters["q"].split(">=")[1].split(" ")[0])
+            offset = parameters["offset"] + 1
+            return {
+                "data": SimpleNamespace(result_content=SimpleNamespace(data=[{"id": offset}])),
+                "pagination": {"next": f"/results?offset={offset}&hpp=1" if offset < pages[start] else ""},
+                "seconds": 0.1, "bytes": 100,
+            }
+
+        params = {
+            "project_id": "project", "topic_id": "topic", "from_date": "2024-01-01", "to_date": "2024-01-01",
+            "get_news_links": "False",
+        }
+        driver = Driver()
+        driver.params = {**main.Constants.optional_configuration_variables}
+        driver.talk_walker = TalkwalkerSource(params, 1, 1, "token", rate_limiter=mock.Mock())
+        driver.talk_walker.page_interval = 0
+        driver.talk_walker.download_as_object = download
+        driver.scheduler = driver.talk_walker.scheduler = DeadlineScheduler(
+            windows, deadline=100, margin=10, clock=lambda: now[0]
+        )
+        fetch = driver.build_pipeline(f"{tempfile.mkdtemp()}/errors.txt").stages[0]
+
+        self.assertEqual(len(list(fetch.process(windows[0]))), 2)
+        self.assertTrue(driver.scheduler.expired())
+        # its last page came after the cutoff, the window is in the output and not fetched again
+        self.assertEqual(len(list(fetch.process(windows[1]))), 1)
+        self.assertEqual(parse_windows(json.dumps(driver.scheduler.remaining())), windows[1:])
+
+        # the given up window is listed with its next page and the partition holding its first page
+        remaining = driver.scheduler.remaining(partition=3)
+        self.assertEqual(remaining, [{"start": 3600, "end": 7200, "label": "w1", "offset": 1, "partition": 3}])
+
+        # the follow-up run only fetches the pages after it
+        offsets = parse_offsets(json.dumps(remaining))
+        self.assertEqual(offsets, {windows[1]: (1, 3)})
+        driver.scheduler = driver.talk_walker.scheduler = DeadlineScheduler(windows[1:], offsets=offsets)
+        ids = [item["id"] for page in fetch.process(windows[1]) for item in page]
+        self.assertEqual(ids, [2, 3])
+        self.assertEqual(driver.scheduler.remaining(partition=4), [])
+
+    def test_backfill_chunks_cover_the_range_once(self):
+        self.assertEqual(
+            date_chunks("2024-01-20", "2024-01-03"),
+            [("2024-01-03", "2024-01-07"), ("2024-01-08", "2024-01-14"), ("2024-01-15", "2024-01-20")],
+        )
+        self.assertEqual(
+            date_chunks("2024-01-20", "2024-02-29", "month"),
+            [("2024-01-20", "2024-01-31"), ("2024-02-01", "2024-02-29")],
+        )
+        self.assertEqual(len(date_chunks("2024-01-01", "2024-12-31", "day")), 366)
+        self.assertEqual(
+            date_chunks("2024-01-01", "2024-01-05", "3"), [("2024-01-01", "2024-01-03"), ("2024-01-04", "2024-01-05")]
+        )
+        with self.assertRaises(ValueError):
+            date_chunks("2024-01-01", "2024-01-05", "fortnight")
+
+
+class TestCommandLine(TestCase):
+    def test_options_override_the_json_inputs(self):
+        options = main.parse_args([
+            "backfill", "--args", '{"topic_id": "a", "from_date": "2024-01-01", "get_news_links": "True"}',
+            "--topics", "p1:t1,t2", "--to-date", "2024-01-31", "--chunk", "month", "--workers", "3",
+        ])
+        args = main.get_cli_inputs(options)
+
+        self.assertEqual((options.command, options.chunk, options.workers), ("backfill", "month", 3))
+        self.assertEqual(
+            {key: args[key] for key in ("topic_id", "topics", "from_date", "to_date", "get_news_links", "task_id")},
+            {
+                "topic_id": "a", "topics": "p1:t1,t2", "from_date": "2024-01-01", "to_date": "2024-01-31",
+                "get_news_links": "True", "task_id": "cli",
+            },
+        )
+        self.assertEqual(main.get_cli_inputs(main.parse_args(["run", "--topics", "t1,t2"]))["topic_id"], "t1,t2")
+        self.assertTrue(main.parse_args(["run", "--topic-id", "t", "--dry-run"]).dry_run)
+        with self.assertRaises(SystemExit):
+            main.parse_args(["reprocess"])
+
+    def test_backfill_pulls_every_chunk(self):
+        all_vars = {"from_date": "2024-01-01", "to_date": "2024-01-10"}
+        with mock.patch.object(main, "setup_logging"), \
+                mock.patch.object(main, "get_run_inputs", return_value=(all_vars, [("p", "t")])) as get_run_inputs, \
+                mock.patch.object(main, "Driver") as driver, mock.patch("builtins.print") as output:
+            driver.return_value.run_backfill.return_value = [["first"], ["second"]]
+            self.assertEqual(
+                main.main(["backfill", "--topic-id", "t", "--from-date", "2024-01-01", "--to-date", "2024-01-10",
+                           "--workers", "2"]),
+                0,
+            )
+
+        self.assertEqual(get_run_inputs.call_args[0][0]["topic_id"], "t")
+        chunks = [("2024-01-01", "2024-01-07"), ("2024-01-08", "2024-01-10")]
+        driver.return_value.run_backfill.assert_called_once_with(all_vars, [("p", "t")], chunks, 2)
+        self.assertEqual(
+            json.loads(output.call_args[0][0])["talkwalker_backfill"],
+            [
+                {"from_date": "2024-01-01", "to_date": "2024-01-07", "talkwalker_outputs": ["first"]},
+                {"from_date": "2024-01-08", "to_date": "2024-01-10", "talkwalker_outputs": ["second"]},
+            ],
+        )
+
+
+class TestPageSizer(TestCase):
+    def test_pages_are_sized_from_the_total_and_the_caps(self):
+        sizer = PageSizer(100, maximum=500, latency_cap=2.0, bytes_cap=10 ** 6, smoothing=1.0)
+        self.assertEqual(sizer.next_size(), 100)
+
+        sizer.observe(100, 0.2, 10 ** 5)
+        self.assertEqual(sizer.next_size(), 500)
+        # 1100 items left in 3 pages rather than 500, 500 and 100
+        self.assertEqual(sizer.next_size(1200, 100), 367)
+        self.assertEqual(sizer.next_size(130, 100), 30)
+
+        sizer.observe(100, 1.0, 10 ** 5)
+        self.assertEqual(sizer.next_size(), 200)  # 10 ms per item
+        sizer.observe(100, 0.1, 10 ** 6)
+        self.assertEqual(sizer.next_size(), 100)  # 10 kB per item
+        self.assertEqual(PageSizer(100, maximum=100).next_size(1200, 100), 100)
+
+    def test_window_pages_follow_the_sizer(self):
+        params = {
+            "project_id": "project", "topic_id": "topic", "from_date": "2024-01-01", "to_date": "2024-01-01",
+            "get_news_links": "False",
+        }
+        source = TalkwalkerSource(params, 1, "100", "token", page_sizer=PageSizer(100, smoothing=1.0))
+        source.page_interval = 0
+        source.rate_limiter = mock.Mock()
+        requested = []
+
+        def download_as_object(url, parameters):
+            requested.append((parameters["offset"], parameters["hpp"]))
+            items = min(parameters["hpp"], 1000 - parameters["offset"])
+            next_offset = parameters["offset"] + items
+            page = SimpleNamespace(result_content=SimpleNamespace(data=[None] * items))
+            return {
+                "data": page, "seconds": 0.01 * items, "bytes": 1000 * items,
+                "pagination": {"total": 1000, "next": f"?offset={next_offset}&hpp=1" if next_offset < 1000 else ""},
+            }
+
+        source.download_as_object = download_as_object
+        pages = list(source.fetch_pages("url", source.window_parameters(0, 3600)))
+
+        self.assertEqual(requested, [(0, 100), (100, 450), (550, 450)])
+        self.assertEqual(sum(len(page) for page in pages), 1000)
+
+
+class TestManifest(TestCase):
+    def test_stats_match_the_output_file(self):
+        path = f"{tempfile.mkdtemp()}/file_1.jsonl"
+        records = [{"id": 1, "published": 1704070800}, {"id": 2, "published": 0}, {"id": 3, "published": 1704067200}]
+        data = "".join(json.dumps(record) + "\n" for record in records).encode()
+        with open(path, "wb") as f:
+            f.write(data)
+
+        stats = PartitionStats(1)
+        stats.add(data[:data.index(b"\n") + 1], 1, [1704070800])
+        stats.add(data[data.index(b"\n") + 1:], 2, [0, 1704067200])
+
+        self.assertEqual(stats.to_dict(), PartitionStats.from_file(path, 1).to_dict())
+        self.assertEqual(
+            (stats.records, stats.bytes, stats.min_published, stats.max_published),
+            (3, len(data), 1704067200, 1704070800),
+        )
+
+        xcom = {"query_hash": "hash", "project_id": "p", "topic_id": "t", "from_date": "a", "to_date": "b"}
+        empty = PartitionStats(2).to_dict()
+        manifest = build_manifest(xcom, [empty, stats.to_dict()])
+        self.assertEqual([p["partition"] for p in manifest["partitions"]], [1, 2])
+        self.assertEqual((manifest["records"], manifest["min_published"]), (3, 1704067200))
+
+    def test_etag_digest_of_single_and_multipart_uploads(self):
+        data = bytes(range(256)) * 10
+        digest = ETagDigest(part_size=1000)
+        for n in range(0, len(data), 300):
+            digest.update(data[n:n + 300])
+
+        parts = b"".join(hashlib.md5(data[n:n + 1000]).digest() for n in range(0, len(data), 1000))
+        self.assertEqual(digest.md5, hashlib.md5(data).hexdigest())
+        self.assertEqual(digest.multipart_etag, f"{hashlib.md5(parts).hexdigest()}-3")
+        self.assertTrue(digest.matches(f'"{digest.md5}"'))
+        self.assertTrue(digest.matches(digest.multipart_etag))
+        self.assertFalse(digest.matches(f"{hashlib.md5(parts).hexdigest()}-2"))
+
+    def test_unchanged_objects_are_not_uploaded_again(self):
+        path = f"{tempfile.mkdtemp()}/file_1.jsonl"
+        with open(path, "wb") as f:
+            f.write(b'{"id": 1}\n')
+        md5 = hashlib.md5(b'{"id": 1}\n').hexdigest()
+
+        driver = Driver()
+        driver.params = {"tw_upload_skip_unchanged": "True", "tw_upload_part_size": "8388608"}
+        driver.object_storage = mock.Mock()
+        driver.s3 = mock.Mock()
+        driver.s3.head_object.return_value = {"ContentLength": 10, "ETag": f'"{md5}"', "Metadata": {}}
+
+        self.assertTrue(driver.upload_file(path, "bucket", "key"))
+        driver.object_storage.upload_file.assert_not_called()
+
+        driver.s3.head_object.side_effect = Exception("Not Found")
+        self.assertTrue(driver.upload_file(path, "bucket", "key"))
+        driver.object_storage.upload_file.assert_called_once_with(path, "bucket", "key")
+        self.assertEqual(
+            driver.upload_stats.to_dict(),
+            {"uploaded_files": 1, "uploaded_bytes": 10, "skipped_files": 1, "skipped_bytes": 10},
+        )
+
+
+class TestStructuredLogging(TestCase):
+    def test_messages_are_sampled_per_type(self):
+        sampling = SamplingFilter(burst=2, interval=60)
+
+        def record(msg, *args, level=logging.INFO):
+            return logging.LogRecord("driver", level, __file__, 1, msg, args, None)
+
+        let_through = [sampling.filter(record("Item retrieved for %s: %s", "label", i)) for i in range(5)]
+        self.assertEqual(let_through, [True, True, False, False, False])
+        self.assertTrue(sampling.filter(record("another message")))
+        self.assertTrue(sampling.filter(record("Item retrieved for %s: %s", "label", 5, level=logging.WARNING)))
+
+        sampling.interval = 0
+        line = record("Item retrieved for %s: %s", "label", 6)
+        self.assertTrue(sampling.filter(line))
+        self.assertEqual(json.loads(JsonFormatter().format(line))["sampled_out"], 3)
+        self.assertEqual(json.loads(JsonFormatter().format(line))["message"], "Item retrieved for label: 6")
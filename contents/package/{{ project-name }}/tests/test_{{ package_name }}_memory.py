@@ -0,0 +1,327 @@
+"""
+Memory ceilings of a whole Driver.run() against a fake talkwalker api.
+
+Every measured run happens in a fresh interpreter, run_scenario() below, so that its peak RSS is its own. The
+api is a requests adapter mounted on the driver's session that generates the search windows on the fly,
+one item in five is a tweet, hydrated by a fake twitter source, and uploads go to a fake object storage.
+tracemalloc reports the peak of every pipeline stage call, over the memory held when the call started; the
+stage calls are serialized for that, so their peaks do not mix. A stage is measured by the 99th percentile of
+its calls, the highest point of the whole pipeline by the traced memory held at any call. A small and a large
+run are compared: every measure of the large one must stay under its ceiling and within GROWTH of the small one.
+
+The default runs take seconds. Millions of items, e.g. 30 days of 2000 items per hour:
+
+    TW_MEMORY_DAYS=30 TW_MEMORY_ITEMS_PER_WINDOW=2000 poetry run pytest tests/test_{{ package_name }}_memory.py
+
+TW_MEMORY_CEILINGS overrides ceilings, in MB, as json: '{"rss": 300, "hydrate": 16}'.
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import tracemalloc
+from datetime import date, timedelta
+from unittest import TestCase, skipIf
+from urllib.parse import parse_qs, urlsplit
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+import requests
+from requests.adapters import BaseAdapter
+
+# MB, of the large run
+CEILINGS = {
+    "rss": 200,
+    "pull": 16,  # traced memory held at the highest point of the pipeline
+    "publish": 2,
+    "fetch": 4,
+    "format": 4,
+    "dedupe": 4,
+    "hydrate": 4,
+    "serialize": 4,
+    "sink": 2,
+}
+# a large run may hold GROWTH times what the small one holds, plus some MB
+GROWTH = 1.25
+GROWTH_SLACK_MB = {"rss": 16, "pull": 4}  # 0.25 MB for the stages
+
+SMALL = {"days": 1, "items_per_window": 100}
+LARGE = {
+    "days": int(os.getenv("TW_MEMORY_DAYS", "2")),
+    "items_per_window": int(os.getenv("TW_MEMORY_ITEMS_PER_WINDOW", "300")),
+}
+
+MB = 2 ** 20
+PROJECT_ID = "project"
+TOPIC_ID = "topic"
+LANGS = ["en", "en", "en", "fr", "de", "es"]
+SOURCE_TYPES = [["ONLINENEWS", "ONLINENEWS_NEWSPAPER"], ["BLOG", "BLOG_OTHER"], ["FORUM", "FORUM_OTHER"]]
+
+
+def fake_item(start: int, i: int, items_per_window: int) -> dict:
+    """Result item i of the window starting at start, every fifth one a tweet"""
+    site = f"site{i % 300}.example.com"
+    item = {
+        "url": f"https://{site}/{start}/{i}",
+        "matched_profile": ["profile-brand"],
+        "indexed": start * 1000 + i,
+        "search_indexed": start * 1000 + i,
+        "published": (start + i * 3600 // items_per_window) * 1000,
+        "title": f"Title of article {i}",
+        "content": f"Content of article {i} " * 8,
+        "root_url": f"https://{site}/",
+        "domain_url": f"https://{site}/",
+        "host_url": f"https://{site}/{start}/",
+        "lang": LANGS[i % len(LANGS)],
+        "sentiment": i % 11 - 5,
+        "source_type": SOURCE_TYPES[i % len(SOURCE_TYPES)],
+        "post_type": ["TEXT"],
+        "tokens_title": ["title", "article"],
+        "source_extended_attributes": {"id": site, "name": site},
+        "extra_author_attributes": {"id": f"author{i % 1000}", "name": f"Author {i % 1000}"},
+        "engagement": i % 100,
+        "reach": i % 10000,
+        "word_count": 32,
+    }
+    if i % 5 == 0:
+        item.update({
+            "url": f"https://twitter.com/user/status/{start}{i:06d}",
+            "root_url": "https://twitter.com/",
+            "domain_url": "https://twitter.com/",
+            "source_type": ["SOCIALMEDIA", "SOCIALMEDIA_TWITTER"],
+            "external_provider": "twitter",
+            "external_id": int(f"{start}{i:06d}"),
+        })
+    return item
+
+
+class FakeTalkwalkerAdapter(BaseAdapter):
+    """Answers the talkwalker api calls of a run, the windows have items_per_window items each"""
+
+    def __init__(self, days: int, items_per_window: int):
+        super().__init__()
+        self.days = days
+        self.items_per_window = items_per_window
+        self.requests = 0
+
+    def send(self, request, **kwargs):
+        self.requests += 1
+        parts = urlsplit(request.url)
+        query = {key: values[0] for key, values in parse_qs(parts.query).items()}
+
+        if parts.path == "/api/v1/search/info":
+            body = {"result_accinfo": {"projects": [{"id": PROJECT_ID, "name": "Project"}]}}
+        elif parts.path == f"/api/v2/talkwalker/p/{PROJECT_ID}/resources":
+            topic = {"title": "Solution", "nodes": [{"id": TOPIC_ID, "title": "Topic"}]}
+            body = {"result_resources": {"projects": [{"topics": [topic]}]}}
+        elif parts.path == "/api/v1/status/credits":
+            body = {"result_creditinfo": {"remaining_credits_monthly": 10 ** 9}}
+        elif parts.path == f"/api/v1/search/p/{PROJECT_ID}/results":
+            body = self.results(query)
+        else:
+            body, status = {"error": f"unknown path {parts.path}"}, 404
+            return self.response(request, body, status)
+        return self.response(request, body)
+
+    def results(self, query: dict) -> dict:
+        hpp, offset = int(query["hpp"]), int(query["offset"])
+        if hpp == 0:
+            # the required credits of the topic
+            return {"pagination": {"total": self.days * 24 * self.items_per_window}, "result_content": None}
+
+        start = int(query["q"].split("published:>=")[1].split(" ")[0])
+        end = min(offset + hpp, self.items_per_window)
+        page = [{"data": fake_item(start, i, self.items_per_window)} for i in range(offset, end)]
+        pagination = {"total": self.items_per_window}
+        if end < self.items_per_window:
+            pagination["next"] = f"/api/v1/search/p/{PROJECT_ID}/results?offset={end}&hpp={hpp}"
+        return {"pagination": pagination, "result_content": {"data": page}}
+
+    @staticmethod
+    def response(request, body: dict, status: int = 200) -> requests.Response:
+        rc = requests.Response()
+        rc.status_code = status
+        rc._content = json.dumps(body).encode()
+        rc.headers["Content-Type"] = "application/json"
+        rc.encoding = "utf-8"
+        rc.url = request.url
+        rc.request = request
+        return rc
+
+    def close(self):
+        pass
+
+
+class FakeTwitterSource:
+    def get_tweets_by_ids(self, ids, error_file_path):
+        return {
+            "data": [
+                {
+                    "id": tweet_id, "author_id": "1000", "created_at": "2024-04-10T08:15:30.000Z", "lang": "en",
+                    "text": f"tweet {tweet_id} with a link https://t.co/abcdef #hashtag",
+                    "public_metrics": {"retweet_count": 1, "reply_count": 0, "like_count": 2, "quote_count": 0},
+                }
+                for tweet_id in ids
+            ],
+            "errors": [],
+        }
+
+
+class FakeObjectStorage:
+    def __init__(self):
+        self.uploads = {}
+
+    def upload_file(self, file_path, bucket_name, key_name) -> bool:
+        self.uploads[key_name] = os.path.getsize(file_path)
+        return True
+
+
+class StageProbe:
+    """tracemalloc peaks of the pipeline stage calls, the calls are serialized so that their peaks do not mix"""
+
+    def __init__(self):
+        self.peaks = {}  # stage -> peaks of its calls over the memory held when they started
+        self.held = 0  # highest traced memory seen during the calls
+        self._lock = threading.Lock()
+
+    def call(self, name, fn, *args):
+        with self._lock:
+            base = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            try:
+                return fn(*args)
+            finally:
+                peak = tracemalloc.get_traced_memory()[1]
+                self.held = max(self.held, peak)
+                self.peaks.setdefault(name, []).append(peak - base)
+
+    def percentile(self, name, q: float = 0.99) -> int:
+        """
+        Peak of q of the calls of a stage, one-off allocations of the interpreter (e.g. a resize of the table
+        of interned strings) land in whichever call triggers them
+        """
+        peaks = sorted(self.peaks[name])
+        return peaks[int(q * (len(peaks) - 1))]
+
+    def wrap(self, name, process):
+        """process (or flush) measured one output at a time, generator stages stay lazy"""
+
+        def measured(*args):
+            outputs = self.call(name, lambda: iter(process(*args) or ()))
+            while True:
+                try:
+                    output = self.call(name, next, outputs)
+                except StopIteration:
+                    return
+                yield output
+
+        return measured
+
+
+def run_scenario(scenario: dict) -> dict:
+    """Driver.run() of scenario against the fakes, in the current directory, returns its measures in MB"""
+    from {{ project_name }}.{{ package_name }}.driver import Driver
+    from {{ project_name }}.{{ package_name }}.main import Constants
+    from {{ project_name }}.{{ package_name }}.ratelimit import RateLimiter
+
+    probe = StageProbe()
+    phases = {}
+
+    class MeasuredDriver(Driver):
+        def create_source(self, params, project_id=None, topic_id=None):
+            source = super().create_source(params, project_id, topic_id)
+            source.page_interval = 0
+            return source
+
+        def build_pipeline(self, error_file_path):
+            pipeline = super().build_pipeline(error_file_path)
+            for stage in pipeline.stages:
+                stage.process = probe.wrap(stage.name, stage.process)
+                if stage.flush is not None:
+                    stage.flush = probe.wrap(stage.name, stage.flush)
+            run = pipeline.run
+            pipeline.run = lambda inputs, sink: run(inputs, lambda output: probe.call("sink", sink, output))
+            return pipeline
+
+        def publish(self, *args, **kwargs):
+            base = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            try:
+                return super().publish(*args, **kwargs)
+            finally:
+                phases["publish"] = tracemalloc.get_traced_memory()[1] - base
+
+    first = date(2024, 1, 1)
+    params = {
+        **Constants.optional_configuration_variables,
+        "from_date": str(first), "to_date": str(first + timedelta(days=scenario["days"] - 1)),
+        "task_id": "task", "project_id": PROJECT_ID, "topic_id": TOPIC_ID, "get_news_links": "False",
+        "API_KEY": "token", "TWITTER_TOKEN": "token", "max_retries": "1", "page_size": "100",
+        "bucket_location": "bucket",
+        # fixed pages, and buffers that fill up in the small run already: the dedupe window and the queues
+        # between the stages, which hold up to tw_pipeline_queue_size pages each
+        "tw_page_size_max": "100",
+        "tw_dedupe_window": "2000",
+        "tw_pipeline_queue_size": "2",
+        "tw_upload_skip_unchanged": "False",  # the fake bucket is empty, no head requests to s3
+    }
+
+    adapter = FakeTalkwalkerAdapter(scenario["days"], scenario["items_per_window"])
+    driver = MeasuredDriver()
+    driver.session = requests.Session()
+    driver.session.mount("https://", adapter)
+    driver.rate_limiter = RateLimiter(0)
+    driver.object_storage = FakeObjectStorage()
+    driver.twitter = FakeTwitterSource()
+
+    tracemalloc.start()
+    driver.run(params)
+    tracemalloc.stop()
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    rc = {
+        "items": driver.talk_walker.total_saved,
+        "requests": adapter.requests,
+        "rss": rss / (MB if sys.platform == "darwin" else 1024),  # bytes on macos, kB elsewhere
+        "pull": probe.held / MB,
+        "publish": phases["publish"] / MB,
+    }
+    rc.update({name: probe.percentile(name) / MB for name in probe.peaks})
+    return rc
+
+
+@skipIf(resource is None, "peak RSS is read with the resource module")
+class TestMemoryCeilings(TestCase):
+    def measure(self, scenario: dict) -> dict:
+        with tempfile.TemporaryDirectory() as path:
+            out = os.path.join(path, "measures.json")
+            env = {**os.environ, "PYTHONPATH": os.pathsep.join(p for p in sys.path if p)}
+            subprocess.run(
+                [sys.executable, __file__, json.dumps(scenario), out], cwd=path, env=env, check=True,
+                stdout=subprocess.DEVNULL,
+            )
+            with open(out) as f:
+                return json.load(f)
+
+    def test_memory_stays_flat_as_the_run_grows(self):
+        ceilings = {**CEILINGS, **json.loads(os.getenv("TW_MEMORY_CEILINGS", "{}"))}
+        small = self.measure(SMALL)
+        large = self.measure(LARGE)
+
+        self.assertEqual(small["items"], SMALL["days"] * 24 * SMALL["items_per_window"])
+        self.assertEqual(large["items"], LARGE["days"] * 24 * LARGE["items_per_window"])
+        for name, ceiling in ceilings.items():
+            with self.subTest(measure=name):
+                limit = small[name] * GROWTH + GROWTH_SLACK_MB.get(name, 0.25)
+                self.assertLess(large[name], ceiling, f"{name} over its ceiling, small run {small}, large {large}")
+                self.assertLess(large[name], limit, f"{name} grows with the run, small run {small}, large {large}")
+
+
+if __name__ == "__main__":
+    with open(sys.argv[2], "w") as out_file:
+        json.dump(run_scenario(json.loads(sys.argv[1])), out_file)